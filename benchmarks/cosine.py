@@ -0,0 +1,118 @@
+import os
+import sys
+import timeit
+
+import numba as nb
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import similarity  # noqa: E402
+
+
+# Previous cosine kernel (match lists, reflected sets, and uint16 shift
+# indexes that overflow for spectra with more than 65,535 peaks).
+@nb.njit
+def _cosine_lists(spec, spec_other, fragment_mz_tolerance, allow_shift):
+    precursor_charge = max(spec.precursor_charge, 1)
+    precursor_mass_diff = ((spec.precursor_mz - spec_other.precursor_mz)
+                           * precursor_charge)
+    num_shifts = 1
+    if allow_shift and abs(precursor_mass_diff) >= fragment_mz_tolerance:
+        num_shifts += precursor_charge
+    other_peak_index = np.zeros(num_shifts, np.uint16)
+    mass_diff = np.zeros(num_shifts, np.float32)
+    for charge in range(1, num_shifts):
+        mass_diff[charge] = precursor_mass_diff / charge
+
+    peak_match_scores, peak_match_idx = [], []
+    for peak_index, (peak_mz, peak_intensity) in enumerate(zip(
+            spec.mz, spec.intensity)):
+        for cpi in range(num_shifts):
+            while (other_peak_index[cpi] < len(spec_other.mz) - 1 and
+                   (peak_mz - fragment_mz_tolerance >
+                    spec_other.mz[other_peak_index[cpi]] + mass_diff[cpi])):
+                other_peak_index[cpi] += 1
+        for cpi in range(num_shifts):
+            index = 0
+            other_peak_i = other_peak_index[cpi] + index
+            while (other_peak_i < len(spec_other.mz) and
+                   abs(peak_mz - (spec_other.mz[other_peak_i]
+                       + mass_diff[cpi])) <= fragment_mz_tolerance):
+                peak_match_scores.append(
+                    peak_intensity * spec_other.intensity[other_peak_i])
+                peak_match_idx.append((peak_index, other_peak_i))
+                index += 1
+                other_peak_i = other_peak_index[cpi] + index
+
+    score, peak_matches = 0., []
+    if len(peak_match_scores) > 0:
+        peak_match_scores_arr = np.asarray(peak_match_scores)
+        peak_match_order = np.argsort(peak_match_scores_arr)[::-1]
+        peak_match_scores_arr = peak_match_scores_arr[peak_match_order]
+        peak_match_idx_arr = np.asarray(peak_match_idx)[peak_match_order]
+        peaks_used, other_peaks_used = set(), set()
+        for peak_match_score, peak_i, other_peak_i in zip(
+                peak_match_scores_arr, peak_match_idx_arr[:, 0],
+                peak_match_idx_arr[:, 1]):
+            if (peak_i not in peaks_used
+                    and other_peak_i not in other_peaks_used):
+                score += peak_match_score
+                peak_matches.append((peak_i, other_peak_i))
+                peaks_used.add(peak_i)
+                other_peaks_used.add(other_peak_i)
+
+    return score, peak_matches
+
+
+def _random_pair(rng, num_peaks):
+    # Two spectra that share about half of their peaks, with the second one
+    # shifted by a (singly charged) precursor mass difference.
+    mz = np.sort(rng.uniform(50, 2000, num_peaks)).astype(np.float32)
+    mz_other = mz.copy()
+    shifted = rng.random(num_peaks) < 0.5
+    mz_other[shifted] += np.float32(14.0157)
+    mz_other += rng.normal(0, 0.005, num_peaks).astype(np.float32)
+    mz_other.sort()
+    spectra = []
+    for precursor_mz, peaks_mz in ((814.3, mz), (800.3, mz_other)):
+        intensity = rng.exponential(1000, num_peaks).astype(np.float32)
+        spectra.append(similarity.SpectrumTuple(
+            precursor_mz, 1, peaks_mz, intensity / np.linalg.norm(intensity)))
+    return spectra
+
+
+def main():
+    rng = np.random.default_rng(42)
+    print(f'{"peaks":>8}{"cosine":>10}{"lists (ms)":>13}{"arrays (ms)":>13}'
+          f'{"speedup":>10}')
+    for num_peaks in (10, 100, 1000, 10000, 50000, 100000):
+        spec, spec_other = _random_pair(rng, num_peaks)
+        number = max(1, 100000 // num_peaks)
+        for allow_shift in (False, True):
+            args = spec, spec_other, 0.02, allow_shift
+            score, peak_matches = similarity._cosine(*args)
+            time_arrays = timeit.timeit(
+                lambda: similarity._cosine(*args),
+                number=number) / number * 1000
+            # The previous kernel never terminates for spectra with more
+            # than 65,535 peaks.
+            if num_peaks <= np.iinfo(np.uint16).max:
+                score_lists, peak_matches_lists = _cosine_lists(*args)
+                assert score == score_lists
+                assert np.array_equal(
+                    peak_matches,
+                    np.asarray(peak_matches_lists, np.int64).reshape(-1, 2))
+                time_lists = timeit.timeit(
+                    lambda: _cosine_lists(*args),
+                    number=number) / number * 1000
+                lists, speedup = (f'{time_lists:>13.3f}',
+                                  f'{time_lists / time_arrays:>9.1f}x')
+            else:
+                lists, speedup = f'{"-":>13}', f'{"-":>10}'
+            cosine = 'shifted' if allow_shift else 'standard'
+            print(f'{num_peaks:>8}{cosine:>10}{lists}{time_arrays:>13.3f}'
+                  f'{speedup}')
+
+
+if __name__ == '__main__':
+    main()
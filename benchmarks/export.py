@@ -0,0 +1,89 @@
+import csv
+import io
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+import numpy as np
+import spectrum_utils.spectrum as sus
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import peak_export  # noqa: E402
+
+
+# Previous exports, which build the full output in memory (CSV twice), and the
+# peaks of the JSON export as a list of tuples of Python floats.
+def _csv_buffered(spectrum):
+    csv_str = io.StringIO()
+    writer = csv.writer(csv_str)
+    writer.writerow(['mz', 'intensity'])
+    for mz, intensity in zip(spectrum.mz, spectrum.intensity):
+        writer.writerow([mz, intensity])
+    csv_bytes = io.BytesIO()
+    csv_bytes.write(csv_str.getvalue().encode('utf-8'))
+    return csv_bytes.getvalue()
+
+
+def _json_buffered(spectrum):
+    peaks = [(float(mz), float(intensity))
+             for mz, intensity in zip(spectrum.mz, spectrum.intensity)]
+    return json.dumps({'n_peaks': len(spectrum.mz), 'peaks': peaks,
+                       'precursor_mz': spectrum.precursor_mz},
+                      separators=(',', ':'), sort_keys=True).encode()
+
+
+def _csv_streamed(spectrum):
+    return b''.join(chunk.encode() for chunk in peak_export.iter_csv(spectrum))
+
+
+def _json_streamed(spectrum):
+    return b''.join(chunk.encode() for chunk in peak_export.iter_json(
+        {'n_peaks': len(spectrum.mz),
+         'peaks': (spectrum.mz, spectrum.intensity),
+         'precursor_mz': spectrum.precursor_mz}))
+
+
+def _peak_memory(export, spectrum, streamed):
+    # Peak memory use while generating the response body; a streamed
+    # response only holds a single chunk at a time.
+    tracemalloc.start()
+    if streamed:
+        for _ in export(spectrum):
+            pass
+    else:
+        export(spectrum)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1024 ** 2
+
+
+def main():
+    rng = np.random.default_rng(42)
+    print(f'{"peaks":>8}{"format":>8}{"buffered (ms)":>15}'
+          f'{"streamed (ms)":>15}{"speedup":>10}{"buffered (MiB)":>16}'
+          f'{"streamed (MiB)":>16}')
+    for num_peaks in (100, 1000, 10000, 100000, 1000000):
+        spectrum = sus.MsmsSpectrum(
+            'benchmark', 500., 2, np.sort(rng.uniform(50, 2000, num_peaks)),
+            rng.exponential(1000, num_peaks))
+        number = max(1, 100000 // num_peaks)
+        for fmt, buffered, streamed, iter_chunks in (
+                ('csv', _csv_buffered, _csv_streamed, peak_export.iter_csv),
+                ('json', _json_buffered, _json_streamed,
+                 lambda spectrum: peak_export.iter_json(
+                     (spectrum.mz, spectrum.intensity)))):
+            assert buffered(spectrum) == streamed(spectrum)
+            time_buffered, time_streamed = (
+                timeit.timeit(lambda: export(spectrum), number=number)
+                / number * 1000 for export in (buffered, streamed))
+            print(f'{num_peaks:>8}{fmt:>8}{time_buffered:>15.2f}'
+                  f'{time_streamed:>15.2f}'
+                  f'{time_buffered / time_streamed:>9.1f}x'
+                  f'{_peak_memory(buffered, spectrum, False):>16.1f}'
+                  f'{_peak_memory(iter_chunks, spectrum, True):>16.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import os
+import sys
+import timeit
+
+import numpy as np
+import spectrum_utils.spectrum as sus
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import views  # noqa: E402
+
+
+# Previous label selection, which compares each candidate peak to all
+# previously labeled peaks in Python.
+def _generate_labels_loop(spec, intensity_threshold=None):
+    if intensity_threshold is None:
+        intensity_threshold = views.default_plotting_args['annotate_threshold']
+    mz_exclusion_window = (spec.mz[-1] - spec.mz[0]) / 20
+
+    labeled_i, order = [], np.argsort(spec.intensity)[::-1]
+    for i, mz, intensity in zip(order, spec.mz[order], spec.intensity[order]):
+        if intensity < intensity_threshold:
+            break
+        if not any(
+            abs(mz - spec.mz[already_labeled_i]) <= mz_exclusion_window
+            for already_labeled_i in labeled_i
+        ):
+            labeled_i.append(i)
+
+    return labeled_i
+
+
+def _random_spectrum(rng, num_peaks):
+    # Rounded intensities to include ties in the intensity order.
+    return sus.MsmsSpectrum(
+        'benchmark', 500., 2, np.sort(rng.uniform(50, 2000, num_peaks)),
+        np.round(rng.exponential(100, num_peaks)))
+
+
+def main():
+    rng = np.random.default_rng(42)
+    print(f'{"peaks":>8}{"threshold":>11}{"labels":>8}{"loop (ms)":>12}'
+          f'{"vectorized (ms)":>17}{"speedup":>10}')
+    for num_peaks in (10, 100, 1000, 10000, 100000, 1000000):
+        spectrum = _random_spectrum(rng, num_peaks)
+        number = max(1, 10000 // num_peaks)
+        for threshold in (0.1, 300):
+            labels = views._generate_labels(spectrum, threshold)
+            assert labels == _generate_labels_loop(spectrum, threshold)
+            time_loop, time_vectorized = (
+                timeit.timeit(lambda: generate_labels(spectrum, threshold),
+                              number=number) / number * 1000
+                for generate_labels in (_generate_labels_loop,
+                                        views._generate_labels))
+            print(f'{num_peaks:>8}{threshold:>11}{len(labels):>8}'
+                  f'{time_loop:>12.3f}{time_vectorized:>17.3f}'
+                  f'{time_loop / time_vectorized:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import base64
+import os
+import sys
+import tempfile
+import time
+import timeit
+import zlib
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import local_files  # noqa: E402
+
+
+# Writers of minimal mzML, mzXML, and MGF files with the given spectra, as
+# tuples of the scan number, precursor m/z, precursor charge, m/z array, and
+# intensity array.
+def _encode(array, dtype, compress):
+    data = np.asarray(array, dtype).tobytes()
+    return base64.b64encode(zlib.compress(data) if compress else data)
+
+
+def write_mzml(filename, spectra, indexed=True, compress=True):
+    chunks = [b'<?xml version="1.0" encoding="utf-8"?>\n']
+    if indexed:
+        chunks.append(b'<indexedmzML xmlns="http://psi.hupo.org/ms/mzml">\n')
+    chunks.append(b'<mzML xmlns="http://psi.hupo.org/ms/mzml" '
+                  b'version="1.1.0">\n<run id="run">\n'
+                  b'<spectrumList count="%d">\n' % len(spectra))
+    offsets = []
+    for i, (scan, precursor_mz, charge, mz, intensity) in enumerate(spectra):
+        native_id = f'controllerType=0 controllerNumber=1 scan={scan}'
+        offsets.append((native_id, sum(map(len, chunks))))
+        compression = (b'<cvParam cvRef="MS" accession="MS:1000574" '
+                       b'name="zlib compression"/>' if compress else
+                       b'<cvParam cvRef="MS" accession="MS:1000576" '
+                       b'name="no compression"/>')
+        chunks.append(
+            b'<spectrum index="%d" id="%s" defaultArrayLength="%d">\n'
+            b'<cvParam cvRef="MS" accession="MS:1000511" name="ms level" '
+            b'value="2"/>\n<precursorList count="1"><precursor>'
+            b'<selectedIonList count="1"><selectedIon>\n'
+            b'<cvParam cvRef="MS" accession="MS:1000744" '
+            b'name="selected ion m/z" value="%r" unitCvRef="MS" '
+            b'unitAccession="MS:1000040" unitName="m/z"/>\n'
+            b'<cvParam cvRef="MS" accession="MS:1000041" '
+            b'name="charge state" value="%d"/>\n'
+            b'</selectedIon></selectedIonList></precursor></precursorList>\n'
+            b'<binaryDataArrayList count="2">\n'
+            b'<binaryDataArray>\n<cvParam cvRef="MS" accession="MS:1000523" '
+            b'name="64-bit float"/>\n%s\n<cvParam cvRef="MS" '
+            b'accession="MS:1000514" name="m/z array"/>\n'
+            b'<binary>%s</binary>\n</binaryDataArray>\n'
+            b'<binaryDataArray>\n<cvParam cvRef="MS" accession="MS:1000521" '
+            b'name="32-bit float"/>\n%s\n<cvParam cvRef="MS" '
+            b'accession="MS:1000515" name="intensity array"/>\n'
+            b'<binary>%s</binary>\n</binaryDataArray>\n'
+            b'</binaryDataArrayList>\n</spectrum>\n' % (
+                i, native_id.encode(), len(mz), precursor_mz, charge,
+                compression, _encode(mz, '<f8', compress), compression,
+                _encode(intensity, '<f4', compress)))
+    chunks.append(b'</spectrumList>\n</run>\n</mzML>\n')
+    if indexed:
+        index_offset = sum(map(len, chunks))
+        chunks.append(b'<indexList count="1">\n<index name="spectrum">\n')
+        chunks.extend(b'<offset idRef="%s">%d</offset>\n' % (
+            native_id.encode(), offset) for native_id, offset in offsets)
+        chunks.append(b'</index>\n</indexList>\n<indexListOffset>%d'
+                      b'</indexListOffset>\n</indexedmzML>\n' % index_offset)
+    with open(filename, 'wb') as f_out:
+        f_out.write(b''.join(chunks))
+
+
+def write_mzxml(filename, spectra, compress=True):
+    chunks = [b'<?xml version="1.0" encoding="ISO-8859-1"?>\n'
+              b'<mzXML xmlns="http://sashimi.sourceforge.net/schema_revision/'
+              b'mzXML_3.2">\n<msRun scanCount="%d">\n' % len(spectra)]
+    offsets = []
+    for scan, precursor_mz, charge, mz, intensity in spectra:
+        offsets.append((scan, sum(map(len, chunks))))
+        peaks = np.column_stack((mz, intensity))
+        chunks.append(
+            b'<scan num="%d" msLevel="2" peaksCount="%d">\n'
+            b'<precursorMz precursorIntensity="0" precursorCharge="%d">%r'
+            b'</precursorMz>\n<peaks precision="64" byteOrder="network" '
+            b'contentType="m/z-int" compressionType="%s">%s</peaks>\n'
+            b'</scan>\n' % (scan, len(mz), charge, precursor_mz,
+                            b'zlib' if compress else b'none',
+                            _encode(peaks, '>f8', compress)))
+    chunks.append(b'</msRun>\n')
+    index_offset = sum(map(len, chunks))
+    chunks.append(b'<index name="scan">\n')
+    chunks.extend(b'<offset id="%d">%d</offset>\n' % entry
+                  for entry in offsets)
+    chunks.append(b'</index>\n<indexOffset>%d</indexOffset>\n</mzXML>\n'
+                  % index_offset)
+    with open(filename, 'wb') as f_out:
+        f_out.write(b''.join(chunks))
+
+
+def write_mgf(filename, spectra):
+    with open(filename, 'w') as f_out:
+        for scan, precursor_mz, charge, mz, intensity in spectra:
+            f_out.write(f'BEGIN IONS\nTITLE=scan {scan}\n'
+                        f'PEPMASS={precursor_mz!r}\nCHARGE={charge}+\n'
+                        f'SCANS={scan}\n')
+            f_out.writelines(f'{m!r} {i!r}\n'
+                             for m, i in zip(mz, intensity.tolist()))
+            f_out.write('END IONS\n')
+
+
+def random_spectra(rng, num_spectra, num_peaks):
+    return [(scan, round(float(rng.uniform(300, 1500)), 4),
+             int(rng.integers(1, 4)),
+             np.sort(rng.uniform(50, 1500, num_peaks)).round(4),
+             rng.exponential(1000, num_peaks).astype(np.float32))
+            for scan in range(1, 2 * num_spectra, 2)]
+
+
+def main():
+    rng = np.random.default_rng(42)
+    num_spectra = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    spectra = random_spectra(rng, num_spectra, 200)
+    scans = rng.choice([spectrum[0] for spectrum in spectra], 1000)
+    print(f'{num_spectra} spectra of 200 peaks')
+    print(f'{"format":<8}{"size (MB)":>11}{"index (s)":>11}'
+          f'{"load index (ms)":>17}{"read (us)":>11}')
+    with tempfile.TemporaryDirectory() as directory:
+        local_files.LOCAL_INDEX_DIR = os.path.join(directory, 'index')
+        for file_format, write in (('mzML', write_mzml),
+                                   ('mzXML', write_mzxml), ('mgf', write_mgf)):
+            filename = os.path.join(directory, f'run.{file_format}')
+            write(filename, spectra)
+            # Build the index, then load the persisted index.
+            timings = []
+            for _ in range(2):
+                start = time.perf_counter()
+                peak_file = local_files.PeakFile(filename)
+                timings.append(time.perf_counter() - start)
+            for scan in scans[:10]:
+                assert np.allclose(
+                    peak_file.get_spectrum(scan).mz,
+                    spectra[(scan - 1) // 2][3])
+            read = timeit.timeit(lambda: [peak_file.get_spectrum(scan)
+                                          for scan in scans], number=1)
+            print(f'{file_format:<8}'
+                  f'{os.path.getsize(filename) / 1e6:>11.1f}'
+                  f'{timings[0]:>11.2f}{timings[1] * 1000:>17.2f}'
+                  f'{read / len(scans) * 1e6:>11.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import json
+import os
+import sys
+import timeit
+
+import numpy as np
+import spectrum_utils.spectrum as sus
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import peak_decoding  # noqa: E402
+
+
+# Previous per-peak decoding in parsing (MassBank string splitting and
+# zip(*peaks) tuples).
+def _decode_peak_string_loop(peaks):
+    mz, intensity = [], []
+    for peak in peaks.split():
+        peak_mz, peak_intensity = peak.split(':')
+        mz.append(float(peak_mz))
+        intensity.append(float(peak_intensity))
+    return mz, intensity
+
+
+def _decode_peak_list_zip(peaks):
+    return zip(*peaks)
+
+
+def _decode_peak_json_zip(peaks):
+    return zip(*json.loads(peaks))
+
+
+def _to_spectrum(decode, peaks):
+    mz, intensity = decode(peaks)
+    return sus.MsmsSpectrum('bench', 0, 0, mz, intensity)
+
+
+def main():
+    rng = np.random.default_rng(42)
+    print(f'{"format":<8}{"peaks":>8}{"loop (ms)":>12}{"numpy (ms)":>12}'
+          f'{"speedup":>10}')
+    for num_peaks in (10, 100, 1000, 10000, 100000):
+        mz = np.sort(rng.uniform(50, 2000, num_peaks)).round(4)
+        intensity = rng.exponential(1000, num_peaks).round(2)
+        peak_list = np.column_stack((mz, intensity)).tolist()
+        peak_json = json.dumps(peak_list)
+        peak_string = ' '.join(f'{m}:{i}' for m, i in peak_list)
+        number = max(1, 100000 // num_peaks)
+        for name, peaks, loop, vectorized in (
+                ('string', peak_string, _decode_peak_string_loop,
+                 peak_decoding.decode_peak_string),
+                ('list', peak_list, _decode_peak_list_zip,
+                 peak_decoding.decode_peak_list),
+                ('json', peak_json, _decode_peak_json_zip,
+                 peak_decoding.decode_peak_json)):
+            time_loop = timeit.timeit(lambda: _to_spectrum(loop, peaks),
+                                      number=number) / number * 1000
+            time_vectorized = timeit.timeit(
+                lambda: _to_spectrum(vectorized, peaks),
+                number=number) / number * 1000
+            print(f'{name:<8}{num_peaks:>8}{time_loop:>12.3f}'
+                  f'{time_vectorized:>12.3f}'
+                  f'{time_loop / time_vectorized:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,494 @@
+import argparse
+import concurrent.futures
+import datetime
+import hashlib
+import http.server
+import itertools
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from typing import Dict, Iterable, List
+
+import numpy as np
+import requests
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, APP_DIR)
+sys.path.insert(0, os.path.join(APP_DIR, 'test'))
+import http_cache  # noqa: E402
+import parsing  # noqa: E402
+import parsing_legacy  # noqa: E402
+import upstream  # noqa: E402
+from usi_test_cases import test_usi_list  # noqa: E402
+
+# Upstream responses for all USIs in `test/usi_test_cases.py`, keyed by URL.
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'fixtures', 'upstream.json')
+
+CONCURRENCY_LEVELS = (1, 4, 16)
+
+
+def get_fixture_key(url: str) -> str:
+    # Requested URLs are (re)quoted by requests, so quote the recorded URLs
+    # identically.
+    return requests.utils.requote_uri(url)
+
+
+def load_fixtures(filename: str = FIXTURES_PATH) -> Dict:
+    with open(filename) as f_in:
+        return json.load(f_in)
+
+
+class _ReplayHandler(http.server.BaseHTTPRequestHandler):
+    # Keep-alive connections (as the upstream sessions use), with the
+    # response headers and body written in a single buffered write.
+    protocol_version = 'HTTP/1.1'
+    wbufsize = 65536
+
+    def do_GET(self):
+        # Requests are redirected as /{scheme}/{host}/{path}?{query} (see
+        # `upstream.UPSTREAM_URL_OVERRIDE`).
+        scheme, _, location = self.path.lstrip('/').partition('/')
+        fixture = self.server.responses.get(
+            get_fixture_key(f'{scheme}://{location}'))
+        if self.server.delay > 0:
+            time.sleep(self.server.delay)
+        if fixture is None:
+            status_code, content_type = 404, 'text/plain'
+            body = f'No recorded response for {scheme}://{location}'.encode()
+        else:
+            status_code = fixture['status_code']
+            content_type = fixture['content_type']
+            body = fixture['body'].encode()
+        self.send_response(status_code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_replay_server(responses: Dict[str, Dict], delay: float = 0.) \
+        -> http.server.ThreadingHTTPServer:
+    """
+    Start a local stand-in for the upstream repositories that replays
+    recorded responses, in a background thread.
+
+    Parameters
+    ----------
+    responses : Dict[str, Dict]
+        The recorded responses (with `status_code`, `content_type`, and
+        `body`) by URL.
+    delay : float
+        Simulated upstream latency (in seconds) per request.
+
+    Returns
+    -------
+    http.server.ThreadingHTTPServer
+        The running server, with its base URL as `url`, which should be
+        configured as `upstream.UPSTREAM_URL_OVERRIDE`.
+    """
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                             _ReplayHandler)
+    server.daemon_threads = True
+    server.responses = {get_fixture_key(url): response
+                        for url, response in responses.items()}
+    server.delay = delay
+    server.url = f'http://127.0.0.1:{server.server_port}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _disable_http_cache() -> None:
+    # Send every upstream request to the (replay) server.
+    http_cache._cache, http_cache._cache_initialized = None, True
+
+
+def _capture_responses(usis: Iterable[str], get) -> Dict[str, Dict]:
+    # Resolve the USIs without any caching, with `get` instead of
+    # `upstream.get`, and collect the upstream responses.
+    responses = {}
+
+    def capturing_get(url, **kwargs):
+        if 'params' in kwargs:
+            url = requests.Request('GET', url, params=kwargs['params']) \
+                .prepare().url
+        response = get(url, **kwargs)
+        responses[get_fixture_key(url)] = {
+            'status_code': response.status_code,
+            'content_type': response.headers.get('Content-Type',
+                                                 'application/octet-stream'),
+            'body': response.text}
+        return response
+
+    _disable_http_cache()
+    upstream_get, upstream.get = upstream.get, capturing_get
+    try:
+        for usi in usis:
+            try:
+                parsing._parse_usi(usi)
+                print(f'Resolved {usi}', file=sys.stderr)
+            except Exception as e:
+                print(f'Unable to resolve {usi}: {e!r}', file=sys.stderr)
+    finally:
+        upstream.get = upstream_get
+    return responses
+
+
+def _synthesize_response(url: str, **kwargs) -> requests.Response:
+    # Fabricate a response in the format of each upstream repository, with a
+    # random (but reproducible per URL) spectrum.
+    split_url = urllib.parse.urlsplit(url)
+    query = dict(urllib.parse.parse_qsl(split_url.query))
+    rng = np.random.default_rng(
+        int(hashlib.sha1(url.encode()).hexdigest()[:8], 16))
+    precursor_mz = round(float(rng.uniform(200, 1000)), 4)
+    num_peaks = int(rng.integers(20, 500))
+    peaks = [[round(float(mz), 4), round(float(intensity), 1)]
+             for mz, intensity in zip(
+                 np.sort(rng.uniform(50, precursor_mz, num_peaks)),
+                 rng.exponential(1000, num_peaks))]
+    path = split_url.path
+    if path.endswith('/DownloadResultFile'):
+        body = {'peaks': peaks,
+                'precursor': {'mz': precursor_mz, 'charge': 1}}
+    elif path.endswith('/SpectrumCommentServlet'):
+        body = {'spectruminfo': {'peaks_json': json.dumps(peaks)},
+                'annotations': [{'Precursor_MZ': str(precursor_mz),
+                                 'Charge': '1'}]}
+    elif path.endswith('/QuerySpectrum'):
+        _, dataset, ms_run = query['id'].split(':')[:3]
+        body = {'row_data': [{'file_descriptor':
+                              f'f.{dataset}/peak/{ms_run}.mzML'}]}
+    elif split_url.hostname == 'massbank.us':
+        body = {'spectrum': ' '.join(f'{mz}:{intensity}'
+                                     for mz, intensity in peaks),
+                'metaData': [{'name': 'precursor m/z',
+                              'value': precursor_mz}]}
+    elif '/get_doc/' in path:
+        body = {'peaks': peaks, 'precursor_mz': precursor_mz}
+    elif '/get_motif/' in path:
+        body = peaks
+    else:
+        body = None
+    response = requests.Response()
+    response.url = url
+    if body is None:
+        response.status_code = 404
+        response.headers['Content-Type'] = 'text/plain'
+        response._content = b'Not found'
+    else:
+        response.status_code = 200
+        response.headers['Content-Type'] = 'application/json'
+        response._content = json.dumps(body).encode()
+    response.encoding = 'utf-8'
+    return response
+
+
+def _save_fixtures(filename: str, responses: Dict[str, Dict],
+                   synthetic: bool) -> None:
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    if synthetic:
+        description = ('SYNTHETIC responses in the format of each upstream '
+                       'repository with random spectra, generated by '
+                       '`replay.py synthesize` for offline benchmarks. '
+                       'Re-record with `replay.py record` for realistic '
+                       'spectra.')
+    else:
+        description = (f'Upstream responses recorded by `replay.py record` '
+                       f'on {datetime.date.today().isoformat()}.')
+    with open(filename, 'w') as f_out:
+        json.dump({'synthetic': synthetic, 'description': description,
+                   'responses': responses}, f_out, indent=1, sort_keys=True)
+        f_out.write('\n')
+    print(f'Stored {len(responses)} responses in {filename}',
+          file=sys.stderr)
+
+
+def _summarize(latencies: List[float]) -> Dict[str, float]:
+    # Latency statistics in milliseconds.
+    latencies = np.asarray(latencies) * 1000
+    return {'n': len(latencies),
+            'mean_ms': float(np.mean(latencies)),
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p95_ms': float(np.percentile(latencies, 95)),
+            'p99_ms': float(np.percentile(latencies, 99)),
+            'min_ms': float(np.min(latencies)),
+            'max_ms': float(np.max(latencies))}
+
+
+def _time(function, *args, repeat: int = 1, **kwargs) -> List[float]:
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def _resolve(usi: str) -> None:
+    # Resolve the USI upstream, also if it was resolved before.
+    parsing_legacy.parse_usi_legacy.cache_clear()
+    parsing._parse_usi(usi)
+
+
+def _run_stages(usis: List[str], repeat: int) -> Dict[str, Dict]:
+    # Latency of the processing stages in this process, without the caches.
+    import flask
+    import similarity
+    import spectrum_view
+    import views
+    import warmup
+    from app import app
+    warmup.warm_up()
+    latencies, spectra = {}, []
+    for usi in usis:
+        stage = f'resolve/{parsing._get_collection(usi)}'
+        latencies.setdefault(stage, []).extend(
+            _time(_resolve, usi, repeat=repeat))
+        spectra.append(parsing.parse_usi(usi)[0])
+    # Compile the similarity kernels for the resolved spectra first.
+    for cosine in ('standard', 'shifted'):
+        similarity.cosine(spectra[0], spectra[-1], 0.02, cosine == 'shifted')
+    for spectrum1, spectrum2 in itertools.combinations(spectra, 2):
+        for cosine in ('standard', 'shifted'):
+            latencies.setdefault(f'cosine/{cosine}', []).extend(_time(
+                similarity.cosine, spectrum1, spectrum2, 0.02,
+                cosine == 'shifted', repeat=repeat))
+    for spectrum in spectra:
+        latencies.setdefault('labels', []).extend(_time(
+            views._generate_labels, spectrum_view.SpectrumView(spectrum),
+            repeat=repeat))
+    for (usi1, usi2), extension in itertools.product(
+            zip(usis, usis[1:] + usis[:1]), ('png', 'svg')):
+        with app.test_request_context():
+            plotting_args = views._get_plotting_args(flask.request)
+            mirror_args = views._get_plotting_args(flask.request, True)
+        latencies.setdefault(f'render/{extension}', []).extend(_time(
+            views._generate_figure, usi1, extension, **plotting_args))
+        latencies.setdefault(f'render/mirror_{extension}', []).extend(_time(
+            views._generate_mirror_figure, usi1, usi2, extension,
+            **mirror_args))
+    return {stage: _summarize(stage_latencies)
+            for stage, stage_latencies in latencies.items()}
+
+
+def _get_routes(usis: List[str]) -> Dict[str, List[str]]:
+    quoted = [urllib.parse.quote(usi, safe='') for usi in usis]
+    pairs = list(zip(quoted, quoted[1:] + quoted[:1]))
+    routes = {route: [f'{route}?usi={usi}' for usi in quoted]
+              for route in ('/spectrum/', '/png/', '/svg/', '/json/', '/csv/',
+                            '/npy/', '/api/proxi/v0.1/spectra', '/qrcode/',
+                            '/json/search/')}
+    routes.update({route: [f'{route}?usi1={usi1}&usi2={usi2}'
+                           for usi1, usi2 in pairs]
+                   for route in ('/mirror/', '/png/mirror/',
+                                 '/svg/mirror/')})
+    routes['/json/similarity/'] = [
+        '/json/similarity/?' + '&'.join(f'usi={usi}' for usi in quoted)]
+    return routes
+
+
+def _run_route(server_url: str, paths: List[str], concurrency: int,
+               num_requests: int) -> Dict:
+    local = threading.local()
+    urls = [f'{server_url}{path}' for path in paths]
+
+    def request(i):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        start = time.perf_counter()
+        try:
+            response = session.get(urls[i % len(urls)], timeout=300)
+            ok = response.status_code == 200
+        except requests.exceptions.RequestException:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(request, range(num_requests)))
+    duration = time.perf_counter() - start
+    return {'concurrency': concurrency,
+            'requests': num_requests,
+            'errors': sum(not ok for _, ok in results),
+            'throughput_rps': num_requests / duration,
+            'latency': _summarize([latency for latency, _ in results])}
+
+
+def _start_server(replay_url: str, workers: int, cache_dir: str) \
+        -> subprocess.Popen:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    # The spectra and figures are shared between the workers as in the
+    # docker-compose deployment, but all upstream requests are replayed. The
+    # similarity search is enabled to benchmark `/json/search/`, and the
+    # metrics aren't stored.
+    env = {**os.environ, 'UPSTREAM_URL_OVERRIDE': replay_url,
+           'HTTP_CACHE_BACKEND': '', 'SPECTRUM_INDEX_MAX_SPECTRA': '10000',
+           'SPECTRUM_CACHE_BACKEND': 'disk',
+           'SPECTRUM_CACHE_DIR': os.path.join(cache_dir, 'spectrum_cache'),
+           'RENDER_CACHE_DIR': os.path.join(cache_dir, 'render_cache')}
+    env.pop('PROMETHEUS_MULTIPROC_DIR', None)
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+         '-w', str(workers), '-b', f'127.0.0.1:{port}', '--timeout', '600',
+         'main:app'], cwd=APP_DIR, env=env)
+    process.url = f'http://127.0.0.1:{port}'
+    # Wait until the workers are warmed up.
+    deadline = time.monotonic() + 600
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f'{process.url}/heartbeat').ok:
+                return process
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError('The server did not start')
+
+
+def _get_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=APP_DIR,
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def run(fixtures: Dict, args: argparse.Namespace) -> Dict:
+    replay_server = start_replay_server(fixtures['responses'],
+                                        args.upstream_delay)
+    upstream.UPSTREAM_URL_OVERRIDE = replay_server.url
+    _disable_http_cache()
+    results = {
+        'metadata': {
+            'synthetic_fixtures': fixtures['synthetic'],
+            'fixtures': args.fixtures,
+            'commit': _get_commit(),
+            'timestamp': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'upstream_delay': args.upstream_delay,
+            'workers': args.workers,
+            'concurrency_levels': args.concurrency,
+            'repeat': args.repeat,
+            'requests': args.requests},
+        'stages': {},
+        'routes': {}}
+    if fixtures['synthetic']:
+        print('Using SYNTHETIC upstream fixtures', file=sys.stderr)
+    usis = []
+    for usi in test_usi_list:
+        try:
+            parsing._parse_usi(usi)
+            usis.append(usi)
+        except ValueError as e:
+            print(f'Skipping {usi}: {e}', file=sys.stderr)
+    results['stages'] = _run_stages(usis, args.repeat)
+    _print_stages(results['stages'])
+    if args.no_routes:
+        return results
+    cache_dir = tempfile.TemporaryDirectory()
+    server = _start_server(replay_server.url, args.workers, cache_dir.name)
+    try:
+        for route, paths in _get_routes(usis).items():
+            # Measure the steady state, after each path is resolved and
+            # rendered once.
+            _run_route(server.url, paths, 1, len(paths))
+            results['routes'][route] = [
+                _run_route(server.url, paths, concurrency, args.requests)
+                for concurrency in args.concurrency]
+            _print_route(route, results['routes'][route])
+    finally:
+        server.terminate()
+        server.wait(60)
+        replay_server.shutdown()
+        cache_dir.cleanup()
+    return results
+
+
+def _print_stages(stages: Dict[str, Dict]) -> None:
+    print(f'{"stage":<24}{"n":>6}{"mean (ms)":>12}{"p50 (ms)":>11}'
+          f'{"p95 (ms)":>11}', file=sys.stderr)
+    for stage, summary in stages.items():
+        print(f'{stage:<24}{summary["n"]:>6}{summary["mean_ms"]:>12.2f}'
+              f'{summary["p50_ms"]:>11.2f}{summary["p95_ms"]:>11.2f}',
+              file=sys.stderr)
+
+
+def _print_route(route: str, results: List[Dict]) -> None:
+    for result in results:
+        print(f'{route:<26}c={result["concurrency"]:<4}'
+              f'{result["throughput_rps"]:>9.1f} req/s'
+              f'{result["latency"]["p50_ms"]:>10.1f} ms p50'
+              f'{result["latency"]["p95_ms"]:>10.1f} ms p95'
+              f'{result["errors"]:>5} errors', file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the USI server offline, with upstream '
+                    'responses replayed from recorded fixtures by a local '
+                    'stand-in server.')
+    parser.add_argument(
+        'mode', nargs='?', default='run',
+        choices=('run', 'record', 'synthesize'),
+        help='run the benchmarks (default), record the fixtures from the '
+             'live upstream repositories, or generate synthetic fixtures')
+    parser.add_argument('--fixtures', default=FIXTURES_PATH,
+                        help='fixtures file (default: %(default)s)')
+    parser.add_argument('--output',
+                        help='JSON results file (default: stdout)')
+    parser.add_argument(
+        '--concurrency', type=lambda levels: [int(level) for level in
+                                              levels.split(',')],
+        default=list(CONCURRENCY_LEVELS),
+        help='comma-separated numbers of concurrent clients per route')
+    parser.add_argument('--requests', type=int, default=50,
+                        help='requests per route and concurrency level')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='repetitions of the resolve and cosine stages')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='gunicorn worker processes')
+    parser.add_argument('--upstream-delay', type=float, default=0.,
+                        help='simulated upstream latency (in seconds)')
+    parser.add_argument('--no-routes', action='store_true',
+                        help="don't benchmark the HTTP routes")
+    parser.add_argument('--check', action='store_true',
+                        help='exit with an error if any request failed')
+    args = parser.parse_args()
+
+    if args.mode == 'record':
+        _save_fixtures(args.fixtures,
+                       _capture_responses(test_usi_list, upstream.get), False)
+    elif args.mode == 'synthesize':
+        _save_fixtures(args.fixtures, _capture_responses(
+            test_usi_list, _synthesize_response), True)
+    else:
+        results = run(load_fixtures(args.fixtures), args)
+        if args.output:
+            with open(args.output, 'w') as f_out:
+                json.dump(results, f_out, indent=1)
+        else:
+            print(json.dumps(results, indent=1))
+        if args.check and any(result['errors'] for route_results
+                              in results['routes'].values()
+                              for result in route_results):
+            sys.exit('Some requests failed')
+
+
+if __name__ == '__main__':
+    main()
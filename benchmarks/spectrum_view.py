@@ -0,0 +1,63 @@
+import copy
+import os
+import sys
+import tracemalloc
+
+import numpy as np
+import spectrum_utils.spectrum as sus
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import spectrum_view  # noqa: E402
+
+
+# Previous spectrum preparation in views (deepcopy of the cached spectrum).
+def _prepare_deepcopy(spectrum, annotate_mz, mz_min, mz_max):
+    spectrum = copy.deepcopy(spectrum)
+    spectrum.scale_intensity(max_intensity=1)
+    for mz in annotate_mz:
+        spectrum.annotate_mz_fragment(mz, 0, 0.02, 'Da', text=f'{mz:.4f}')
+    spectrum.set_mz_range(mz_min, mz_max)
+    spectrum.scale_intensity(max_intensity=1)
+    return spectrum
+
+
+def _prepare_view(spectrum, annotate_mz, mz_min, mz_max):
+    spectrum = spectrum_view.SpectrumView(spectrum)
+    for mz in annotate_mz:
+        spectrum.annotate_mz_fragment(mz, 0.02, text=f'{mz:.4f}')
+    return spectrum.set_mz_range(mz_min, mz_max).to_spectrum()
+
+
+def _peak_memory(prepare, *args):
+    tracemalloc.start()
+    prepare(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    rng = np.random.default_rng(42)
+    print(f'{"peaks":>8}{"m/z range":>12}{"deepcopy (KiB)":>16}'
+          f'{"view (KiB)":>12}{"reduction":>11}')
+    for num_peaks in (1000, 10000, 100000, 1000000):
+        mz = np.sort(rng.uniform(50, 2000, num_peaks))
+        spectrum = spectrum_view.freeze(sus.MsmsSpectrum(
+            'bench', 500, 2, mz, rng.exponential(1000, num_peaks)))
+        annotate_mz = mz[rng.integers(0, num_peaks, 20)] + 0.01
+        # Warm up the JIT-compiled spectrum_utils functions.
+        _prepare_deepcopy(spectrum, annotate_mz, 500, 600)
+        _prepare_view(spectrum, annotate_mz, 500, 600)
+        for mz_min, mz_max in ((None, None), (500, 1000), (500, 600)):
+            args = spectrum, annotate_mz, mz_min, mz_max
+            memory_deepcopy = _peak_memory(_prepare_deepcopy, *args) / 1024
+            memory_view = _peak_memory(_prepare_view, *args) / 1024
+            mz_range = (f'{mz_min}-{mz_max}' if mz_min is not None
+                        else 'all')
+            print(f'{num_peaks:>8}{mz_range:>12}{memory_deepcopy:>16.1f}'
+                  f'{memory_view:>12.1f}'
+                  f'{memory_deepcopy / memory_view:>10.1f}x')
+
+
+if __name__ == '__main__':
+    main()
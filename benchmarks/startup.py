@@ -0,0 +1,72 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Time until a worker is ready to serve requests, when it imports the app
+# itself or when it's forked from a master process that preloaded the app.
+_WORKER_SCRIPT = '''
+import json, os, time
+start = time.perf_counter()
+import main
+import warmup
+imported = time.perf_counter()
+if {preload}:
+    warmup.warm_up(worker=False)
+    preloaded = time.perf_counter()
+    read, write = os.pipe()
+    if os.fork() == 0:
+        start = time.perf_counter()
+        warmup.warm_up()
+        os.write(write, str(time.perf_counter() - start).encode())
+        os._exit(0)
+    os.wait()
+    ready = float(os.read(read, 100))
+    print(json.dumps({{'import': imported - start,
+                      'master warm-up': preloaded - imported,
+                      'worker ready': ready}}))
+else:
+    warmup.warm_up()
+    print(json.dumps({{'import': imported - start,
+                      'worker ready': time.perf_counter() - start}}))
+'''
+
+
+def _run(args):
+    result = subprocess.run([sys.executable, *args], cwd=APP_DIR,
+                            capture_output=True, text=True, check=True)
+    return result
+
+
+def _profile_imports(num_modules=10):
+    # Cumulative import time of the slowest modules imported by the app.
+    stderr = _run(['-X', 'importtime', '-c', 'import main']).stderr
+    modules = []
+    for line in stderr.splitlines()[1:]:
+        _, cumulative, module = line.split('|')
+        modules.append((int(cumulative) / 1e6, module.strip()))
+    modules = [module for module in modules
+               if not module[1].startswith(('encodings', '_'))]
+    return sorted(modules, reverse=True)[:num_modules]
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    print('Slowest imports (cumulative):')
+    for cumulative, module in _profile_imports():
+        print(f'{cumulative:>8.2f} s  {module}')
+    print()
+    print(f'{"mode":<10}{"stage":<16}{"median (s)":>12}')
+    for mode, preload in (('fresh', False), ('preload', True)):
+        timings = [json.loads(_run(['-c', _WORKER_SCRIPT.format(
+            preload=preload)]).stdout) for _ in range(repeat)]
+        for stage in timings[0]:
+            median = statistics.median(timing[stage] for timing in timings)
+            print(f'{mode:<10}{stage:<16}{median:>12.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import concurrent.futures
+import os
+import threading
+from typing import Callable, Dict, Hashable, TypeVar
+
+T = TypeVar('T')
+
+# Number of OS threads that run CPU-bound work (rendering) when requests are
+# served from cooperative gevent workers. CPU-bound work holds the GIL, so a
+# single thread is used by default; use RENDER_PROCESSES to render figures in
+# parallel.
+CPU_THREADS = int(os.environ.get('CPU_THREADS', 1))
+
+_threadpool = None
+_threadpool_lock = threading.Lock()
+
+
+def is_cooperative() -> bool:
+    """
+    Check whether the server runs in cooperative (gevent) mode.
+
+    Returns
+    -------
+    bool
+        True if the standard library has been monkey-patched by gevent (i.e.
+        when running in gunicorn's gevent workers), False otherwise.
+    """
+    try:
+        import gevent.monkey
+    except ImportError:
+        return False
+    return gevent.monkey.is_module_patched('socket')
+
+
+def run_cpu_bound(function: Callable[..., T], *args, **kwargs) -> T:
+    """
+    Run a CPU-bound function without blocking other requests.
+
+    In cooperative mode the function is executed in a native thread so that
+    the worker's event loop keeps serving other requests (e.g. waiting on
+    upstream lookups) in the meantime. Otherwise the function is simply
+    called.
+
+    The function shouldn't perform any network I/O.
+    """
+    if not is_cooperative():
+        return function(*args, **kwargs)
+    return _get_threadpool().apply(function, args, kwargs)
+
+
+def _get_threadpool():
+    global _threadpool
+    if _threadpool is None:
+        with _threadpool_lock:
+            if _threadpool is None:
+                import gevent.threadpool
+                _threadpool = gevent.threadpool.ThreadPool(CPU_THREADS)
+    return _threadpool
+
+
+class SingleFlight:
+    """
+    Deduplicate concurrent calls with the same key: the first caller executes
+    the function while the others wait for its result (or exception).
+    """
+
+    def __init__(self) -> None:
+        self._calls: Dict[Hashable, concurrent.futures.Future] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, function: Callable[..., T], *args,
+           **kwargs) -> T:
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = concurrent.futures.Future()
+        if not leader:
+            return future.result()
+        try:
+            result = function(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
@@ -0,0 +1,167 @@
+import csv
+import logging
+import os
+import sys
+from typing import Iterable, Optional, Tuple
+
+from http_cache import SQLiteStore
+from spectrum_cache import LocalRedis
+
+
+logger = logging.getLogger(__name__)
+
+# Backend of the index of the MassIVE files that contain the spectra of each
+# (dataset, MS run): 'memory' (per worker process), 'sqlite' (a database file
+# that is shared between the worker processes and persists across restarts),
+# 'redis', or '' to disable the index.
+FILE_INDEX_BACKEND = os.environ.get('FILE_INDEX_BACKEND', 'memory')
+FILE_INDEX_PATH = os.environ.get('FILE_INDEX_PATH',
+                                 '/output/file_index.sqlite')
+FILE_INDEX_REDIS_URL = os.environ.get('FILE_INDEX_REDIS_URL',
+                                      'redis://localhost:6379/0')
+FILE_INDEX_MAX_BYTES = int(os.environ.get('FILE_INDEX_MAX_BYTES',
+                                          64 * 1024 ** 2))
+
+# Extensions of the dataset files from which spectra can be retrieved.
+PEAK_FILE_EXTENSIONS = ('mzml', 'mzxml', 'mgf')
+
+
+class FileIndex:
+    """
+    Mapping of (dataset, MS run) to the descriptor of the dataset file that
+    contains the MS run's spectra, in a Redis-compatible key-value store.
+    """
+
+    key_prefix = 'file:'
+
+    def __init__(self, client) -> None:
+        self.client = client
+
+    def get(self, dataset: str, ms_run: str) -> Optional[str]:
+        """
+        Get the file that contains the spectra of an MS run.
+
+        Parameters
+        ----------
+        dataset : str
+            The dataset identifier (e.g. MSV000079514).
+        ms_run : str
+            The MS run name.
+
+        Returns
+        -------
+        Optional[str]
+            The MassIVE file descriptor, or None if it isn't known.
+        """
+        try:
+            value = self.client.get(self._get_key(dataset, ms_run))
+        except Exception as e:
+            logger.warning('Unable to retrieve file of %s:%s: %s', dataset,
+                           ms_run, e)
+            value = None
+        return value.decode() if value is not None else None
+
+    def put(self, dataset: str, ms_run: str, file_descriptor: str) -> None:
+        """
+        Store the file that contains the spectra of an MS run.
+
+        Parameters
+        ----------
+        dataset : str
+            The dataset identifier (e.g. MSV000079514).
+        ms_run : str
+            The MS run name.
+        file_descriptor : str
+            The MassIVE file descriptor.
+        """
+        try:
+            self.client.set(self._get_key(dataset, ms_run),
+                            file_descriptor.encode())
+        except Exception as e:
+            logger.warning('Unable to store file of %s:%s: %s', dataset,
+                           ms_run, e)
+
+    def seed(self, files: Iterable[Tuple[str, str]]) -> int:
+        """
+        Store the files of datasets in bulk, with the MS run names derived
+        from the file names.
+
+        Parameters
+        ----------
+        files : Iterable[Tuple[str, str]]
+            Tuples of the dataset identifier and MassIVE file descriptor.
+            Files that don't contain spectra are skipped.
+
+        Returns
+        -------
+        int
+            The number of stored files.
+        """
+        num_stored = 0
+        for dataset, file_descriptor in files:
+            if is_peak_file(file_descriptor):
+                self.put(dataset, get_ms_run(file_descriptor),
+                         file_descriptor)
+                num_stored += 1
+        return num_stored
+
+    def _get_key(self, dataset: str, ms_run: str) -> str:
+        # Dataset identifiers are case-insensitive, file names are not.
+        return f'{self.key_prefix}{dataset.upper()}:{ms_run}'
+
+
+def is_peak_file(file_descriptor: str) -> bool:
+    return file_descriptor.lower().endswith(PEAK_FILE_EXTENSIONS)
+
+
+def get_ms_run(file_descriptor: str) -> str:
+    # E.g. f.MSV000079514/ccms_peak/RAW/Adult_Frontalcortex_f09.mzML.
+    return os.path.splitext(file_descriptor.rsplit('/', 1)[-1])[0]
+
+
+_index = None
+_index_initialized = False
+
+
+def get_index() -> Optional[FileIndex]:
+    """
+    Get the configured file index.
+
+    Returns
+    -------
+    Optional[FileIndex]
+        The file index configured by the FILE_INDEX_BACKEND environment
+        variable, or None if it's disabled.
+    """
+    global _index, _index_initialized
+    if not _index_initialized:
+        _index = _create_index(FILE_INDEX_BACKEND.lower())
+        _index_initialized = True
+    return _index
+
+
+def _create_index(backend: str) -> Optional[FileIndex]:
+    if backend == 'memory':
+        return FileIndex(LocalRedis(FILE_INDEX_MAX_BYTES))
+    elif backend == 'sqlite':
+        return FileIndex(SQLiteStore(FILE_INDEX_PATH, FILE_INDEX_MAX_BYTES))
+    elif backend == 'redis':
+        import redis
+        return FileIndex(redis.Redis.from_url(FILE_INDEX_REDIS_URL))
+    elif not backend:
+        return None
+    else:
+        raise ValueError(f'Unknown file index backend: {backend}')
+
+
+if __name__ == '__main__':
+    # Seed the (sqlite or redis) file index from a tab-separated file with
+    # the dataset identifier and MassIVE file descriptor per line.
+    if len(sys.argv) != 2 or get_index() is None:
+        sys.exit(f'Usage: FILE_INDEX_BACKEND=sqlite|redis python '
+                 f'{sys.argv[0]} FILES.tsv')
+    with open(sys.argv[1], newline='') as f_in:
+        num_stored = get_index().seed(
+            row[:2] for row in csv.reader(f_in, delimiter='\t')
+            if len(row) >= 2)
+    print(f'Stored {num_stored} files')
@@ -0,0 +1,41 @@
+import os
+import time
+
+# Import the app and warm it up once in the master process, so that the forked
+# workers share the loaded modules and compiled functions (copy-on-write) and
+# (re)start without importing and compiling them again.
+preload_app = os.environ.get('PRELOAD_APP', 'true').lower() == 'true'
+
+if preload_app and os.environ.get('SERVER_MODE') == 'async':
+    # Locks that are created while preloading the app should cooperate with
+    # the gevent workers.
+    from gevent import monkey
+    monkey.patch_all()
+
+
+def when_ready(server):
+    if preload_app:
+        import warmup
+        start = time.perf_counter()
+        warmup.warm_up(worker=False)
+        server.log.info('Warmed up in %.1f s', time.perf_counter() - start)
+
+
+def post_worker_init(worker):
+    # Compile the JIT functions and initialize the renderers before the
+    # worker accepts requests, instead of during the first requests after
+    # each (recycled) worker starts.
+    import warmup
+    start = time.perf_counter()
+    warmup.warm_up()
+    worker.log.info('Warmed up in %.1f s', time.perf_counter() - start)
+
+
+def on_starting(server):
+    import metrics
+    metrics.clear_directory()
+
+
+def child_exit(server, worker):
+    import metrics
+    metrics.mark_process_dead(worker.pid)
@@ -0,0 +1,302 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+from typing import Dict, Optional
+
+import requests
+import requests.structures
+
+import metrics
+from spectrum_cache import LocalRedis
+
+
+logger = logging.getLogger(__name__)
+
+# Backend of the upstream HTTP response cache: 'memory' (per worker process),
+# 'sqlite' (a database file shared between the worker processes), 'redis', or
+# '' (default) to disable caching upstream responses.
+HTTP_CACHE_BACKEND = os.environ.get('HTTP_CACHE_BACKEND', '')
+HTTP_CACHE_PATH = os.environ.get('HTTP_CACHE_PATH',
+                                 '/output/http_cache.sqlite')
+HTTP_CACHE_REDIS_URL = os.environ.get('HTTP_CACHE_REDIS_URL',
+                                      'redis://localhost:6379/0')
+HTTP_CACHE_MAX_BYTES = int(os.environ.get('HTTP_CACHE_MAX_BYTES',
+                                          256 * 1024 ** 2))
+
+# Time (in seconds) after which the cached responses expire per upstream host,
+# or 0 to not cache the host's responses.
+# Can be overridden as a comma-separated list of host=seconds pairs in the
+# HTTP_CACHE_EXPIRE_AFTER environment variable.
+HTTP_CACHE_DEFAULT_EXPIRE_AFTER = int(
+    os.environ.get('HTTP_CACHE_DEFAULT_EXPIRE_AFTER', 300))
+default_expire_after = {
+    # GNPS task results can be updated, whereas the repository records are
+    # stable.
+    'gnps.ucsd.edu': 300,
+    'massive.ucsd.edu': 60 * 60,
+    'massbank.us': 60 * 60,
+    'ms2lda.org': 60 * 60,
+}
+for _expire_after in filter(
+        None, os.environ.get('HTTP_CACHE_EXPIRE_AFTER', '').split(',')):
+    _host, _seconds = _expire_after.split('=')
+    default_expire_after[_host.strip().lower()] = int(_seconds)
+
+# Maximum time (in seconds) that a worker waits for the SQLite database when
+# it's locked by another worker.
+HTTP_CACHE_SQLITE_TIMEOUT = 5
+# Minimum interval (in seconds) between updates of the access time of a SQLite
+# entry when it's read, to limit the writes by frequently read entries.
+HTTP_CACHE_SQLITE_TOUCH_INTERVAL = 60
+
+
+class HttpCache:
+    """
+    Cache of successful upstream responses in a Redis-compatible key-value
+    store, with an expiration time per upstream host.
+    """
+
+    key_prefix = 'http:response:'
+
+    def __init__(self, client,
+                 expire_after: Optional[Dict[str, int]] = None) -> None:
+        self.client = client
+        self.expire_after = (expire_after if expire_after is not None
+                             else default_expire_after)
+        self.stats = collections.Counter()
+        self._stats_lock = threading.Lock()
+
+    def get(self, url: str) -> Optional[requests.Response]:
+        """
+        Get the cached response for a URL.
+
+        Parameters
+        ----------
+        url : str
+            The requested URL.
+
+        Returns
+        -------
+        Optional[requests.Response]
+            The cached response (with `from_cache` set to True), or None if
+            the URL isn't cached or its cached response expired.
+        """
+        if self._get_expire_after(url) <= 0:
+            return None
+        try:
+            value = self.client.get(f'{self.key_prefix}{_get_key(url)}')
+        except Exception as e:
+            logger.warning('Unable to retrieve cached response %s: %s',
+                           url, e)
+            value = None
+        self._count('hits' if value is not None else 'misses')
+        metrics.cache_requests.inc(
+            cache='http', result='hit' if value is not None else 'miss')
+        return _to_response(value) if value is not None else None
+
+    def put(self, url: str, response: requests.Response) -> None:
+        """
+        Cache a response if it was successful.
+
+        Parameters
+        ----------
+        url : str
+            The requested URL.
+        response : requests.Response
+            The upstream response.
+        """
+        seconds = self._get_expire_after(url)
+        if seconds <= 0 or response.status_code != 200:
+            return
+        try:
+            self.client.set(f'{self.key_prefix}{_get_key(url)}',
+                            _from_response(response), ex=seconds)
+            self._count('stores')
+        except Exception as e:
+            logger.warning('Unable to cache response %s: %s', url, e)
+
+    def _get_expire_after(self, url: str) -> int:
+        host = urllib.parse.urlsplit(url).hostname
+        return self.expire_after.get(host, HTTP_CACHE_DEFAULT_EXPIRE_AFTER)
+
+    def _count(self, stat: str) -> None:
+        with self._stats_lock:
+            self.stats[stat] += 1
+
+
+def _get_key(url: str) -> str:
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+def _from_response(response: requests.Response) -> bytes:
+    metadata = json.dumps({'status_code': response.status_code,
+                           'reason': response.reason,
+                           'url': response.url,
+                           'encoding': response.encoding,
+                           'headers': dict(response.headers)}).encode()
+    return len(metadata).to_bytes(4, 'little') + metadata + response.content
+
+
+def _to_response(value: bytes) -> requests.Response:
+    metadata_len = int.from_bytes(value[:4], 'little')
+    metadata = json.loads(value[4:4 + metadata_len])
+    response = requests.Response()
+    response.status_code = metadata['status_code']
+    response.reason = metadata['reason']
+    response.url = metadata['url']
+    response.encoding = metadata['encoding']
+    response.headers = requests.structures.CaseInsensitiveDict(
+        metadata['headers'])
+    response._content = value[4 + metadata_len:]
+    response.from_cache = True
+    return response
+
+
+class SQLiteStore:
+    """
+    Key-value store in a SQLite database that is shared between the worker
+    processes, with the subset of the Redis client API used by `HttpCache`.
+
+    The database is used in WAL mode so that reads don't block on concurrent
+    writes by other workers. Once the stored values exceed `max_bytes` the
+    least recently used entries are evicted first, for which reads update the
+    access time of an entry at most once per
+    `HTTP_CACHE_SQLITE_TOUCH_INTERVAL`. The total size of the values is
+    maintained by triggers in a single-row table, so that writes don't need to
+    sum the sizes of all entries.
+    """
+
+    def __init__(self, filename: str, max_bytes: int) -> None:
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        directory = os.path.dirname(self.filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        # The values are stored last so that the other columns can be read
+        # without loading them.
+        conn.executescript(
+            'BEGIN IMMEDIATE;'
+            'CREATE TABLE IF NOT EXISTS entries '
+            '(key TEXT PRIMARY KEY, size INTEGER, accessed REAL, '
+            'expires REAL, value BLOB);'
+            'CREATE INDEX IF NOT EXISTS entries_accessed '
+            'ON entries (accessed, size);'
+            'CREATE TABLE IF NOT EXISTS total '
+            '(id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER);'
+            'INSERT OR IGNORE INTO total '
+            'SELECT 0, COALESCE(SUM(size), 0) FROM entries;'
+            'CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON '
+            'entries BEGIN UPDATE total SET bytes = bytes + NEW.size; END;'
+            'CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON '
+            'entries BEGIN UPDATE total SET bytes = bytes - OLD.size; END;'
+            'COMMIT;')
+
+    def _connect(self) -> sqlite3.Connection:
+        # One connection per thread, which isn't shared with forked workers.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._local.conn = sqlite3.connect(
+                self.filename, timeout=HTTP_CACHE_SQLITE_TIMEOUT)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            # Replaced entries fire the delete trigger.
+            conn.execute('PRAGMA recursive_triggers=ON')
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key: str) -> Optional[bytes]:
+        now, conn = time.time(), self._connect()
+        row = conn.execute(
+            'SELECT accessed, value FROM entries '
+            'WHERE key = ? AND expires > ?', (key, now)).fetchone()
+        if row is None:
+            return None
+        if row[0] < now - HTTP_CACHE_SQLITE_TOUCH_INTERVAL:
+            # Mark the entry as recently used for the LRU eviction, which is
+            # skipped if the database stays locked by other workers.
+            try:
+                with conn:
+                    conn.execute(
+                        'UPDATE entries SET accessed = ? WHERE key = ?',
+                        (now, key))
+            except sqlite3.OperationalError:
+                pass
+        return row[1]
+
+    def set(self, key: str, value: bytes, ex: Optional[int] = None) -> bool:
+        now = time.time()
+        expires = now + ex if ex is not None else float('inf')
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO entries '
+                         'VALUES (?, ?, ?, ?, ?)',
+                         (key, len(value), now, expires, value))
+            self._evict(conn, now)
+        return True
+
+    def delete(self, key: str) -> int:
+        with self._connect() as conn:
+            return conn.execute('DELETE FROM entries WHERE key = ?',
+                                (key,)).rowcount
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        if self._get_total_bytes(conn) <= self.max_bytes:
+            return
+        # Remove the expired entries first, then the least recently used
+        # entries, down to 90% of the maximum size so that evictions (which
+        # scan the expired entries) only happen once every many writes.
+        conn.execute('DELETE FROM entries WHERE expires <= ?', (now,))
+        total_bytes, evict_keys = self._get_total_bytes(conn), []
+        for key, size in conn.execute(
+                'SELECT key, size FROM entries ORDER BY accessed'):
+            if total_bytes <= 0.9 * self.max_bytes:
+                break
+            evict_keys.append((key,))
+            total_bytes -= size
+        conn.executemany('DELETE FROM entries WHERE key = ?', evict_keys)
+
+    @staticmethod
+    def _get_total_bytes(conn: sqlite3.Connection) -> int:
+        return conn.execute('SELECT bytes FROM total').fetchone()[0]
+
+
+_cache = None
+_cache_initialized = False
+
+
+def get_cache() -> Optional[HttpCache]:
+    """
+    Get the configured upstream response cache.
+
+    Returns
+    -------
+    Optional[HttpCache]
+        The response cache configured by the HTTP_CACHE_BACKEND environment
+        variable, or None if upstream responses aren't cached.
+    """
+    global _cache, _cache_initialized
+    if not _cache_initialized:
+        _cache = _create_cache(HTTP_CACHE_BACKEND.lower())
+        _cache_initialized = True
+    return _cache
+
+
+def _create_cache(backend: str) -> Optional[HttpCache]:
+    if backend == 'memory':
+        return HttpCache(LocalRedis(HTTP_CACHE_MAX_BYTES))
+    elif backend == 'sqlite':
+        return HttpCache(SQLiteStore(HTTP_CACHE_PATH, HTTP_CACHE_MAX_BYTES))
+    elif backend == 'redis':
+        import redis
+        return HttpCache(redis.Redis.from_url(HTTP_CACHE_REDIS_URL))
+    elif not backend:
+        return None
+    else:
+        raise ValueError(f'Unknown HTTP cache backend: {backend}')
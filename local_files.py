@@ -0,0 +1,442 @@
+import base64
+import functools
+import hashlib
+import logging
+import math
+import mmap
+import os
+import re
+import tempfile
+import threading
+import time
+import zlib
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+import file_index
+
+
+logger = logging.getLogger(__name__)
+
+# Directory with a subdirectory per locally mirrored dataset, named after the
+# dataset identifier (e.g. MSV000079514), from which proteomics USIs are
+# resolved instead of upstream.
+LOCAL_DATASETS_DIR = os.environ.get('LOCAL_DATASETS_DIR', '')
+# Directories of individual datasets.
+# Can be specified as a comma-separated list of dataset=directory pairs in the
+# LOCAL_DATASETS environment variable.
+local_datasets = {}
+for _local_dataset in filter(
+        None, os.environ.get('LOCAL_DATASETS', '').split(',')):
+    _dataset, _directory = _local_dataset.split('=', 1)
+    local_datasets[_dataset.strip().upper()] = _directory.strip()
+# Directory in which the scan indexes of the local files are stored, or empty
+# to only keep them in memory.
+LOCAL_INDEX_DIR = os.environ.get('LOCAL_INDEX_DIR', '/output/local_index')
+# Maximum number of memory-mapped files (with their scan index) per worker
+# process.
+LOCAL_MAX_OPEN_FILES = int(os.environ.get('LOCAL_MAX_OPEN_FILES', 128))
+# Minimum interval (in seconds) between listing the files of a dataset
+# directory again when an MS run isn't found.
+LOCAL_RESCAN_INTERVAL = 60
+
+
+class LocalSpectrum(NamedTuple):
+    """
+    A spectrum read from a local file.
+    """
+    mz: np.ndarray
+    intensity: np.ndarray
+    precursor_mz: float
+    precursor_charge: int
+
+
+def get_spectrum(dataset: str, ms_run: str, scan: str) \
+        -> Optional[LocalSpectrum]:
+    """
+    Read a spectrum from the local mirror of a dataset.
+
+    Parameters
+    ----------
+    dataset : str
+        The dataset identifier (e.g. MSV000079514).
+    ms_run : str
+        The MS run name, i.e. the name of the mzML, mzXML, or MGF file
+        without extension.
+    scan : str
+        The scan number of the spectrum.
+
+    Returns
+    -------
+    Optional[LocalSpectrum]
+        The spectrum, or None if the MS run isn't available locally, or if it
+        doesn't contain the scan but has spectra without a scan number.
+
+    Raises
+    ------
+    ValueError
+        If the MS run is available locally but doesn't contain the scan.
+    """
+    filename = _find_file(dataset, ms_run)
+    if filename is None:
+        return None
+    try:
+        scan = int(scan)
+    except ValueError:
+        raise ValueError(f'Invalid scan number: {scan}')
+    stat = os.stat(filename)
+    # Empty (e.g. partially mirrored) files can't be memory-mapped.
+    if stat.st_size == 0:
+        return None
+    return _open(filename, stat.st_size, stat.st_mtime_ns).get_spectrum(scan)
+
+
+def _get_dataset_directory(dataset: str) -> Optional[str]:
+    dataset = dataset.upper()
+    if dataset in local_datasets:
+        return local_datasets[dataset]
+    if LOCAL_DATASETS_DIR:
+        directory = os.path.join(LOCAL_DATASETS_DIR, dataset)
+        if os.path.isdir(directory):
+            return directory
+    return None
+
+
+_listings: Dict[str, Tuple[float, Dict[str, str]]] = {}
+_listings_lock = threading.Lock()
+
+
+def _find_file(dataset: str, ms_run: str) -> Optional[str]:
+    directory = _get_dataset_directory(dataset)
+    if directory is None:
+        return None
+    listed, filenames = _listings.get(directory, (-math.inf, {}))
+    if (ms_run not in filenames
+            and time.monotonic() - listed >= LOCAL_RESCAN_INTERVAL):
+        with _listings_lock:
+            listed, filenames = _listings.get(directory, (-math.inf, {}))
+            if time.monotonic() - listed >= LOCAL_RESCAN_INTERVAL:
+                filenames = _list_files(directory)
+                _listings[directory] = time.monotonic(), filenames
+    return filenames.get(ms_run)
+
+
+def _list_files(directory: str) -> Dict[str, str]:
+    # Files by MS run, preferring mzML over mzXML over MGF files.
+    extension_order = {'.mzml': 0, '.mzxml': 1, '.mgf': 2}
+    filenames = []
+    for dir_path, _, dir_filenames in os.walk(directory):
+        filenames.extend(os.path.join(dir_path, filename)
+                         for filename in dir_filenames
+                         if file_index.is_peak_file(filename))
+    filenames.sort(key=lambda filename: extension_order[
+        os.path.splitext(filename)[1].lower()])
+    ms_runs = {}
+    for filename in filenames:
+        ms_runs.setdefault(file_index.get_ms_run(filename), filename)
+    return ms_runs
+
+
+class PeakFile:
+    """
+    Random access to the spectra in a memory-mapped mzML, mzXML, or MGF file
+    by scan number, using an index of the byte offsets of the spectra.
+    """
+
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self.format = os.path.splitext(filename)[1].lower()[1:]
+        with open(filename, 'rb') as f_in:
+            self._data = mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ)
+        self.scans, self.offsets = _load_index(filename, self._data,
+                                               self.format)
+
+    def get_spectrum(self, scan: int) -> Optional[LocalSpectrum]:
+        """
+        Read a spectrum.
+
+        Parameters
+        ----------
+        scan : int
+            The scan number of the spectrum.
+
+        Returns
+        -------
+        Optional[LocalSpectrum]
+            The spectrum, or None if the file doesn't contain the scan but
+            has spectra without a scan number, which might have this scan
+            number in the original (e.g. vendor) file.
+
+        Raises
+        ------
+        ValueError
+            If the file doesn't contain the scan.
+        """
+        i = np.searchsorted(self.scans, scan)
+        if i == len(self.scans) or self.scans[i] != scan:
+            # Spectra without a scan number are indexed as scan -1.
+            if len(self.scans) > 0 and self.scans[0] < 0:
+                return None
+            raise ValueError(f'Unknown scan {scan} in {self.filename}')
+        return _readers[self.format](self._data, int(self.offsets[i]))
+
+
+@functools.lru_cache(LOCAL_MAX_OPEN_FILES)
+def _open(filename: str, size: int, mtime_ns: int) -> PeakFile:
+    # Files are reopened (and reindexed) when they're modified.
+    return PeakFile(filename)
+
+
+def _load_index(filename: str, data: mmap.mmap, file_format: str) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    # Scan numbers and the byte offsets of their spectra, sorted by scan
+    # number.
+    index_filename = None
+    if LOCAL_INDEX_DIR:
+        stat = os.stat(filename)
+        key = hashlib.sha1(f'{os.path.abspath(filename)}:{stat.st_size}:'
+                           f'{stat.st_mtime_ns}'.encode()).hexdigest()
+        index_filename = os.path.join(LOCAL_INDEX_DIR, f'{key}.npy')
+        try:
+            index = np.load(index_filename)
+            return index[0], index[1]
+        except (OSError, ValueError):
+            pass
+    entries = _indexers[file_format](data)
+    index = (np.asarray(entries, np.int64).reshape(-1, 2).T
+             if entries else np.zeros((2, 0), np.int64))
+    index = index[:, np.argsort(index[0], kind='stable')]
+    if index_filename is not None:
+        try:
+            os.makedirs(LOCAL_INDEX_DIR, exist_ok=True)
+            fd, tmp_filename = tempfile.mkstemp(dir=LOCAL_INDEX_DIR,
+                                                suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f_out:
+                np.save(f_out, index)
+            os.replace(tmp_filename, index_filename)
+        except OSError as e:
+            logger.warning('Unable to store the scan index of %s: %s',
+                           filename, e)
+    return index[0], index[1]
+
+
+_SCAN_NUMBER = re.compile(rb'\bscan=(\d+)')
+_MZML_INDEX_LIST_OFFSET = re.compile(
+    rb'<indexListOffset>\s*(\d+)\s*</indexListOffset>')
+_MZML_INDEX_OFFSET = re.compile(
+    rb'<offset\s+idRef="([^"]*)"[^>]*>\s*(\d+)\s*</offset>')
+_MZML_SPECTRUM = re.compile(rb'<spectrum\s[^>]*?\bid="([^"]*)"')
+
+
+def _index_mzml(data: mmap.mmap) -> List[Tuple[int, int]]:
+    # Use the offsets of the indexedmzML index if it's valid, otherwise find
+    # all spectra. Spectra are identified by the scan number in their native
+    # identifier, or as scan -1 otherwise because their position doesn't
+    # necessarily match their scan number upstream.
+    entries = None
+    match = _MZML_INDEX_LIST_OFFSET.search(data, max(0, len(data) - 4096))
+    if match is not None:
+        start = data.find(b'<index name="spectrum"', int(match.group(1)))
+        end = data.find(b'</index>', start)
+        if start >= 0 and end >= 0:
+            entries = [(native_id, int(offset)) for native_id, offset in
+                       _MZML_INDEX_OFFSET.findall(data, start, end)]
+            if any(data[offset:offset + 9] != b'<spectrum'
+                   for _, offset in entries[:1] + entries[-1:]):
+                entries = None
+    if entries is None:
+        entries = [(match.group(1), match.start())
+                   for match in _MZML_SPECTRUM.finditer(data)]
+    index = []
+    for native_id, offset in entries:
+        match = _SCAN_NUMBER.search(native_id)
+        index.append((int(match.group(1)) if match is not None else -1,
+                      offset))
+    return index
+
+
+def _read_mzml(data: mmap.mmap, offset: int) -> LocalSpectrum:
+    spectrum = data[offset:data.find(b'</spectrum>', offset)]
+    arrays = {}
+    for binary_data_array in _split_elements(spectrum, b'binaryDataArray'):
+        if b'"MS:1000514"' in binary_data_array:
+            array_type = 'mz'
+        elif b'"MS:1000515"' in binary_data_array:
+            array_type = 'intensity'
+        else:
+            continue
+        if b'"MS:1000523"' in binary_data_array:
+            dtype = '<f8'
+        elif b'"MS:1000521"' in binary_data_array:
+            dtype = '<f4'
+        else:
+            raise ValueError('Unsupported mzML binary data type')
+        if b'"MS:1000574"' in binary_data_array:
+            compression = 'zlib'
+        elif b'"MS:1000576"' in binary_data_array:
+            compression = None
+        else:
+            raise ValueError('Unsupported mzML binary data compression')
+        start = binary_data_array.find(b'<binary>') + len(b'<binary>')
+        end = binary_data_array.find(b'</binary>', start)
+        arrays[array_type] = _decode_binary(
+            binary_data_array[start:end], dtype, compression)
+    precursor_mz = _get_cv_value(spectrum, b'MS:1000744')
+    charge = _get_cv_value(spectrum, b'MS:1000041')
+    return LocalSpectrum(
+        arrays.get('mz', np.zeros(0)), arrays.get('intensity', np.zeros(0)),
+        float(precursor_mz) if precursor_mz is not None else 0.,
+        int(charge) if charge is not None else 0)
+
+
+def _split_elements(data: bytes, tag: bytes) -> List[bytes]:
+    # Plain searches, which are considerably faster than (non-greedy)
+    # regular expressions over the large encoded arrays.
+    elements, start = [], data.find(b'<' + tag)
+    while start >= 0:
+        end = start + len(tag) + 1
+        # Skip longer tag names with the same prefix.
+        if data[end:end + 1] in (b' ', b'>', b'\n', b'\r', b'\t'):
+            end = data.find(b'</' + tag + b'>', end)
+            if end < 0:
+                break
+            elements.append(data[start:end])
+        start = data.find(b'<' + tag, end)
+    return elements
+
+
+def _get_cv_value(element: bytes, accession: bytes) -> Optional[bytes]:
+    match = re.search(rb'<cvParam\b[^>]*\baccession="' + accession +
+                      rb'"[^>]*>', element)
+    if match is None:
+        return None
+    value = re.search(rb'\bvalue="([^"]*)"', match.group(0))
+    return value.group(1) if value is not None else None
+
+
+_MZXML_INDEX_OFFSET = re.compile(rb'<indexOffset>\s*(\d+)\s*</indexOffset>')
+_MZXML_INDEX_ENTRY = re.compile(
+    rb'<offset\s+id="(\d+)"\s*>\s*(\d+)\s*</offset>')
+_MZXML_SCAN = re.compile(rb'<scan\s[^>]*?\bnum="(\d+)"')
+_MZXML_PRECURSOR = re.compile(rb'<precursorMz\b([^>]*)>\s*([^<]*?)\s*<')
+_MZXML_PEAKS = re.compile(rb'<peaks\b([^>]*?)(/?)>')
+
+
+def _index_mzxml(data: mmap.mmap) -> List[Tuple[int, int]]:
+    # Use the offsets of the mzXML index if it's valid, otherwise find all
+    # scans.
+    match = _MZXML_INDEX_OFFSET.search(data, max(0, len(data) - 4096))
+    if match is not None:
+        start = data.find(b'<index name="scan"', int(match.group(1)))
+        end = data.find(b'</index>', start)
+        if start >= 0 and end >= 0:
+            entries = [(int(scan), int(offset)) for scan, offset in
+                       _MZXML_INDEX_ENTRY.findall(data, start, end)]
+            if all(data[offset:offset + 5] == b'<scan'
+                   for _, offset in entries[:1] + entries[-1:]):
+                return entries
+    return [(int(match.group(1)), match.start())
+            for match in _MZXML_SCAN.finditer(data)]
+
+
+def _read_mzxml(data: mmap.mmap, offset: int) -> LocalSpectrum:
+    # The peaks of a scan precede its nested (child) scans.
+    peaks = _MZXML_PEAKS.search(data, offset)
+    if peaks is None:
+        raise ValueError('Invalid mzXML scan')
+    precursor = _MZXML_PRECURSOR.search(data, offset, peaks.start())
+    precursor_mz, charge = 0., 0
+    if precursor is not None:
+        precursor_mz = float(precursor.group(2))
+        charge_attribute = _get_attribute(precursor.group(1),
+                                          b'precursorCharge')
+        charge = int(charge_attribute) if charge_attribute else 0
+    attributes = peaks.group(1)
+    encoded = (data[peaks.end():data.find(b'</peaks>', peaks.end())].strip()
+               if not peaks.group(2) else b'')
+    if not encoded:
+        mz = intensity = np.zeros(0)
+    else:
+        if (_get_attribute(attributes, b'contentType')
+                or _get_attribute(attributes, b'pairOrder')
+                or b'm/z-int') != b'm/z-int':
+            raise ValueError('Unsupported mzXML peaks content type')
+        precision = int(_get_attribute(attributes, b'precision') or 32)
+        dtype = f'>f{precision // 8}'
+        compression = _get_attribute(attributes, b'compressionType')
+        if compression not in (None, b'none', b'zlib'):
+            raise ValueError('Unsupported mzXML peaks compression')
+        mz, intensity = _decode_binary(
+            encoded, dtype,
+            'zlib' if compression == b'zlib' else None).reshape(-1, 2).T
+    return LocalSpectrum(mz, intensity, precursor_mz, charge)
+
+
+def _get_attribute(attributes: bytes, name: bytes) -> Optional[bytes]:
+    match = re.search(rb'\b' + name + rb'="([^"]*)"', attributes)
+    return match.group(1) if match is not None else None
+
+
+_MGF_SCANS = re.compile(rb'^SCANS=(\d+)', re.MULTILINE)
+
+
+def _index_mgf(data: mmap.mmap) -> List[Tuple[int, int]]:
+    # Spectra are identified by their SCANS header, or as scan -1 otherwise
+    # (see `_index_mzml`).
+    index, start = [], data.find(b'BEGIN IONS')
+    while start >= 0:
+        end = data.find(b'END IONS', start)
+        if end < 0:
+            end = len(data)
+        scan = _MGF_SCANS.search(data, start, end)
+        index.append((int(scan.group(1)) if scan is not None else -1,
+                      start))
+        start = data.find(b'BEGIN IONS', end)
+    return index
+
+
+def _read_mgf(data: mmap.mmap, offset: int) -> LocalSpectrum:
+    end = data.find(b'END IONS', offset)
+    spectrum = data[offset:end if end >= 0 else len(data)]
+    precursor_mz, charge, peak_lines = 0., 0, []
+    lines = spectrum.splitlines()
+    for i, line in enumerate(lines[1:], 1):
+        line = line.strip()
+        if not line or line[:1] in b'#;!/':
+            continue
+        elif line[:1].isdigit():
+            # Parse the remaining peaks at once if they consist of m/z and
+            # intensity pairs only.
+            peak_lines = lines[i:]
+            break
+        elif line.startswith(b'PEPMASS='):
+            precursor_mz = float(line[8:].split()[0])
+        elif line.startswith(b'CHARGE='):
+            # E.g. 2+ or 2-.
+            value = line[7:].split(b',')[0].strip()
+            charge = (-1 if value.endswith(b'-') else 1) * int(
+                value.rstrip(b'+-'))
+    try:
+        peaks = np.array(b' '.join(peak_lines).split(), np.float64)
+        peaks = peaks.reshape(-1, 2)
+        if len(peaks) != sum(1 for line in peak_lines if line.strip()):
+            raise ValueError
+    except ValueError:
+        peaks = np.array([line.split()[:2] for line in peak_lines
+                          if line[:1].isdigit()], np.float64).reshape(-1, 2)
+    return LocalSpectrum(peaks[:, 0], peaks[:, 1], precursor_mz, charge)
+
+
+def _decode_binary(encoded: bytes, dtype: str,
+                   compression: Optional[str]) -> np.ndarray:
+    decoded = base64.b64decode(encoded)
+    if compression == 'zlib':
+        decoded = zlib.decompress(decoded)
+    return np.frombuffer(decoded, dtype)
+
+
+_indexers: Dict[str, Callable[[mmap.mmap], List[Tuple[int, int]]]] = {
+    'mzml': _index_mzml, 'mzxml': _index_mzxml, 'mgf': _index_mgf}
+_readers: Dict[str, Callable[[mmap.mmap, int], LocalSpectrum]] = {
+    'mzml': _read_mzml, 'mzxml': _read_mzxml, 'mgf': _read_mgf}
@@ -0,0 +1,166 @@
+import os
+from typing import ContextManager, Dict, Sequence
+
+import prometheus_client
+from prometheus_client import multiprocess
+
+# Directory in which the worker processes store their metrics, so that the
+# metrics of all workers are aggregated on each scrape (see the multiprocess
+# mode of prometheus_client, which is enabled whenever the same environment
+# variable is set, even if it's empty). If not set, only the metrics of the
+# scraped worker process are reported.
+METRICS_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR', '')
+
+CONTENT_TYPE = prometheus_client.CONTENT_TYPE_LATEST
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+
+
+class _Metric:
+    # prometheus_client metric with the label values passed as keyword
+    # arguments of each observation.
+
+    def __init__(self, metric) -> None:
+        self._metric = metric
+
+    def _get(self, labels: Dict[str, str]):
+        return self._metric.labels(**labels) if labels else self._metric
+
+
+class Counter(_Metric):
+    """
+    Monotonically increasing count per label combination.
+    """
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Sequence[str] = ()) -> None:
+        super().__init__(prometheus_client.Counter(name, documentation,
+                                                   labelnames))
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        self._get(labels).inc(amount)
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values (e.g. durations in seconds) per label
+    combination, counted in cumulative buckets.
+    """
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(prometheus_client.Histogram(
+            name, documentation, labelnames, buckets=buckets))
+
+    def observe(self, value: float, **labels: str) -> None:
+        self._get(labels).observe(value)
+
+    def time(self, **labels: str) -> ContextManager:
+        """
+        Observe the duration (in seconds) of the enclosed code, also if it
+        raises an exception.
+        """
+        return self._get(labels).time()
+
+
+class Gauge(_Metric):
+    """
+    Current value per label combination, summed over the live worker
+    processes.
+    """
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Sequence[str] = ()) -> None:
+        super().__init__(prometheus_client.Gauge(
+            name, documentation, labelnames, multiprocess_mode='livesum'))
+
+    def set(self, value: float, **labels: str) -> None:
+        self._get(labels).set(value)
+
+
+request_duration = Histogram(
+    'usi_request_duration_seconds', 'Duration of the handled requests.',
+    ['route', 'status'])
+stage_duration = Histogram(
+    'usi_stage_duration_seconds',
+    'Duration of the spectrum processing stages: resolve (cached or upstream '
+    'lookup), labels, cosine, render, similarity_matrix, and search.',
+    ['stage'])
+upstream_duration = Histogram(
+    'usi_upstream_duration_seconds',
+    'Duration of the upstream lookups per collection.', ['collection'])
+upstream_errors = Counter(
+    'usi_upstream_errors_total', 'Failed upstream lookups per collection.',
+    ['collection', 'error'])
+cache_requests = Counter(
+    'usi_cache_requests_total',
+    'Lookups in the spectrum store (spectrum), render cache (render), '
+    'upstream response cache (http), MassIVE file index (file_index), and '
+    'unknown USIs (negative).',
+    ['cache', 'result'])
+prefetch_requests = Counter(
+    'usi_prefetch_requests_total',
+    'Background prefetches of spectra: queued, dropped (queue full), cached '
+    '(already available), resolved, and failed.', ['result'])
+upstream_circuit_events = Counter(
+    'usi_upstream_circuit_events_total',
+    'Circuit breaker events per upstream host: opened, closed, and rejected '
+    'requests.', ['host', 'event'])
+upstream_circuit_open = Gauge(
+    'usi_upstream_circuit_open',
+    'Number of worker processes that consider an upstream host unavailable.',
+    ['host'])
+rendered_bytes = Counter(
+    'usi_rendered_bytes_total', 'Size of the rendered figures.', ['format'])
+rendered_figures = Counter(
+    'usi_rendered_figures_total', 'Number of rendered figures.', ['format'])
+
+
+def generate_latest() -> str:
+    """
+    Get the metrics in the Prometheus text exposition format.
+
+    If METRICS_DIR is set, the metrics of all (current and exited) worker
+    processes are aggregated.
+
+    Returns
+    -------
+    str
+        The metrics of all registered counters, gauges, and histograms.
+    """
+    if METRICS_DIR:
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry, METRICS_DIR)
+    else:
+        registry = prometheus_client.REGISTRY
+    return prometheus_client.generate_latest(registry).decode()
+
+
+def clear_directory() -> None:
+    """
+    Create METRICS_DIR (if set), or remove the metrics of previous server runs
+    from it.
+    """
+    if not METRICS_DIR:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    with os.scandir(METRICS_DIR) as it:
+        for entry in it:
+            if entry.name.endswith('.db'):
+                os.unlink(entry.path)
+
+
+def mark_process_dead(pid: int) -> None:
+    """
+    Discard the gauges of an exited worker process, whose counts and
+    observations are retained.
+
+    Parameters
+    ----------
+    pid : int
+        The process id of the exited worker.
+    """
+    if METRICS_DIR:
+        multiprocess.mark_process_dead(pid, METRICS_DIR)
@@ -1,133 +1,517 @@
+import collections
+import concurrent.futures
 import functools
 import json
+import os
 import re
-from typing import Tuple
+import threading
+import time
+from typing import (Callable, Dict, Iterable, Iterator, List, NamedTuple,
+                    Optional, Tuple)
 
+import numpy as np
 import requests
 import spectrum_utils.spectrum as sus
 
+import concurrency
+import file_index
+import http_cache
+import local_files
+import metrics
 import parsing_legacy
+import peak_decoding
+import prefetch
+import spectrum_cache
+import spectrum_index
+import spectrum_view
+import upstream
 
 MS2LDA_SERVER = 'http://ms2lda.org/basicviz/'
 MOTIFDB_SERVER = 'http://ms2lda.org/motifdb/'
 MASSBANK_SERVER = 'https://massbank.us/rest/spectra/'
+GNPS_HOST = 'gnps.ucsd.edu'
+
+# Maximum number of concurrent upstream lookups per collection when resolving
+# batches of USIs.
+BATCH_MAX_WORKERS_PER_COLLECTION = int(
+    os.environ.get('BATCH_MAX_WORKERS_PER_COLLECTION', 4))
+# Maximum time (in seconds) to wait for another worker process that resolves
+# the same USI.
+RESOLVE_LOCK_TIMEOUT = float(os.environ.get('RESOLVE_LOCK_TIMEOUT', 60))
+# Maximum number of candidate dataset files that are concurrently probed for
+# a MassIVE spectrum.
+MASSIVE_MAX_PROBES = int(os.environ.get('MASSIVE_MAX_PROBES', 4))
+# Time (in seconds) during which USIs that couldn't be found upstream are
+# reported as unknown without looking them up again, or 0 to disable it.
+NEGATIVE_CACHE_TTL = float(os.environ.get('NEGATIVE_CACHE_TTL', 60))
+# Maximum number of unknown USIs that are remembered per worker process.
+NEGATIVE_CACHE_MAX_SIZE = 10000
 
 # USI specification: http://www.psidev.info/usi
-usi_pattern = re.compile(
-    # mzspec preamble
-    '^mzspec'
-    # collection identifier
-    # Proteomics collection identifiers: PXDnnnnnn, MSVnnnnnnnnn, RPXDnnnnnn,
-    #                                    PXLnnnnnn
-    # Unofficial: MASSIVEKB
-    # https://github.com/HUPO-PSI/usi/blob/master/CollectionIdentifiers.md
-    ':(MSV\d{9}|PXD\d{6}|PXL\d{6}|RPXD\d{6})'
-    # msRun identifier
-    ':(.*)'
-    # index flag
-    ':(scan|index|nativeId|trace)'
-    # index number
-    ':(.+)'
-    # optional spectrum interpretation
-    '(:.+)?$',
-    flags=re.IGNORECASE
-)
-# OR: Metabolomics USIs.
-usi_pattern_draft = re.compile(
-    # mzdraft preamble
-    '^(?:mzspec|mzdraft)'
-    # collection identifier
-    # Unofficial proteomics spectral library identifier: MASSIVEKB
-    # Metabolomics collection identifiers: GNPS, MASSBANK, MS2LDA, MOTIFDB
-    ':(MASSIVEKB|GNPS|MASSBANK|MS2LDA|MOTIFDB)'
-    # msRun identifier
-    ':(.*)'
-    # index flag
-    ':(scan|index|nativeId|trace|accession)'
-    # index number
-    ':(.+)'
-    # optional spectrum interpretation
-    '(:.+)?$',
-    flags=re.IGNORECASE
-)
+# Proteomics collection identifiers: PXDnnnnnn, MSVnnnnnnnnn, RPXDnnnnnn,
+#                                    PXLnnnnnn
+# https://github.com/HUPO-PSI/usi/blob/master/CollectionIdentifiers.md
+usi_collection_prefixes = {'MSV': 9, 'PXD': 6, 'PXL': 6, 'RPXD': 6}
+usi_index_flags = {'scan': 'scan', 'index': 'index', 'nativeid': 'nativeId',
+                   'trace': 'trace'}
+# OR: Metabolomics USIs with an mzspec or mzdraft preamble.
+# Unofficial proteomics spectral library identifier: MASSIVEKB
+# Metabolomics collection identifiers: GNPS, MASSBANK, MS2LDA, MOTIFDB
+usi_draft_collections = {'MASSIVEKB', 'GNPS', 'MASSBANK', 'MS2LDA', 'MOTIFDB'}
+usi_draft_index_flags = {**usi_index_flags, 'accession': 'accession'}
+
 gnps_task_pattern = re.compile('^TASK-([a-z0-9]{32})-(.+)$',
                                flags=re.IGNORECASE)
-ms2lda_task_pattern = re.compile('^TASK-(\d+)$', flags=re.IGNORECASE)
+ms2lda_task_pattern = re.compile(r'^TASK-(\d+)$', flags=re.IGNORECASE)
+
+_single_flight = concurrency.SingleFlight()
+
+
+class Usi(NamedTuple):
+    """
+    The components of a tokenized USI.
+    """
+    usi: str
+    preamble: str
+    collection: str
+    ms_run: str
+    index_flag: str
+    index: str
+    interpretation: Optional[str]
+
+    @property
+    def collection_key(self) -> str:
+        # All proteomics USIs are resolved through MassIVE.
+        collection = self.collection.upper()
+        if (collection == 'MASSIVEKB' or
+                collection not in usi_draft_collections):
+            return 'massive'
+        return collection.lower()
+
+    @property
+    def normalized(self) -> str:
+        normalized = (f'{self.preamble}:{self.collection.upper()}:'
+                      f'{self.ms_run}:{self.index_flag}:{self.index}')
+        if self.interpretation is not None:
+            normalized += f':{self.interpretation}'
+        return normalized
+
+
+@functools.lru_cache(10000)
+def tokenize_usi(usi: str) -> Usi:
+    """
+    Split a USI into its components in a single pass.
+
+    Parameters
+    ----------
+    usi : str
+        The USI to tokenize.
+
+    Returns
+    -------
+    Usi
+        The USI components, with the preamble and index flag in their
+        canonical case.
+
+    Raises
+    ------
+    ValueError
+        If the USI is incorrectly formatted.
+    """
+    tokens = usi.split(':')
+    if len(tokens) >= 5:
+        preamble, collection = tokens[0].lower(), tokens[1]
+        # First try matching as an official USI, then as a metabolomics draft
+        # USI.
+        if preamble == 'mzspec' and _is_official_collection(collection):
+            index_flags = usi_index_flags
+        elif (preamble in ('mzspec', 'mzdraft') and
+              collection.upper() in usi_draft_collections):
+            index_flags = usi_draft_index_flags
+        else:
+            index_flags = None
+        if index_flags is not None:
+            # The msRun can't contain colons, the interpretation can.
+            for i in range(2, len(tokens) - 1):
+                index_flag = index_flags.get(tokens[i].lower())
+                if index_flag is not None and tokens[i + 1]:
+                    return Usi(usi, preamble, collection,
+                               ':'.join(tokens[2:i]), index_flag,
+                               tokens[i + 1],
+                               ':'.join(tokens[i + 2:]) or None)
+    raise ValueError(f'Incorrectly formatted USI: {usi}')
+
+
+def _is_official_collection(collection: str) -> bool:
+    collection = collection.upper()
+    for prefix, num_digits in usi_collection_prefixes.items():
+        if (collection.startswith(prefix) and
+                len(collection) == len(prefix) + num_digits and
+                collection[len(prefix):].isdecimal()):
+            return True
+    return False
+
+
+def validate_usis(usis: Iterable[str]) \
+        -> List[Tuple[str, Optional[str], Optional[str]]]:
+    """
+    Validate and normalize USIs without resolving them.
+
+    Parameters
+    ----------
+    usis : Iterable[str]
+        The USIs to validate.
+
+    Returns
+    -------
+    List[Tuple[str, Optional[str], Optional[str]]]
+        Tuples of (i) the USI, (ii) the normalized USI if it's valid, and
+        (iii) the validation error otherwise, in the order of the given USIs.
+    """
+    results = []
+    for usi in usis:
+        try:
+            results.append((usi, tokenize_usi(usi).normalized, None))
+        except ValueError as e:
+            # Legacy USIs are passed through unchanged.
+            if parsing_legacy.is_legacy_usi(usi):
+                results.append((usi, usi, None))
+            else:
+                results.append((usi, None, str(e)))
+    return results
+
+
+def normalize_usi(usi: str) -> str:
+    """
+    Normalize a USI.
 
+    Parameters
+    ----------
+    usi : str
+        The USI.
 
-def _match_usi(usi: str):
-    # First try matching as an official USI, then as a metabolomics draft USI.
-    match = usi_pattern.match(usi)
-    if match is None:
-        match = usi_pattern_draft.match(usi)
-    if match is None:
-        raise ValueError(f'Incorrectly formatted USI: {usi}')
-    return match
+    Returns
+    -------
+    str
+        The normalized USI, or the USI unchanged if it can't be tokenized
+        (e.g. legacy USIs).
+    """
+    try:
+        return tokenize_usi(usi).normalized
+    except ValueError:
+        return usi
 
 
 @functools.lru_cache(100)
 def parse_usi(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
+    # Concurrent lookups of the same USI wait on a single resolution.
+    usi_key = normalize_usi(usi)
+    _check_unknown_usi(usi_key)
+    try:
+        spectrum, source_link = _single_flight.do(usi_key, _resolve_usi, usi)
+    except ValueError as e:
+        _add_unknown_usi(usi_key, e)
+        raise
+    # Cached spectra are shared between requests and thus read-only.
+    spectrum = spectrum_view.freeze(spectrum)
+    # Make the spectrum available for similarity searches.
+    spectrum_index.index.add(usi_key, spectrum)
+    # Users tend to browse to the neighboring scans next.
+    if prefetch.PREFETCH_SCANS > 0:
+        _prefetch_gnps_task_scans(usi)
+    return spectrum, source_link
+
+
+_unknown_usis: 'collections.OrderedDict[str, Tuple[float, str]]' = \
+    collections.OrderedDict()
+_unknown_usis_lock = threading.Lock()
+
+
+def _check_unknown_usi(usi_key: str) -> None:
+    # Raise the error of USIs that recently couldn't be resolved.
+    if NEGATIVE_CACHE_TTL <= 0:
+        return
+    with _unknown_usis_lock:
+        expires, message = _unknown_usis.get(usi_key, (0., None))
+        if message is not None and expires <= time.monotonic():
+            del _unknown_usis[usi_key]
+            message = None
+    metrics.cache_requests.inc(
+        cache='negative', result='hit' if message is not None else 'miss')
+    if message is not None:
+        raise ValueError(message)
+
+
+def _add_unknown_usi(usi_key: str, error: ValueError) -> None:
+    # Errors that are caused by an unhealthy upstream, rather than a USI that
+    # doesn't exist, aren't remembered.
+    if NEGATIVE_CACHE_TTL <= 0 or _is_upstream_failure(error):
+        return
+    with _unknown_usis_lock:
+        _unknown_usis[usi_key] = (time.monotonic() + NEGATIVE_CACHE_TTL,
+                                  str(error))
+        _unknown_usis.move_to_end(usi_key)
+        while len(_unknown_usis) > NEGATIVE_CACHE_MAX_SIZE:
+            _unknown_usis.popitem(last=False)
+
+
+def _is_upstream_failure(error: BaseException) -> bool:
+    # Resolvers raise a ValueError while handling the upstream error.
+    while error is not None:
+        if isinstance(error, requests.exceptions.HTTPError):
+            if (error.response is not None
+                    and error.response.status_code >= 500):
+                return True
+        elif isinstance(error, requests.exceptions.RequestException):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+def _resolve_usi(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
+    # Spectra are shared between the worker processes through the (optional)
+    # spectrum store, with a per-process LRU cache in front of it.
+    store = spectrum_cache.get_store()
+    if store is None:
+        return _parse_usi(usi)
+    # Different spellings of a USI share a single store entry.
+    usi_key = normalize_usi(usi)
+    cached = store.get(usi_key)
+    metrics.cache_requests.inc(
+        cache='spectrum', result='hit' if cached is not None else 'miss')
+    if cached is not None:
+        return cached
+    # Only one worker process resolves the USI, the others wait until it's
+    # available from the spectrum store.
+    with store.lock(usi_key, RESOLVE_LOCK_TIMEOUT):
+        cached = store.get(usi_key)
+        if cached is not None:
+            return cached
+        spectrum, source_link = _parse_usi(usi)
+        store.put(usi_key, spectrum, source_link, _get_collection(usi))
+    return spectrum, source_link
+
+
+def prefetch_gnps_task(task: str, filename: str, scans: Iterable[int]) \
+        -> int:
+    """
+    Resolve the spectra of a GNPS task file in the background, into the
+    spectrum store (and the upstream response cache).
+
+    Parameters
+    ----------
+    task : str
+        The GNPS task identifier.
+    filename : str
+        The file name within the task, as in the task USIs.
+    scans : Iterable[int]
+        The scan numbers of the spectra.
+
+    Returns
+    -------
+    int
+        The number of queued spectra, excluding the spectra that are dropped
+        because the prefetch queue is full.
+    """
+    return sum(_prefetcher.submit(f'mzspec:GNPS:TASK-{task}-{filename}:scan:'
+                                  f'{scan}', GNPS_HOST)
+               for scan in scans)
+
+
+def _prefetch_gnps_task_scans(usi: str) -> None:
+    try:
+        tokenized_usi = tokenize_usi(usi)
+    except ValueError:
+        return
+    if (tokenized_usi.collection_key != 'gnps'
+            or tokenized_usi.index_flag != 'scan'
+            or not tokenized_usi.index.isdecimal()
+            or gnps_task_pattern.match(tokenized_usi.ms_run) is None):
+        return
+    # Nothing to prefetch into without a cache that outlives the request.
+    if spectrum_cache.get_store() is None and http_cache.get_cache() is None:
+        return
+    scan = int(tokenized_usi.index)
+    for offset in range(1, prefetch.PREFETCH_SCANS + 1):
+        for neighbor in (scan + offset, scan - offset):
+            if neighbor > 0:
+                _prefetcher.submit(
+                    f'{tokenized_usi.preamble}:{tokenized_usi.collection}:'
+                    f'{tokenized_usi.ms_run}:scan:{neighbor}', GNPS_HOST)
+
+
+def get_cached_spectrum(usi: str) -> Optional[sus.MsmsSpectrum]:
+    """
+    Get a previously resolved spectrum from the spectrum store, without
+    resolving it.
+
+    Parameters
+    ----------
+    usi : str
+        The USI of the spectrum.
+
+    Returns
+    -------
+    Optional[sus.MsmsSpectrum]
+        The spectrum, or None if it isn't available from the spectrum store.
+    """
+    store = spectrum_cache.get_store()
+    cached = store.get(normalize_usi(usi)) if store is not None else None
+    return cached[0] if cached is not None else None
+
+
+def _is_cached(usi: str) -> bool:
+    store = spectrum_cache.get_store()
+    return store is not None and store.get(normalize_usi(usi)) is not None
+
+
+# Prefetched spectra are resolved into the shared caches only, not into the
+# per-process LRU cache, and don't trigger further prefetches.
+_prefetcher = prefetch.Prefetcher(_resolve_usi, _is_cached)
+
+
+def parse_usi_batch(usis: Iterable[str]) \
+        -> Iterator[Tuple[str, Optional[Tuple[sus.MsmsSpectrum, str]],
+                          Optional[Exception]]]:
+    """
+    Resolve multiple USIs concurrently.
+
+    Identical USIs are only resolved once and the USIs are grouped by
+    collection, with at most `BATCH_MAX_WORKERS_PER_COLLECTION` concurrent
+    lookups per collection.
+
+    Parameters
+    ----------
+    usis : Iterable[str]
+        The USIs to resolve.
+
+    Returns
+    -------
+    Iterator[Tuple[str, Optional[Tuple[sus.MsmsSpectrum, str]],
+                   Optional[Exception]]]
+        Tuples of (i) the USI, (ii) the spectrum and source link if the USI
+        could be resolved, and (iii) the exception otherwise, in the order of
+        the given USIs.
+    """
+    usis = list(usis)
+    executors, futures = {}, {}
+    try:
+        for usi in usis:
+            if usi not in futures:
+                collection = _get_collection(usi)
+                if collection not in executors:
+                    executors[collection] = \
+                        concurrent.futures.ThreadPoolExecutor(
+                            BATCH_MAX_WORKERS_PER_COLLECTION)
+                futures[usi] = executors[collection].submit(parse_usi, usi)
+        for usi in usis:
+            try:
+                yield usi, futures[usi].result(), None
+            except Exception as e:
+                yield usi, None, e
+    finally:
+        # Don't resolve the remaining USIs if the consumer stops early.
+        for future in futures.values():
+            future.cancel()
+        for executor in executors.values():
+            executor.shutdown(wait=False)
+
+
+def get_ttl(usi: str) -> int:
+    """
+    Get the time-to-live of a resolved spectrum in the spectrum store.
+
+    Parameters
+    ----------
+    usi : str
+        The USI of the spectrum.
+
+    Returns
+    -------
+    int
+        The time-to-live in seconds of the spectra of the USI's collection.
+    """
+    store = spectrum_cache.get_store()
+    return spectrum_cache.get_ttl(_get_collection(usi),
+                                  store.ttl if store is not None else None)
+
+
+def _get_collection(usi: str) -> str:
+    try:
+        return tokenize_usi(usi).collection_key
+    except ValueError:
+        return 'legacy'
+
+
+_resolvers: Dict[str, Callable[[Usi], Tuple[sus.MsmsSpectrum, str]]] = {}
+
+
+def _register_resolver(collection_key: str):
+    def decorator(resolver):
+        _resolvers[collection_key] = resolver
+        return resolver
+    return decorator
+
+
+def _parse_usi(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
     try:
-        match = _match_usi(usi)
+        tokenized_usi = tokenize_usi(usi)
     except ValueError as e:
         try:
-            return parsing_legacy.parse_usi_legacy(usi)
+            return _timed_lookup('legacy', parsing_legacy.parse_usi_legacy,
+                                 usi)
         except ValueError:
             raise e
-    collection = match.group(1).lower()
-    # Send all proteomics USIs to MassIVE.
-    if (
-        collection.startswith('msv') or
-        collection.startswith('pxd') or
-        collection.startswith('pxl') or
-        collection.startswith('rpxd') or
-        collection == 'massivekb'
-    ):
-        return _parse_msv_pxd(usi)
-    elif collection == 'gnps':
-        return _parse_gnps(usi)
-    elif collection == 'massbank':
-        return _parse_massbank(usi)
-    elif collection == 'ms2lda':
-        return _parse_ms2lda(usi)
-    elif collection == 'motifdb':
-        return _parse_motifdb(usi)
-    else:
-        raise ValueError(f'Unknown USI collection: {match.group(1)}')
+    resolver = _resolvers.get(tokenized_usi.collection_key)
+    if resolver is None:
+        raise ValueError(f'Unknown USI collection: '
+                         f'{tokenized_usi.collection}')
+    return _timed_lookup(tokenized_usi.collection_key, resolver,
+                         tokenized_usi)
+
+
+def _timed_lookup(collection: str, resolver: Callable, usi) \
+        -> Tuple[sus.MsmsSpectrum, str]:
+    # Record the upstream latency and errors per collection.
+    try:
+        with metrics.upstream_duration.time(collection=collection):
+            return resolver(usi)
+    except Exception as e:
+        metrics.upstream_errors.inc(collection=collection,
+                                    error=type(e).__name__)
+        raise
 
 
 # Parse GNPS tasks or library spectra.
-def _parse_gnps(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
-    match = _match_usi(usi)
-    ms_run = match.group(2)
-    if ms_run.lower().startswith('task'):
+@_register_resolver('gnps')
+def _parse_gnps(usi: Usi) -> Tuple[sus.MsmsSpectrum, str]:
+    if usi.ms_run.lower().startswith('task'):
         return _parse_gnps_task(usi)
     else:
         return _parse_gnps_library(usi)
 
 
 # Parse GNPS clustered spectra in Molecular Networking.
-def _parse_gnps_task(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
-    match = _match_usi(usi)
-    gnps_task_match = gnps_task_pattern.match(match.group(2))
+def _parse_gnps_task(usi: Usi) -> Tuple[sus.MsmsSpectrum, str]:
+    gnps_task_match = gnps_task_pattern.match(usi.ms_run)
     if gnps_task_match is None:
         raise ValueError('Incorrectly formatted GNPS task')
     task = gnps_task_match.group(1)
     filename = gnps_task_match.group(2)
-    index_flag = match.group(3)
-    if index_flag.lower() != 'scan':
+    if usi.index_flag != 'scan':
         raise ValueError('Currently supported GNPS TASK index flags: scan')
-    scan = match.group(4)
+    scan = usi.index
 
     try:
         request_url = (f'https://gnps.ucsd.edu/ProteoSAFe/DownloadResultFile?'
                        f'task={task}&invoke=annotatedSpectrumImageText&block=0'
                        f'&file=FILE->{filename}&scan={scan}&peptide=*..*&'
                        f'force=false&_=1561457932129&format=JSON')
-        lookup_request = requests.get(request_url)
+        lookup_request = upstream.get(request_url)
         lookup_request.raise_for_status()
         spectrum_dict = lookup_request.json()
-        mz, intensity = zip(*spectrum_dict['peaks'])
+        mz, intensity = peak_decoding.decode_peak_list(
+            spectrum_dict['peaks'])
         source_link = (f'https://gnps.ucsd.edu/ProteoSAFe/status.jsp?'
                        f'task={task}')
         if 'precursor' in spectrum_dict:
@@ -135,34 +519,32 @@ def _parse_gnps_task(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
             charge = int(spectrum_dict['precursor'].get('charge', 0))
         else:
             precursor_mz, charge = 0, 0
-        return (sus.MsmsSpectrum(usi, precursor_mz, charge, mz, intensity),
-                source_link)
+        return (sus.MsmsSpectrum(usi.usi, precursor_mz, charge, mz,
+                                 intensity), source_link)
     except (requests.exceptions.HTTPError, json.decoder.JSONDecodeError):
         raise ValueError('Unknown GNPS task USI')
 
 
 # Parse GNPS library.
-def _parse_gnps_library(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
-    match = _match_usi(usi)
-    index_flag = match.group(3)
-    if index_flag.lower() != 'accession':
+def _parse_gnps_library(usi: Usi) -> Tuple[sus.MsmsSpectrum, str]:
+    if usi.index_flag != 'accession':
         raise ValueError('Currently supported GNPS library index flags: '
                          'accession')
-    index = match.group(4)
+    index = usi.index
     try:
         request_url = (f'https://gnps.ucsd.edu/ProteoSAFe/'
                        f'SpectrumCommentServlet?SpectrumID={index}')
-        lookup_request = requests.get(request_url)
+        lookup_request = upstream.get(request_url)
         lookup_request.raise_for_status()
         spectrum_dict = lookup_request.json()
         if spectrum_dict['spectruminfo']['peaks_json'] == 'null':
             raise ValueError('Unknown GNPS library USI')
-        mz, intensity = zip(*json.loads(
-            spectrum_dict['spectruminfo']['peaks_json']))
+        mz, intensity = peak_decoding.decode_peak_json(
+            spectrum_dict['spectruminfo']['peaks_json'])
         source_link = (f'https://gnps.ucsd.edu/ProteoSAFe/'
                        f'gnpslibraryspectrum.jsp?SpectrumID={index}')
         spectrum = sus.MsmsSpectrum(
-            usi,
+            usi.usi,
             float(spectrum_dict['annotations'][0]['Precursor_MZ']),
             int(spectrum_dict['annotations'][0]['Charge']),
             mz,
@@ -174,21 +556,17 @@ def _parse_gnps_library(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
 
 
 # Parse MassBank entry.
-def _parse_massbank(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
-    match = _match_usi(usi)
-    index_flag = match.group(3)
-    if index_flag.lower() != 'accession':
+@_register_resolver('massbank')
+def _parse_massbank(usi: Usi) -> Tuple[sus.MsmsSpectrum, str]:
+    if usi.index_flag != 'accession':
         raise ValueError('Currently supported MassBank index flags: accession')
-    index = match.group(4)
+    index = usi.index
     try:
-        lookup_request = requests.get(f'{MASSBANK_SERVER}{index}')
+        lookup_request = upstream.get(f'{MASSBANK_SERVER}{index}')
         lookup_request.raise_for_status()
         spectrum_dict = lookup_request.json()
-        mz, intensity = [], []
-        for peak in spectrum_dict['spectrum'].split():
-            peak_mz, peak_intensity = peak.split(':')
-            mz.append(float(peak_mz))
-            intensity.append(float(peak_intensity))
+        mz, intensity = peak_decoding.decode_peak_string(
+            spectrum_dict['spectrum'])
         precursor_mz = 0
         for metadata in spectrum_dict['metaData']:
             if metadata['name'] == 'precursor m/z':
@@ -196,102 +574,172 @@ def _parse_massbank(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
                 break
         source_link = (f'https://massbank.eu/MassBank/'
                        f'RecordDisplay.jsp?id={index}')
-        return (sus.MsmsSpectrum(usi, precursor_mz, 0, mz, intensity),
+        return (sus.MsmsSpectrum(usi.usi, precursor_mz, 0, mz, intensity),
                 source_link)
     except requests.exceptions.HTTPError:
         raise ValueError('Unknown MassBank USI')
 
 
 # Parse MS2LDA from ms2lda.org.
-def _parse_ms2lda(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
-    match = _match_usi(usi)
-    ms2lda_task_match = ms2lda_task_pattern.match(match.group(2))
+@_register_resolver('ms2lda')
+def _parse_ms2lda(usi: Usi) -> Tuple[sus.MsmsSpectrum, str]:
+    ms2lda_task_match = ms2lda_task_pattern.match(usi.ms_run)
     if ms2lda_task_match is None:
         raise ValueError('Incorrectly formatted MS2LDA task')
     experiment_id = ms2lda_task_match.group(1)
-    index_flag = match.group(3)
-    if index_flag.lower() != 'accession':
+    if usi.index_flag != 'accession':
         raise ValueError('Currently supported MS2LDA index flags: accession')
-    index = match.group(4)
+    index = usi.index
     try:
-        lookup_request = requests.get(
+        lookup_request = upstream.get(
             f'{MS2LDA_SERVER}get_doc/?experiment_id={experiment_id}'
             f'&document_id={index}')
         lookup_request.raise_for_status()
         spectrum_dict = json.loads(lookup_request.text)
         if 'error' in spectrum_dict:
             raise ValueError(f'MS2LDA error: {spectrum_dict["error"]}')
-        mz, intensity = zip(*spectrum_dict['peaks'])
+        mz, intensity = peak_decoding.decode_peak_list(
+            spectrum_dict['peaks'])
         source_link = f'http://ms2lda.org/basicviz/show_doc/{index}/'
-        return sus.MsmsSpectrum(usi, float(spectrum_dict['precursor_mz']), 0,
-                                mz, intensity), source_link
+        return sus.MsmsSpectrum(usi.usi, float(spectrum_dict['precursor_mz']),
+                                0, mz, intensity), source_link
     except requests.exceptions.HTTPError:
         raise ValueError('Unknown MS2LDA USI')
 
 
 # Parse MSV or PXD library.
-def _parse_msv_pxd(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
-    match = _match_usi(usi)
-    dataset_identifier = match.group(1)
-    index_flag = match.group(3)
-    if index_flag.lower() != 'scan':
+@_register_resolver('massive')
+def _parse_msv_pxd(usi: Usi) -> Tuple[sus.MsmsSpectrum, str]:
+    dataset_identifier = usi.collection
+    if usi.index_flag != 'scan':
         raise ValueError('Currently supported MassIVE index flags: scan')
-    scan = match.group(4)
+    scan = usi.index
+    # Read the spectrum from the local mirror of the dataset if available.
+    local_spectrum = local_files.get_spectrum(dataset_identifier, usi.ms_run,
+                                              scan)
+    if local_spectrum is not None:
+        mz, intensity, precursor_mz, charge = local_spectrum
+    else:
+        mz, intensity, precursor_mz, charge = _get_massive_peaks(usi)
+    if dataset_identifier.lower().startswith('pxd'):
+        source_link = (f'http://proteomecentral.proteomexchange.org/'
+                       f'cgi/GetDataset?ID={dataset_identifier}')
+    else:
+        source_link = (f'https://massive.ucsd.edu/ProteoSAFe/'
+                       f'QueryMSV?id={dataset_identifier}')
+    return sus.MsmsSpectrum(usi.usi, precursor_mz, charge, mz,
+                            intensity), source_link
+
+
+def _get_massive_peaks(usi: Usi) \
+        -> Tuple[np.ndarray, np.ndarray, float, int]:
+    # Retrieve the spectrum directly from the file that contained previous
+    # spectra of the same MS run, or find the file that contains it.
+    index = file_index.get_index()
+    spectrum_dict = None
+    file_descriptor = (index.get(usi.collection, usi.ms_run)
+                       if index is not None else None)
+    if index is not None:
+        metrics.cache_requests.inc(
+            cache='file_index',
+            result='hit' if file_descriptor is not None else 'miss')
+    if file_descriptor is not None:
+        try:
+            spectrum_dict = _get_massive_spectrum(file_descriptor, usi.index)
+        except (requests.exceptions.HTTPError,
+                json.decoder.JSONDecodeError) as e:
+            if not _is_massive_miss(e):
+                raise
+    if spectrum_dict is None:
+        file_descriptor, spectrum_dict = _find_massive_spectrum(usi)
+        if index is not None:
+            index.put(usi.collection, usi.ms_run, file_descriptor)
+    mz, intensity = peak_decoding.decode_peak_list(spectrum_dict['peaks'])
+    if 'precursor' in spectrum_dict:
+        precursor_mz = float(spectrum_dict['precursor'].get('mz', 0))
+        charge = int(spectrum_dict['precursor'].get('charge', 0))
+    else:
+        precursor_mz, charge = 0, 0
+    return mz, intensity, precursor_mz, charge
+
+
+def _find_massive_spectrum(usi: Usi) -> Tuple[str, Dict]:
+    # Try all candidate files of the dataset concurrently, and use the first
+    # file that contains the spectrum, preferring the files named after the
+    # MS run.
     try:
-        lookup_url = f'https://massive.ucsd.edu/ProteoSAFe/QuerySpectrum?id={usi}'
-        lookup_request = requests.get(lookup_url)
+        lookup_url = (f'https://massive.ucsd.edu/ProteoSAFe/QuerySpectrum?'
+                      f'id={usi.usi}')
+        lookup_request = upstream.get(lookup_url)
         lookup_request.raise_for_status()
-        for spectrum_file in lookup_request.json()['row_data']:
-            if any(spectrum_file['file_descriptor'].lower().endswith(extension)
-                   for extension in ['mzml', 'mzxml', 'mgf']):
-                request_url = (f'https://gnps.ucsd.edu/ProteoSAFe/'
-                               f'DownloadResultFile?'
-                               f'task=4f2ac74ea114401787a7e96e143bb4a1&'
-                               f'invoke=annotatedSpectrumImageText&block=0&'
-                               f'file=FILE->{spectrum_file["file_descriptor"]}'
-                               f'&scan={scan}&peptide=*..*&force=false&'
-                               f'format=JSON&uploadfile=True')
+        candidates = [
+            spectrum_file['file_descriptor']
+            for spectrum_file in lookup_request.json()['row_data']
+            if file_index.is_peak_file(spectrum_file['file_descriptor'])]
+    except requests.exceptions.HTTPError as e:
+        if not _is_massive_miss(e):
+            raise
+        candidates = []
+    candidates.sort(key=lambda file_descriptor: file_index.get_ms_run(
+        file_descriptor) != usi.ms_run)
+    upstream_error = None
+    if candidates:
+        executor = concurrent.futures.ThreadPoolExecutor(MASSIVE_MAX_PROBES)
+        futures = [executor.submit(_get_massive_spectrum, file_descriptor,
+                                   usi.index)
+                   for file_descriptor in candidates]
+        try:
+            for file_descriptor, future in zip(candidates, futures):
                 try:
-                    spectrum_request = requests.get(request_url)
-                    spectrum_request.raise_for_status()
-                    spectrum_dict = spectrum_request.json()
-                except (requests.exceptions.HTTPError,
-                        json.decoder.JSONDecodeError):
-                    continue
-                mz, intensity = zip(*spectrum_dict['peaks'])
-                if 'precursor' in spectrum_dict:
-                    precursor_mz = float(
-                        spectrum_dict['precursor'].get('mz', 0))
-                    charge = int(spectrum_dict['precursor'].get('charge', 0))
-                else:
-                    precursor_mz, charge = 0, 0
-                if dataset_identifier.lower().startswith('pxd'):
-                    source_link = (
-                        f'http://proteomecentral.proteomexchange.org/'
-                        f'cgi/GetDataset?ID={dataset_identifier}')
-                else:
-                    source_link = (f'https://massive.ucsd.edu/ProteoSAFe/'
-                                   f'QueryMSV?id={dataset_identifier}')
-
-                return sus.MsmsSpectrum(usi, precursor_mz, charge, mz,
-                                        intensity), source_link
-    except requests.exceptions.HTTPError:
-        pass
+                    return file_descriptor, future.result()
+                except (requests.exceptions.RequestException,
+                        json.decoder.JSONDecodeError) as e:
+                    # The spectrum might still be found in another file.
+                    if not _is_massive_miss(e):
+                        upstream_error = e
+        finally:
+            # Don't wait for or probe the remaining candidates.
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+    # Report upstream failures instead of an unknown USI, so that the USI isn't
+    # negatively cached during an outage.
+    if upstream_error is not None:
+        raise upstream_error
     raise ValueError('Unsupported/unknown USI')
 
 
+def _is_massive_miss(error: Exception) -> bool:
+    # Only missing spectra (files) are skipped, whereas upstream failures
+    # (server errors, timeouts) are raised.
+    return (isinstance(error, json.decoder.JSONDecodeError)
+            or (error.response is not None
+                and error.response.status_code == 404))
+
+
+def _get_massive_spectrum(file_descriptor: str, scan: str) -> Dict:
+    request_url = (f'https://gnps.ucsd.edu/ProteoSAFe/DownloadResultFile?'
+                   f'task=4f2ac74ea114401787a7e96e143bb4a1&'
+                   f'invoke=annotatedSpectrumImageText&block=0&'
+                   f'file=FILE->{file_descriptor}&scan={scan}&peptide=*..*&'
+                   f'force=false&format=JSON&uploadfile=True')
+    spectrum_request = upstream.get(request_url)
+    spectrum_request.raise_for_status()
+    return spectrum_request.json()
+
+
 # Parse MOTIFDB from ms2lda.org.
-def _parse_motifdb(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
-    match = _match_usi(usi)
-    index_flag = match.group(3)
-    if index_flag.lower() != 'accession':
+@_register_resolver('motifdb')
+def _parse_motifdb(usi: Usi) -> Tuple[sus.MsmsSpectrum, str]:
+    if usi.index_flag != 'accession':
         raise ValueError('Currently supported MOTIFDB index flags: accession')
-    index = match.group(4)
+    index = usi.index
     try:
-        lookup_request = requests.get(f'{MOTIFDB_SERVER}get_motif/{index}')
+        lookup_request = upstream.get(f'{MOTIFDB_SERVER}get_motif/{index}')
         lookup_request.raise_for_status()
-        mz, intensity = zip(*json.loads(lookup_request.text))
+        mz, intensity = peak_decoding.decode_peak_json(
+            lookup_request.text)
         source_link = f'http://ms2lda.org/motifdb/motif/{index}/'
-        return sus.MsmsSpectrum(usi, 0, 0, mz, intensity), source_link
+        return sus.MsmsSpectrum(usi.usi, 0, 0, mz, intensity), source_link
     except requests.exceptions.HTTPError:
         raise ValueError('Unknown MOTIFDB USI')
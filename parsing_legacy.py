@@ -2,9 +2,10 @@ import functools
 import json
 from typing import Tuple
 
-import requests
 import spectrum_utils.spectrum as sus
 
+import upstream
+
 MS2LDA_SERVER = 'http://ms2lda.org/basicviz/'
 MOTIFDB_SERVER = 'http://ms2lda.org/motifdb/'
 MASSBANK_SERVER = 'https://massbank.us/rest/spectra/'
@@ -13,26 +14,16 @@ MASSBANK_SERVER = 'https://massbank.us/rest/spectra/'
 @functools.lru_cache(100)
 def parse_usi_legacy(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
     usi_identifier = usi.lower().split(':')[1]
-    if usi_identifier.startswith('gnpstask'):
-        return _parse_gnps_task(usi)
-    elif usi_identifier.startswith('gnpslibrary'):
-        return _parse_gnps_library(usi)
-    elif usi_identifier.startswith('ms2ldatask'):
-        return _parse_ms2lda(usi)
-    elif usi_identifier.startswith('pxd'):
-        return _parse_msv_pxd(usi)
-    elif usi_identifier.startswith('msv'):
-        return _parse_msv_pxd(usi)
-    elif usi_identifier.startswith('mtbls'):
-        return _parse_mtbls(usi)
-    elif usi_identifier.startswith('st'):
-        return _parse_metabolomics_workbench(usi)
-    elif usi_identifier.startswith('motifdb'):
-        return _parse_motifdb(usi)
-    elif usi_identifier.startswith('massbank'):
-        return _parse_massbank(usi)
-    else:
-        raise ValueError(f'Unknown USI: {usi}')
+    for prefix, parse in _legacy_parsers:
+        if usi_identifier.startswith(prefix):
+            return parse(usi)
+    raise ValueError(f'Unknown USI: {usi}')
+
+
+def is_legacy_usi(usi: str) -> bool:
+    tokens = usi.lower().split(':')
+    return len(tokens) > 1 and any(tokens[1].startswith(prefix)
+                                   for prefix, _ in _legacy_parsers)
 
 
 # Parse GNPS clustered spectra in Molecular Networking.
@@ -45,7 +36,7 @@ def _parse_gnps_task(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
                    f'task={task}&invoke=annotatedSpectrumImageText&block=0&'
                    f'file=FILE->{filename}&scan={scan}&peptide=*..*&'
                    f'force=false&_=1561457932129&format=JSON')
-    spectrum_dict = requests.get(request_url).json()
+    spectrum_dict = upstream.get(request_url).json()
     mz, intensity = zip(*spectrum_dict['peaks'])
     source_link = f'https://gnps.ucsd.edu/ProteoSAFe/status.jsp?task={task}'
     if 'precursor' in spectrum_dict:
@@ -63,7 +54,7 @@ def _parse_gnps_library(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
     identifier = tokens[2]
     request_url = (f'https://gnps.ucsd.edu/ProteoSAFe/SpectrumCommentServlet?'
                    f'SpectrumID={identifier}')
-    spectrum_dict = requests.get(request_url).json()
+    spectrum_dict = upstream.get(request_url).json()
     mz, intensity = zip(*json.loads(
         spectrum_dict['spectruminfo']['peaks_json']))
     source_link = (f'https://gnps.ucsd.edu/ProteoSAFe/'
@@ -80,7 +71,7 @@ def _parse_ms2lda(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
     document_id = tokens[3]
     request_url = (f'{MS2LDA_SERVER}get_doc/?experiment_id={experiment_id}'
                    f'&document_id={document_id}')
-    spectrum_dict = json.loads(requests.get(request_url).text)
+    spectrum_dict = json.loads(upstream.get(request_url).text)
     mz, intensity = zip(*spectrum_dict['peaks'])
     source_link = f'http://ms2lda.org/basicviz/show_doc/{document_id}/'
     return sus.MsmsSpectrum(usi, float(spectrum_dict['precursor_mz']), 1, mz,
@@ -96,7 +87,7 @@ def _parse_msv_pxd(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
     lookup_url = (f'https://massive.ucsd.edu/ProteoSAFe/QuerySpectrum?'
                   f'id=mzspec:{dataset_identifier}:{filename}:scan:{scan}')
     usi_resolvable = False
-    for spectrum_file in requests.get(lookup_url).json()['row_data']:
+    for spectrum_file in upstream.get(lookup_url).json()['row_data']:
         try:
             usi_resolvable = any(
                 spectrum_file['file_descriptor'].lower().endswith(extension)
@@ -109,7 +100,7 @@ def _parse_msv_pxd(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
                                f'file=FILE->{spectrum_file["file_descriptor"]}'
                                f'&scan={scan}&peptide=*..*&force=false&'
                                f'format=JSON&uploadfile=True')
-                spectrum_dict = requests.get(request_url).json()
+                spectrum_dict = upstream.get(request_url).json()
                 mz, intensity = zip(*spectrum_dict['peaks'])
 
                 precursor_mz = 0
@@ -143,7 +134,7 @@ def _parse_mtbls(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
     dataset_identifier = tokens[1]
     filename = tokens[2]
     scan = tokens[4]
-    for dataset in requests.get('https://massive.ucsd.edu/ProteoSAFe/'
+    for dataset in upstream.get('https://massive.ucsd.edu/ProteoSAFe/'
                                 'datasets_json.jsp').json()['datasets']:
         if dataset_identifier in dataset['title']:
             source_link = (f'https://www.ebi.ac.uk/'
@@ -158,7 +149,7 @@ def _parse_metabolomics_workbench(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
     dataset_identifier = tokens[1]
     filename = tokens[2]
     scan = tokens[4]
-    for dataset in requests.get('https://massive.ucsd.edu/ProteoSAFe/'
+    for dataset in upstream.get('https://massive.ucsd.edu/ProteoSAFe/'
                                 'datasets_json.jsp').json()['datasets']:
         if dataset_identifier in dataset['title']:
             source_link = (f'https://www.metabolomicsworkbench.org/'
@@ -175,7 +166,7 @@ def _parse_motifdb(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
     tokens = usi.split(':')
     motif_id = tokens[3]
     request_url = f'{MOTIFDB_SERVER}get_motif/{motif_id}'
-    mz, intensity = zip(*json.loads(requests.get(request_url).text))
+    mz, intensity = zip(*json.loads(upstream.get(request_url).text))
     source_link = f'http://ms2lda.org/motifdb/motif/{motif_id}/'
     return sus.MsmsSpectrum(usi, 0, 1, mz, intensity), source_link
 
@@ -186,7 +177,7 @@ def _parse_massbank(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
     tokens = usi.split(':')
     massbank_id = tokens[2]
     request_url = f'{MASSBANK_SERVER}{massbank_id}'
-    response = requests.get(request_url)
+    response = upstream.get(request_url)
     spectrum_dict = response.json()
     mz, intensity = [], []
     for peak in spectrum_dict['spectrum'].split():
@@ -201,3 +192,16 @@ def _parse_massbank(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
     source_link = (f'https://massbank.eu/MassBank/'
                    f'RecordDisplay.jsp?id={massbank_id}')
     return sus.MsmsSpectrum(usi, precursor_mz, 1, mz, intensity), source_link
+
+
+_legacy_parsers = [
+    ('gnpstask', _parse_gnps_task),
+    ('gnpslibrary', _parse_gnps_library),
+    ('ms2ldatask', _parse_ms2lda),
+    ('pxd', _parse_msv_pxd),
+    ('msv', _parse_msv_pxd),
+    ('mtbls', _parse_mtbls),
+    ('st', _parse_metabolomics_workbench),
+    ('motifdb', _parse_motifdb),
+    ('massbank', _parse_massbank),
+]
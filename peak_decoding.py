@@ -0,0 +1,119 @@
+import itertools
+import json
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+
+# Separators to convert peaks JSON to whitespace-separated values.
+_peak_json_separators = bytes.maketrans(b'[],', b'   ')
+# Characters of numbers, which are removed to check the structure of the
+# peaks.
+_number_characters = b'0123456789+-.eE \t\n\r'
+
+
+def decode_peak_string(peaks: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Decode peaks formatted as "mz:intensity mz:intensity ..." (MassBank).
+
+    Parameters
+    ----------
+    peaks : str
+        The peak string.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        The m/z and intensity arrays.
+    """
+    num_peaks = peaks.count(':')
+    values = None
+    if _get_structure(peaks) == b':' * num_peaks:
+        values = _parse_values(peaks.encode().replace(b':', b' '),
+                               2 * num_peaks)
+    if values is None:
+        raise ValueError('Incorrectly formatted peaks')
+    return _split_values(values)
+
+
+def decode_peak_list(peaks: Sequence[Sequence[float]]) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Decode peaks formatted as a list of [mz, intensity] pairs (parsed JSON).
+
+    Parameters
+    ----------
+    peaks : Sequence[Sequence[float]]
+        The (m/z, intensity) pairs.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        The m/z and intensity arrays.
+    """
+    if len(peaks) == 0:
+        raise ValueError('No peaks found')
+    try:
+        if any(len(peak) != 2 for peak in peaks):
+            raise ValueError('Incorrectly formatted peaks')
+    except TypeError:
+        raise ValueError('Incorrectly formatted peaks')
+    return _split_values(np.fromiter(itertools.chain.from_iterable(peaks),
+                                     np.float64, 2 * len(peaks)))
+
+
+def decode_peak_json(peaks: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Decode peaks formatted as a JSON string of [mz, intensity] pairs.
+
+    Parameters
+    ----------
+    peaks : str
+        The peaks JSON string.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        The m/z and intensity arrays.
+    """
+    # Parse the numbers directly if the JSON only consists of pairs of
+    # numbers.
+    num_peaks = peaks.count('[') - 1
+    values = None
+    if _get_structure(peaks) == (
+            b'[' + b'[,],' * (num_peaks - 1) + b'[,]' if num_peaks > 0
+            else b'[') + b']':
+        values = _parse_values(peaks.encode().translate(
+            _peak_json_separators), 2 * num_peaks)
+    if values is None:
+        peak_list = json.loads(peaks)
+        if not isinstance(peak_list, list):
+            raise ValueError('Incorrectly formatted peaks')
+        return decode_peak_list(peak_list)
+    return _split_values(values)
+
+
+def _get_structure(peaks: str) -> Optional[bytes]:
+    # The peaks without the numbers and whitespace, e.g. b'[[,],[,]]'.
+    try:
+        return peaks.encode('ascii').translate(None, _number_characters)
+    except UnicodeEncodeError:
+        return None
+
+
+def _parse_values(peaks: bytes, num_values: int) -> Optional[np.ndarray]:
+    # Malformed numbers raise a ValueError, unlike with `np.fromstring`.
+    try:
+        values = np.array(peaks.split(), np.float64)
+    except ValueError:
+        return None
+    return values if len(values) == num_values else None
+
+
+def _split_values(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    if len(values) == 0:
+        raise ValueError('No peaks found')
+    # Return strided views on the interleaved values, which are copied only
+    # once into the spectrum arrays.
+    peaks = values.reshape(-1, 2)
+    return peaks[:, 0], peaks[:, 1]
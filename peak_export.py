@@ -0,0 +1,191 @@
+import base64
+import io
+import json
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+from spectrum_utils import spectrum as sus
+
+
+# Number of peaks that are formatted at once while streaming the peaks of a
+# spectrum, to bound the memory used by the intermediate Python objects.
+EXPORT_CHUNK_SIZE = 10000
+
+# Peaks are exported as little-endian 32-bit floats (the precision in which
+# spectrum_utils stores them), as in the binary data arrays of mzML.
+BINARY_DTYPE = '<f4'
+
+# Intensities are quantized relative to the base peak in this many steps in
+# the compact delta-encoded peaks.
+DELTA_INTENSITY_SCALE = 10000
+
+_JSON_SEPARATORS = (',', ':')
+
+
+def iter_json(value, decimals: Optional[int] = None) -> Iterator[str]:
+    """
+    Serialize a value to compact JSON in chunks.
+
+    Dictionaries are serialized with sorted keys (as `flask.jsonify`). NumPy
+    arrays are serialized as (nested) lists of numbers and tuples of
+    equal-length NumPy arrays as lists of rows (e.g. `(mz, intensity)` as a
+    list of `[mz, intensity]` peaks), which are formatted `EXPORT_CHUNK_SIZE`
+    rows (or whole rows of multidimensional arrays up to `EXPORT_CHUNK_SIZE`
+    elements) at a time instead of converting the full arrays to Python
+    objects.
+
+    Parameters
+    ----------
+    value
+        The value to serialize.
+    decimals : Optional[int]
+        The number of decimals to which floats in NumPy arrays are rounded,
+        or None to not round them.
+
+    Returns
+    -------
+    Iterator[str]
+        Consecutive chunks of the JSON document.
+    """
+    if isinstance(value, dict):
+        yield '{'
+        for i, key in enumerate(sorted(value)):
+            yield f'{"," if i > 0 else ""}{json.dumps(key)}:'
+            yield from iter_json(value[key], decimals)
+        yield '}'
+    elif isinstance(value, np.ndarray) or (
+            isinstance(value, tuple) and len(value) > 0
+            and all(isinstance(column, np.ndarray) for column in value)):
+        columns = (value,) if isinstance(value, np.ndarray) else value
+        chunk_size = EXPORT_CHUNK_SIZE
+        if columns[0].ndim > 1 and len(columns[0]) > 0:
+            chunk_size = max(1, EXPORT_CHUNK_SIZE // columns[0][0].size)
+        yield '['
+        for start in range(0, len(columns[0]), chunk_size):
+            chunk = [column[start:start + chunk_size] for column in columns]
+            # Convert to float64 so that the numbers are formatted as
+            # `float(value)` instead of as their float32 representation.
+            # Integers are formatted as integers.
+            chunk = (chunk[0] if len(chunk) == 1 else np.column_stack(chunk))
+            if chunk.dtype.kind not in 'iu':
+                chunk = chunk.astype(np.float64)
+                if decimals is not None:
+                    chunk = chunk.round(decimals)
+            yield ((',' if start > 0 else '') + json.dumps(
+                chunk.tolist(), separators=_JSON_SEPARATORS)[1:-1])
+        yield ']'
+    elif isinstance(value, list):
+        yield '['
+        for i, element in enumerate(value):
+            if i > 0:
+                yield ','
+            yield from iter_json(element, decimals)
+        yield ']'
+    else:
+        yield json.dumps(value, separators=_JSON_SEPARATORS)
+
+
+def iter_csv(spectrum: sus.MsmsSpectrum) -> Iterator[str]:
+    """
+    Export the peaks of a spectrum as CSV in chunks.
+
+    Parameters
+    ----------
+    spectrum : sus.MsmsSpectrum
+        The spectrum to export.
+
+    Returns
+    -------
+    Iterator[str]
+        The header row, followed by chunks of `mz,intensity` rows (formatted
+        identical to `csv.writer`).
+    """
+    yield 'mz,intensity\r\n'
+    for start in range(0, len(spectrum.mz), EXPORT_CHUNK_SIZE):
+        stop = start + EXPORT_CHUNK_SIZE
+        yield ''.join([
+            f'{mz},{intensity}\r\n' for mz, intensity in zip(
+                spectrum.mz[start:stop].astype(str).tolist(),
+                spectrum.intensity[start:stop].astype(str).tolist())])
+
+
+def iter_npy(spectrum: sus.MsmsSpectrum) -> Iterator[bytes]:
+    """
+    Export the peaks of a spectrum in the NumPy `.npy` format in chunks.
+
+    Parameters
+    ----------
+    spectrum : sus.MsmsSpectrum
+        The spectrum to export.
+
+    Returns
+    -------
+    Iterator[bytes]
+        The `.npy` header, followed by chunks of the (n_peaks, 2) array with
+        the m/z and intensity per peak as little-endian 32-bit floats.
+    """
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(header, {
+        'descr': BINARY_DTYPE, 'fortran_order': False,
+        'shape': (len(spectrum.mz), 2)})
+    yield header.getvalue()
+    for start in range(0, len(spectrum.mz), EXPORT_CHUNK_SIZE):
+        stop = start + EXPORT_CHUNK_SIZE
+        yield np.column_stack(
+            (spectrum.mz[start:stop], spectrum.intensity[start:stop])
+        ).astype(BINARY_DTYPE, copy=False).tobytes()
+
+
+def get_base64_arrays(spectrum: sus.MsmsSpectrum) -> Tuple[str, str]:
+    """
+    Encode the peaks of a spectrum as base64 binary arrays.
+
+    Parameters
+    ----------
+    spectrum : sus.MsmsSpectrum
+        The spectrum to export.
+
+    Returns
+    -------
+    Tuple[str, str]
+        The base64-encoded m/z and intensity arrays of little-endian 32-bit
+        floats.
+    """
+    return _to_base64(spectrum.mz), _to_base64(spectrum.intensity)
+
+
+def get_delta_arrays(spectrum: sus.MsmsSpectrum, mz_decimals: int) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Encode the peaks of a spectrum compactly as small integers.
+
+    The m/z values are rounded to the given number of decimals and encoded
+    as the integer difference with the previous peak (the first peak as its
+    m/z value), and the intensities relative to the base peak in
+    `DELTA_INTENSITY_SCALE` steps. They're decoded as
+    `cumsum(mz) / 10 ** mz_decimals` and `intensity / DELTA_INTENSITY_SCALE`.
+
+    Parameters
+    ----------
+    spectrum : sus.MsmsSpectrum
+        The spectrum to export, with its peaks sorted by m/z.
+    mz_decimals : int
+        The number of decimals of the m/z values.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        The delta-encoded m/z and quantized intensity arrays of integers.
+    """
+    mz = np.round(spectrum.mz.astype(np.float64)
+                  * 10 ** mz_decimals).astype(np.int64)
+    intensity = spectrum.intensity.astype(np.float64)
+    if len(intensity) > 0 and intensity.max() > 0:
+        intensity = intensity / intensity.max()
+    return (np.diff(mz, prepend=0),
+            np.round(intensity * DELTA_INTENSITY_SCALE).astype(np.int64))
+
+
+def _to_base64(array: np.ndarray) -> str:
+    return base64.b64encode(
+        array.astype(BINARY_DTYPE, copy=False).tobytes()).decode('ascii')
@@ -0,0 +1,151 @@
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Callable, Dict, Set
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Number of following and preceding scans of the same GNPS task file that are
+# resolved in the background after a GNPS task spectrum is requested, or 0 to
+# disable prefetching.
+PREFETCH_SCANS = int(os.environ.get('PREFETCH_SCANS', 0))
+# Maximum number of background upstream lookups per second per host.
+# Can be specified per host as a comma-separated list of host=rate pairs in
+# the PREFETCH_RATES environment variable.
+PREFETCH_DEFAULT_RATE = float(os.environ.get('PREFETCH_DEFAULT_RATE', 2))
+prefetch_rates = {}
+for _prefetch_rate in filter(
+        None, os.environ.get('PREFETCH_RATES', '').split(',')):
+    _host, _rate = _prefetch_rate.split('=', 1)
+    prefetch_rates[_host.strip()] = float(_rate)
+# Maximum number of queued prefetches per worker process, further prefetches
+# are dropped.
+PREFETCH_MAX_PENDING = int(os.environ.get('PREFETCH_MAX_PENDING', 1000))
+# Number of background threads per worker process that prefetch spectra.
+PREFETCH_THREADS = int(os.environ.get('PREFETCH_THREADS', 2))
+
+
+class RateLimiter:
+    """
+    Token bucket that limits the rate of (bursts of) calls.
+    """
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """
+        Wait until a call is allowed.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens
+                               + (now - self._updated) * self.rate)
+            self._updated = now
+            # Reserve a token, waiting for it outside of the lock if it's not
+            # available yet.
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Prefetcher:
+    """
+    Resolve keys (e.g. USIs) in background threads, with a limited rate of
+    upstream lookups per host.
+
+    Keys are queued at most once at a time, and are skipped if they're
+    already cached when their turn comes.
+    """
+
+    def __init__(self, resolve: Callable[[str], object],
+                 is_cached: Callable[[str], bool],
+                 max_pending: int = PREFETCH_MAX_PENDING,
+                 num_threads: int = PREFETCH_THREADS) -> None:
+        self.resolve = resolve
+        self.is_cached = is_cached
+        self.max_pending = max_pending
+        self.num_threads = num_threads
+        self._pending: Set[str] = set()
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._rate_limiters: Dict[str, RateLimiter] = {}
+
+    def submit(self, key: str, host: str) -> bool:
+        """
+        Queue a key to be resolved in the background.
+
+        Parameters
+        ----------
+        key : str
+            The key to resolve.
+        host : str
+            The upstream host from which the key is resolved, whose rate
+            limit applies.
+
+        Returns
+        -------
+        bool
+            True if the key is queued (or already pending), False if it's
+            dropped because the queue is full.
+        """
+        with self._lock:
+            if key in self._pending:
+                return True
+            if len(self._pending) >= self.max_pending:
+                metrics.prefetch_requests.inc(result='dropped')
+                return False
+            self._pending.add(key)
+            # The threads are started on first use, in the worker process
+            # rather than in a (forking) master process.
+            if not self._threads:
+                for _ in range(self.num_threads):
+                    thread = threading.Thread(target=self._run, daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+        metrics.prefetch_requests.inc(result='queued')
+        self._queue.put((key, host))
+        return True
+
+    def join(self) -> None:
+        """
+        Wait until all queued keys are resolved.
+        """
+        self._queue.join()
+
+    def _run(self) -> None:
+        while True:
+            key, host = self._queue.get()
+            try:
+                if self.is_cached(key):
+                    metrics.prefetch_requests.inc(result='cached')
+                else:
+                    self._get_rate_limiter(host).acquire()
+                    self.resolve(key)
+                    metrics.prefetch_requests.inc(result='resolved')
+            except Exception as e:
+                logger.debug('Unable to prefetch %s: %s', key, e)
+                metrics.prefetch_requests.inc(result='failed')
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+                self._queue.task_done()
+
+    def _get_rate_limiter(self, host: str) -> RateLimiter:
+        with self._lock:
+            rate_limiter = self._rate_limiters.get(host)
+            if rate_limiter is None:
+                rate_limiter = self._rate_limiters[host] = RateLimiter(
+                    prefetch_rates.get(host, PREFETCH_DEFAULT_RATE))
+            return rate_limiter
@@ -0,0 +1,186 @@
+import collections
+import datetime
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Byte budget of the in-memory render cache.
+RENDER_CACHE_MAX_BYTES = int(os.environ.get('RENDER_CACHE_MAX_BYTES',
+                                            256 * 1024 ** 2))
+# Optional directory of the on-disk render cache tier, shared between the
+# worker processes.
+RENDER_CACHE_DIR = os.environ.get('RENDER_CACHE_DIR', '')
+RENDER_CACHE_DIR_MAX_BYTES = int(os.environ.get('RENDER_CACHE_DIR_MAX_BYTES',
+                                                4 * 1024 ** 3))
+# Bump to invalidate previously rendered images when the figure style changes.
+RENDER_CACHE_VERSION = 2
+# Interval (in seconds) at which workers rescan the on-disk tier to account
+# for the figures written by other workers.
+RENDER_CACHE_SCAN_INTERVAL = 60
+
+RenderedFigure = collections.namedtuple(
+    'RenderedFigure', ['data', 'etag', 'last_modified', 'expires'])
+
+
+def get_key(usis: List[str], extension: str,
+            plotting_args: Dict[str, Any]) -> str:
+    """
+    Get the cache key of a figure.
+
+    Parameters
+    ----------
+    usis : List[str]
+        The USI(s) of the plotted spectra.
+    extension : str
+        The image format.
+    plotting_args : Dict[str, Any]
+        The plotting arguments (see `views._get_plotting_args`).
+
+    Returns
+    -------
+    str
+        A hash of the canonicalized figure inputs.
+    """
+    canonical = json.dumps({'version': RENDER_CACHE_VERSION,
+                            'usis': usis,
+                            'extension': extension,
+                            'plotting_args': plotting_args},
+                           sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class RenderCache:
+    """
+    Cache of rendered figures consisting of a byte-budgeted in-memory LRU
+    cache with an optional on-disk tier.
+
+    Figures expire after a time-to-live, so that they aren't served after the
+    spectra they were rendered from have expired.
+    """
+
+    def __init__(self, max_bytes: int, directory: Optional[str] = None,
+                 directory_max_bytes: int = 0) -> None:
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.directory_max_bytes = directory_max_bytes
+        self._figures = collections.OrderedDict()
+        self._size = 0
+        self._directory_size = 0
+        self._next_scan = 0.
+        self._lock = threading.Lock()
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def get(self, key: str) -> Optional[RenderedFigure]:
+        with self._lock:
+            figure = self._figures.get(key)
+            if figure is not None:
+                if figure.expires < time.time():
+                    del self._figures[key]
+                    self._size -= len(figure.data)
+                    return None
+                self._figures.move_to_end(key)
+                return figure
+        if self.directory:
+            figure = self._read(key)
+            if figure is not None:
+                self._put_memory(key, figure)
+            return figure
+        return None
+
+    def put(self, key: str, data: bytes, ttl: float) -> RenderedFigure:
+        now = time.time()
+        figure = RenderedFigure(
+            data, hashlib.md5(data).hexdigest(),
+            datetime.datetime.fromtimestamp(int(now), datetime.timezone.utc),
+            int(now + ttl))
+        self._put_memory(key, figure)
+        if self.directory:
+            self._write(key, figure)
+        return figure
+
+    def _put_memory(self, key: str, figure: RenderedFigure) -> None:
+        with self._lock:
+            previous = self._figures.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous.data)
+            self._figures[key] = figure
+            self._size += len(figure.data)
+            while self._size > self.max_bytes and self._figures:
+                _, evicted = self._figures.popitem(last=False)
+                self._size -= len(evicted.data)
+
+    def _read(self, key: str) -> Optional[RenderedFigure]:
+        # Files start with the creation and expiration timestamps.
+        filename = os.path.join(self.directory, key)
+        try:
+            with open(filename, 'rb') as f_in:
+                header, data = f_in.read(16), f_in.read()
+            if len(header) < 16:
+                return None
+            created = int.from_bytes(header[:8], 'little')
+            expires = int.from_bytes(header[8:], 'little')
+            if expires < time.time():
+                return None
+            # Mark the file as recently used for the LRU eviction.
+            os.utime(filename)
+        except OSError:
+            return None
+        return RenderedFigure(
+            data, hashlib.md5(data).hexdigest(),
+            datetime.datetime.fromtimestamp(created, datetime.timezone.utc),
+            expires)
+
+    def _write(self, key: str, figure: RenderedFigure) -> None:
+        try:
+            fd, tmp_filename = tempfile.mkstemp(dir=self.directory,
+                                                suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f_out:
+                f_out.write(int(figure.last_modified.timestamp())
+                            .to_bytes(8, 'little'))
+                f_out.write(int(figure.expires).to_bytes(8, 'little'))
+                f_out.write(figure.data)
+            os.replace(tmp_filename, os.path.join(self.directory, key))
+            self._evict_directory(16 + len(figure.data))
+        except OSError as e:
+            logger.warning('Unable to store rendered figure %s: %s', key, e)
+
+    def _evict_directory(self, written_bytes: int) -> None:
+        # The size of the directory is tracked per worker and only recomputed
+        # by scanning it when it exceeds the budget or periodically.
+        with self._lock:
+            self._directory_size += written_bytes
+            now = time.monotonic()
+            if (self._directory_size <= self.directory_max_bytes
+                    and now < self._next_scan):
+                return
+            self._next_scan = now + RENDER_CACHE_SCAN_INTERVAL
+        directory_size = self._scan_and_evict_directory()
+        with self._lock:
+            self._directory_size = directory_size
+
+    def _scan_and_evict_directory(self) -> int:
+        with os.scandir(self.directory) as it:
+            files = [(entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                     for entry in it if not entry.name.endswith('.tmp')]
+        total_bytes = sum(size for _, size, _ in files)
+        for _, size, filename in sorted(files):
+            if total_bytes <= self.directory_max_bytes:
+                break
+            try:
+                os.unlink(filename)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+        return total_bytes
+
+
+cache = RenderCache(RENDER_CACHE_MAX_BYTES, RENDER_CACHE_DIR,
+                    RENDER_CACHE_DIR_MAX_BYTES)
@@ -0,0 +1,301 @@
+import concurrent.futures
+import io
+import multiprocessing
+import os
+import threading
+from typing import Callable, Optional
+
+import matplotlib
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from spectrum_utils import plot as sup, spectrum as sus
+
+import concurrency
+
+matplotlib.use('Agg')
+
+# Number of dedicated renderer processes per server worker. If 0, or when
+# serving from cooperative gevent workers, figures are rendered in the server
+# worker itself.
+RENDER_PROCESSES = int(os.environ.get('RENDER_PROCESSES', 0))
+# Maximum number of figures that are queued or being rendered per server
+# worker, and how long (in seconds) a request waits for a free slot before
+# being rejected.
+RENDER_MAX_PENDING = int(os.environ.get('RENDER_MAX_PENDING',
+                                        4 * max(RENDER_PROCESSES, 1)))
+RENDER_QUEUE_TIMEOUT = float(os.environ.get('RENDER_QUEUE_TIMEOUT', 30))
+
+# Colors for mirror plot peaks, subject to change.
+sup.colors['top'] = '#212121'
+sup.colors['bottom'] = '#388E3C'
+sup.colors['unmatched'] = 'darkgray'
+
+
+class RenderQueueFullError(Exception):
+    """
+    Raised when no figure can be rendered because too many figures are
+    pending.
+    """
+
+
+def render_spectrum(usi: str, spectrum: sus.MsmsSpectrum, url: str,
+                    extension: str, **kwargs) -> bytes:
+    """
+    Render a spectrum plot.
+
+    Parameters
+    ----------
+    usi : str
+        The USI of the spectrum, used as the figure title.
+    spectrum : sus.MsmsSpectrum
+        The spectrum to plot, with the intensities scaled and the peaks to
+        label annotated.
+    url : str
+        The URL that the title links to (in SVG figures).
+    extension : str
+        The image format.
+    kwargs
+        The plotting arguments (see `views._get_plotting_args`).
+
+    Returns
+    -------
+    bytes
+        The rendered figure.
+    """
+    fig, ax = _create_figure(kwargs['width'], kwargs['height'])
+
+    sup.spectrum(
+        spectrum,
+        annotate_ions=kwargs['annotate_peaks'],
+        annot_kws={'rotation': kwargs['annotation_rotation'], 'clip_on': True},
+        grid=kwargs['grid'], ax=ax,
+    )
+
+    ax.set_xlim(kwargs['mz_min'], kwargs['mz_max'])
+    ax.set_ylim(0, kwargs['max_intensity'])
+
+    if not kwargs['grid']:
+        _hide_spines(ax)
+
+    title = ax.text(0.5, 1.06, usi, horizontalalignment='center',
+                    verticalalignment='bottom', fontsize='x-large',
+                    fontweight='bold', transform=ax.transAxes)
+    title.set_url(url)
+    subtitle = (f'Precursor m/z: '
+                f'{spectrum.precursor_mz:.{kwargs["annotate_precision"]}f} '
+                if spectrum.precursor_mz > 0 else '')
+    subtitle += f'Charge: {spectrum.precursor_charge}'
+    subtitle = ax.text(0.5, 1.02, subtitle, horizontalalignment='center',
+                       verticalalignment='bottom', fontsize='large',
+                       transform=ax.transAxes)
+    subtitle.set_url(url)
+
+    return _save_figure(fig, extension)
+
+
+def render_mirror(usi1: str, usi2: str, spectrum_top: sus.MsmsSpectrum,
+                  spectrum_bottom: sus.MsmsSpectrum,
+                  similarity: Optional[float], url: str, extension: str,
+                  **kwargs) -> bytes:
+    """
+    Render a mirror plot.
+
+    Parameters
+    ----------
+    usi1 : str
+        The USI of the top spectrum.
+    usi2 : str
+        The USI of the bottom spectrum.
+    spectrum_top : sus.MsmsSpectrum
+        The top spectrum, with the matching peaks annotated.
+    spectrum_bottom : sus.MsmsSpectrum
+        The bottom spectrum, with the matching peaks annotated.
+    similarity : Optional[float]
+        The cosine similarity between both spectra, or None if the similarity
+        shouldn't be shown.
+    url : str
+        The URL that the titles link to (in SVG figures).
+    extension : str
+        The image format.
+    kwargs
+        The plotting arguments (see `views._get_plotting_args`).
+
+    Returns
+    -------
+    bytes
+        The rendered figure.
+    """
+    fig, ax = _create_figure(kwargs['width'], kwargs['height'])
+
+    sup.mirror(spectrum_top, spectrum_bottom,
+               {'annotate_ions': kwargs['annotate_peaks'],
+                'annot_kws': {'rotation': kwargs['annotation_rotation'],
+                              'clip_on': True},
+                'grid': kwargs['grid']}, ax=ax)
+
+    ax.set_xlim(kwargs['mz_min'], kwargs['mz_max'])
+    ax.set_ylim(-kwargs['max_intensity'], kwargs['max_intensity'])
+
+    if not kwargs['grid']:
+        _hide_spines(ax)
+
+    text_y = 1.2 if similarity is not None else 1.15
+    for usi, spec, loc in zip([usi1, usi2], [spectrum_top, spectrum_bottom],
+                              ['Top', 'Bottom']):
+        title = ax.text(0.5, text_y, f'{loc}: {usi}',
+                        horizontalalignment='center',
+                        verticalalignment='bottom',
+                        fontsize='x-large',
+                        fontweight='bold',
+                        transform=ax.transAxes)
+        title.set_url(url)
+        text_y -= 0.04
+        subtitle = (
+            f'Precursor $m$/$z$: '
+            f'{spec.precursor_mz:.{kwargs["annotate_precision"]}f} '
+            if spec.precursor_mz > 0 else '')
+        subtitle += f'Charge: {spec.precursor_charge}'
+        subtitle = ax.text(0.5, text_y, subtitle, horizontalalignment='center',
+                           verticalalignment='bottom', fontsize='large',
+                           transform=ax.transAxes)
+        subtitle.set_url(url)
+        text_y -= 0.06
+
+    if similarity is not None:
+        subtitle_score = f'Cosine similarity = {similarity:.4f}'
+        ax.text(0.5, text_y, subtitle_score, horizontalalignment='center',
+                verticalalignment='bottom', fontsize='x-large',
+                fontweight='bold', transform=ax.transAxes)
+
+    return _save_figure(fig, extension)
+
+
+def _create_figure(width: float, height: float):
+    # Use the object-oriented API instead of the global pyplot state machine
+    # so that figures can be rendered concurrently.
+    fig = Figure(figsize=(width, height))
+    FigureCanvasAgg(fig)
+    return fig, fig.add_subplot()
+
+
+def _hide_spines(ax) -> None:
+    ax.spines['right'].set_visible(False)
+    ax.spines['top'].set_visible(False)
+    ax.yaxis.set_ticks_position('left')
+    ax.xaxis.set_ticks_position('bottom')
+
+
+def _save_figure(fig: Figure, extension: str) -> bytes:
+    buf = io.BytesIO()
+    fig.savefig(buf, bbox_inches='tight', format=extension)
+    return buf.getvalue()
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_pending = threading.BoundedSemaphore(RENDER_MAX_PENDING)
+_warmed_up = False
+
+
+def render(render_function: Callable[..., bytes], *args, **kwargs) -> bytes:
+    """
+    Render a figure in one of the renderer processes.
+
+    Parameters
+    ----------
+    render_function : Callable[..., bytes]
+        The function that renders the figure (`render_spectrum` or
+        `render_mirror`).
+    args, kwargs
+        The arguments of the render function.
+
+    Returns
+    -------
+    bytes
+        The rendered figure.
+
+    Raises
+    ------
+    RenderQueueFullError
+        If too many figures are pending.
+    """
+    if not _pending.acquire(timeout=RENDER_QUEUE_TIMEOUT):
+        raise RenderQueueFullError('Too many figures are being rendered')
+    try:
+        pool = _get_pool()
+        if pool is None:
+            return concurrency.run_cpu_bound(render_function, *args, **kwargs)
+        try:
+            return pool.submit(render_function, *args, **kwargs).result()
+        except concurrent.futures.process.BrokenProcessPool:
+            _reset_pool(pool)
+            raise
+    finally:
+        _pending.release()
+
+
+def _get_pool() -> Optional[concurrent.futures.ProcessPoolExecutor]:
+    global _pool, _pool_pid
+    # The process pool's management thread and pipes don't work with the
+    # gevent-patched standard library, so cooperative workers render figures
+    # in a native thread instead.
+    if RENDER_PROCESSES <= 0 or concurrency.is_cooperative():
+        return None
+    # Each (forked) server worker has its own renderer processes.
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = concurrent.futures.ProcessPoolExecutor(
+                    RENDER_PROCESSES,
+                    multiprocessing.get_context('spawn'),
+                    initializer=_warm_up)
+                _pool_pid = os.getpid()
+                # Start all renderer processes upfront instead of on demand.
+                for _ in range(RENDER_PROCESSES):
+                    _pool.submit(int)
+    return _pool
+
+
+def _reset_pool(pool: concurrent.futures.ProcessPoolExecutor) -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def warm_up(start_processes: bool = True) -> None:
+    """
+    Prepare rendering before the first figure is requested: start the
+    renderer processes, or load the fonts and initialize the renderers in
+    this process if figures are rendered in the server worker itself.
+
+    Parameters
+    ----------
+    start_processes : bool
+        Whether to start the renderer processes (if enabled). If False, only
+        this process is warmed up, e.g. to share the loaded fonts with the
+        server workers that are forked from it.
+    """
+    if (start_processes and _get_pool() is not None) or _warmed_up:
+        return
+    _warm_up()
+
+
+def _warm_up() -> None:
+    global _warmed_up
+    # Render a small annotated mirror plot to load the fonts and initialize
+    # the renderers before the first job arrives.
+    mz = np.linspace(100, 1000, 10, dtype=np.float32)
+    spectrum = sus.MsmsSpectrum('warm-up', 500., 1, mz, np.ones_like(mz))
+    spectrum.annotation = np.full_like(mz, None, object)
+    spectrum.annotation[0] = sus.FragmentAnnotation(0, mz[0], 'm/z')
+    spectrum.annotation[0].ion_type = 'top'
+    for extension in ('png', 'svg'):
+        render_mirror('warm-up', 'warm-up', spectrum, spectrum, 1., '',
+                      extension, width=1, height=1, annotate_peaks=True,
+                      annotation_rotation=90, grid=True, mz_min=None,
+                      mz_max=None, max_intensity=1.5, annotate_precision=4)
+    _warmed_up = True
@@ -1,4 +1,11 @@
 #!/bin/bash
 source activate usi
 
-gunicorn -w 2 -b 0.0.0.0:5000 --timeout 3600 main:app --access-logfile /app/logs/access.log --max-requests 1000
+# SERVER_MODE=async serves requests from cooperative gevent workers, in which
+# upstream lookups don't block the worker and rendering runs in a separate
+# thread, so that many concurrent requests can share one process.
+if [ "$SERVER_MODE" = "async" ]; then
+    gunicorn -c gunicorn.conf.py -k gevent --worker-connections ${WORKER_CONNECTIONS:-1000} -w 2 -b 0.0.0.0:5000 --timeout 3600 main:app --access-logfile /app/logs/access.log --max-requests 1000
+else
+    gunicorn -c gunicorn.conf.py -w 2 -b 0.0.0.0:5000 --timeout 3600 main:app --access-logfile /app/logs/access.log --max-requests 1000
+fi
@@ -0,0 +1,284 @@
+import collections
+import threading
+from typing import Sequence, Tuple
+
+import numba as nb
+import numpy as np
+from spectrum_utils import spectrum as sus
+
+
+SpectrumTuple = collections.namedtuple(
+    'SpectrumTuple', ['precursor_mz', 'precursor_charge', 'mz', 'intensity'])
+
+# Numba's default threading layer doesn't support concurrent calls of
+# parallel functions from multiple threads.
+_parallel_lock = threading.Lock()
+
+
+def cosine(spectrum1: sus.MsmsSpectrum, spectrum2: sus.MsmsSpectrum,
+           fragment_mz_tolerance: float, allow_shift: bool) \
+        -> Tuple[float, np.ndarray]:
+    """
+    Compute the cosine similarity between the given spectra.
+
+    Parameters
+    ----------
+    spectrum1 : sus.MsmsSpectrum
+        The first spectrum.
+    spectrum2 : sus.MsmsSpectrum
+        The second spectrum.
+    fragment_mz_tolerance : float
+        The fragment m/z tolerance used to match peaks.
+    allow_shift : bool
+        Boolean flag indicating whether to allow peak shifts or not.
+
+    Returns
+    -------
+    Tuple[float, np.ndarray]
+        A tuple consisting of (i) the cosine similarity between both spectra,
+        and (ii) the indexes of matching peaks in both spectra, as an array
+        with a row per peak match.
+    """
+    return _cosine(get_spectrum_tuple(spectrum1),
+                   get_spectrum_tuple(spectrum2), fragment_mz_tolerance,
+                   allow_shift)
+
+
+def get_spectrum_tuple(spectrum: sus.MsmsSpectrum) -> SpectrumTuple:
+    """
+    Convert a spectrum to a Numba-compatible tuple with L2-normalized
+    intensities.
+
+    Parameters
+    ----------
+    spectrum : sus.MsmsSpectrum
+        The spectrum to convert.
+
+    Returns
+    -------
+    SpectrumTuple
+        The spectrum tuple.
+    """
+    return SpectrumTuple(
+        spectrum.precursor_mz, spectrum.precursor_charge, spectrum.mz,
+        spectrum.intensity / np.linalg.norm(spectrum.intensity))
+
+
+def cosine_tuples(spec: SpectrumTuple, spec_other: SpectrumTuple,
+                  fragment_mz_tolerance: float, allow_shift: bool) \
+        -> Tuple[float, np.ndarray]:
+    """
+    Compute the cosine similarity between spectra converted by
+    `get_spectrum_tuple`, to avoid converting spectra that are compared
+    multiple times.
+
+    See `cosine` for the parameters and return value.
+    """
+    return _cosine(spec, spec_other, fragment_mz_tolerance, allow_shift)
+
+
+@nb.njit(cache=True)
+def _cosine(spec: SpectrumTuple, spec_other: SpectrumTuple,
+            fragment_mz_tolerance: float, allow_shift: bool) \
+        -> Tuple[float, np.ndarray]:
+    """
+    Compute the cosine similarity between the given spectra.
+
+    Parameters
+    ----------
+    spec : SpectrumTuple
+        Numba-compatible tuple containing information from the first spectrum.
+    spec_other : SpectrumTuple
+        Numba-compatible tuple containing information from the second spectrum.
+    fragment_mz_tolerance : float
+        The fragment m/z tolerance used to match peaks in both spectra with
+        each other.
+    allow_shift : bool
+        Boolean flag indicating whether to allow peak shifts or not.
+
+    Returns
+    -------
+    Tuple[float, np.ndarray]
+        A tuple consisting of (i) the cosine similarity between both spectra,
+        and (ii) the indexes of matching peaks in both spectra, as an array
+        with a row per peak match.
+    """
+    # Find the matching peaks between both spectra, optionally allowing for
+    # shifted peaks.
+    # Candidate peak indices depend on whether we allow shifts
+    # (check all shifted peaks as well) or not.
+    # Account for unknown precursor charge (default: 1).
+    precursor_charge = max(spec.precursor_charge, 1)
+    precursor_mass_diff = ((spec.precursor_mz - spec_other.precursor_mz)
+                           * precursor_charge)
+    # Only take peak shifts into account if the mass difference is relevant.
+    num_shifts = 1
+    if allow_shift and abs(precursor_mass_diff) >= fragment_mz_tolerance:
+        num_shifts += precursor_charge
+    other_peak_index = np.zeros(num_shifts, np.int64)
+    mass_diff = np.zeros(num_shifts, np.float32)
+    for charge in range(1, num_shifts):
+        mass_diff[charge] = precursor_mass_diff / charge
+
+    # Find the matching peaks between both spectra. The match buffers are
+    # grown when a peak matches multiple other peaks.
+    num_other_peaks = len(spec_other.mz)
+    capacity = max(len(spec.mz) * num_shifts, 1)
+    peak_match_scores = np.empty(capacity, spec.intensity.dtype)
+    peak_match_idx = np.empty((capacity, 2), np.int64)
+    num_matches = 0
+    for peak_index in range(len(spec.mz)):
+        peak_mz = spec.mz[peak_index]
+        peak_intensity = spec.intensity[peak_index]
+        # Advance while there is an excessive mass difference.
+        for cpi in range(num_shifts):
+            while (other_peak_index[cpi] < num_other_peaks - 1 and
+                   (peak_mz - fragment_mz_tolerance >
+                    spec_other.mz[other_peak_index[cpi]] + mass_diff[cpi])):
+                other_peak_index[cpi] += 1
+        # Match the peaks within the fragment mass window if possible.
+        for cpi in range(num_shifts):
+            other_peak_i = other_peak_index[cpi]
+            while (other_peak_i < num_other_peaks and
+                   abs(peak_mz - (spec_other.mz[other_peak_i]
+                       + mass_diff[cpi])) <= fragment_mz_tolerance):
+                if num_matches == capacity:
+                    capacity *= 2
+                    peak_match_scores = _grow(peak_match_scores, capacity)
+                    peak_match_idx = _grow(peak_match_idx, capacity)
+                peak_match_scores[num_matches] = (
+                    peak_intensity * spec_other.intensity[other_peak_i])
+                peak_match_idx[num_matches, 0] = peak_index
+                peak_match_idx[num_matches, 1] = other_peak_i
+                num_matches += 1
+                other_peak_i += 1
+
+    # Use the most prominent peak matches to compute the score (sort in
+    # descending order).
+    peak_match_order = np.argsort(peak_match_scores[:num_matches])[::-1]
+    peaks_used = np.zeros(len(spec.mz), np.bool_)
+    other_peaks_used = np.zeros(num_other_peaks, np.bool_)
+    peak_matches = np.empty((min(len(spec.mz), num_other_peaks), 2),
+                            np.int64)
+    score, num_peak_matches = 0., 0
+    for match_i in peak_match_order:
+        peak_i = peak_match_idx[match_i, 0]
+        other_peak_i = peak_match_idx[match_i, 1]
+        if not peaks_used[peak_i] and not other_peaks_used[other_peak_i]:
+            score += peak_match_scores[match_i]
+            # Save the matched peaks.
+            peak_matches[num_peak_matches, 0] = peak_i
+            peak_matches[num_peak_matches, 1] = other_peak_i
+            num_peak_matches += 1
+            # Make sure these peaks are not used anymore.
+            peaks_used[peak_i] = True
+            other_peaks_used[other_peak_i] = True
+
+    return score, peak_matches[:num_peak_matches]
+
+
+@nb.njit(cache=True)
+def _grow(array: np.ndarray, capacity: int) -> np.ndarray:
+    grown = np.empty((capacity,) + array.shape[1:], array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+def cosine_matrix(spectra: Sequence[sus.MsmsSpectrum],
+                  fragment_mz_tolerance: float, allow_shift: bool) \
+        -> np.ndarray:
+    """
+    Compute the pairwise cosine similarities between the given spectra.
+
+    Parameters
+    ----------
+    spectra : Sequence[sus.MsmsSpectrum]
+        The spectra to compare.
+    fragment_mz_tolerance : float
+        The fragment m/z tolerance used to match peaks.
+    allow_shift : bool
+        Boolean flag indicating whether to allow peak shifts or not.
+
+    Returns
+    -------
+    np.ndarray
+        The similarity matrix, with at row i and column j the cosine
+        similarity between spectra i and j as computed by `cosine`.
+    """
+    offsets = np.zeros(len(spectra) + 1, np.int64)
+    offsets[1:] = np.cumsum([len(spectrum.mz) for spectrum in spectra])
+    mz = np.empty(offsets[-1], np.float32)
+    intensity = np.empty(offsets[-1], np.float32)
+    for i, spectrum in enumerate(spectra):
+        mz[offsets[i]:offsets[i + 1]] = spectrum.mz
+        intensity[offsets[i]:offsets[i + 1]] = (
+            spectrum.intensity / np.linalg.norm(spectrum.intensity))
+    precursor_mz = np.asarray([spectrum.precursor_mz for spectrum in spectra],
+                              np.float64)
+    precursor_charge = np.asarray(
+        [spectrum.precursor_charge for spectrum in spectra], np.int64)
+    with _parallel_lock:
+        return _cosine_matrix(precursor_mz, precursor_charge, mz, intensity,
+                              offsets, fragment_mz_tolerance, allow_shift)
+
+
+@nb.njit(cache=True, parallel=True)
+def _cosine_matrix(precursor_mz: np.ndarray, precursor_charge: np.ndarray,
+                   mz: np.ndarray, intensity: np.ndarray, offsets: np.ndarray,
+                   fragment_mz_tolerance: float, allow_shift: bool) \
+        -> np.ndarray:
+    n = len(offsets) - 1
+    scores = np.zeros((n, n), np.float32)
+    # The shifted cosine depends on the precursor charge of the first
+    # spectrum, so only the standard cosine is symmetric.
+    num_other = n if allow_shift else n // 2 + 1
+    for i in nb.prange(n):
+        spec = SpectrumTuple(precursor_mz[i], precursor_charge[i],
+                             mz[offsets[i]:offsets[i + 1]],
+                             intensity[offsets[i]:offsets[i + 1]])
+        # Balance the work between the rows by computing half of the
+        # symmetric pairs for each row (round-robin).
+        for d in range(num_other):
+            if not allow_shift and 2 * d == n and i >= d:
+                continue
+            j = (i + d) % n
+            spec_other = SpectrumTuple(
+                precursor_mz[j], precursor_charge[j],
+                mz[offsets[j]:offsets[j + 1]],
+                intensity[offsets[j]:offsets[j + 1]])
+            score = _cosine(spec, spec_other, fragment_mz_tolerance,
+                            allow_shift)[0]
+            scores[i, j] = score
+            if not allow_shift:
+                scores[j, i] = score
+    return scores
+
+
+def top_k(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Get the most similar other spectra for each spectrum.
+
+    Parameters
+    ----------
+    scores : np.ndarray
+        The similarity matrix (see `cosine_matrix`).
+    k : int
+        The number of most similar spectra to retrieve.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        The indexes of the (at most) k most similar other spectra per
+        spectrum in decreasing order of similarity, and their similarities.
+    """
+    scores = scores.copy()
+    np.fill_diagonal(scores, -np.inf)
+    k = min(k, len(scores) - 1)
+    if k <= 0:
+        return (np.empty((len(scores), 0), np.int64),
+                np.empty((len(scores), 0), scores.dtype))
+    indexes = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, indexes, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+    return (np.take_along_axis(indexes, order, axis=1),
+            np.take_along_axis(top_scores, order, axis=1))
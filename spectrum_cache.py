@@ -0,0 +1,432 @@
+import collections
+import contextlib
+import fcntl
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import BinaryIO, ContextManager, Dict, Optional, Tuple
+
+import numpy as np
+import spectrum_utils.spectrum as sus
+
+
+logger = logging.getLogger(__name__)
+
+# Backend of the spectrum store shared between worker processes:
+# 'disk' (NumPy files), 'redis', 'local' (in-process Redis stand-in)
+# or '' to disable the shared store.
+SPECTRUM_CACHE_BACKEND = os.environ.get('SPECTRUM_CACHE_BACKEND', '')
+SPECTRUM_CACHE_DIR = os.environ.get('SPECTRUM_CACHE_DIR',
+                                    '/output/spectrum_cache')
+SPECTRUM_CACHE_REDIS_URL = os.environ.get('SPECTRUM_CACHE_REDIS_URL',
+                                          'redis://localhost:6379/0')
+SPECTRUM_CACHE_MAX_BYTES = int(os.environ.get('SPECTRUM_CACHE_MAX_BYTES',
+                                              1024 ** 3))
+
+# Time-to-live (in seconds) of the cached spectra per collection.
+# Can be overridden as a comma-separated list of collection=seconds pairs in
+# the SPECTRUM_CACHE_TTL environment variable.
+default_ttl = {
+    'gnps': 7 * 24 * 60 * 60,
+    'massive': 30 * 24 * 60 * 60,
+    'massbank': 7 * 24 * 60 * 60,
+    'ms2lda': 24 * 60 * 60,
+    'motifdb': 24 * 60 * 60,
+    'legacy': 24 * 60 * 60,
+}
+for _ttl in filter(None, os.environ.get('SPECTRUM_CACHE_TTL', '').split(',')):
+    _collection, _seconds = _ttl.split('=')
+    default_ttl[_collection.strip().lower()] = int(_seconds)
+
+# Interval (in seconds) at which workers poll for a USI that is being resolved
+# by another worker.
+SPECTRUM_CACHE_LOCK_POLL_INTERVAL = 0.05
+# Interval (in seconds) at which workers rescan the disk store to account for
+# the entries written by other workers.
+SPECTRUM_CACHE_SCAN_INTERVAL = 60
+
+
+class SpectrumStore:
+    """
+    Base class of the spectrum stores that can be shared between processes.
+
+    A store entry consists of the peak arrays, precursor m/z, precursor charge,
+    and source link of a resolved USI.
+    """
+
+    def __init__(self, ttl: Optional[Dict[str, int]] = None) -> None:
+        self.ttl = ttl if ttl is not None else default_ttl
+
+    def get(self, usi: str) -> Optional[Tuple[sus.MsmsSpectrum, str]]:
+        raise NotImplementedError
+
+    def put(self, usi: str, spectrum: sus.MsmsSpectrum, source_link: str,
+            collection: str) -> None:
+        raise NotImplementedError
+
+    def lock(self, usi: str, timeout: float) -> ContextManager[bool]:
+        """
+        Lock a USI across worker processes while it's being resolved.
+
+        Parameters
+        ----------
+        usi : str
+            The USI to lock.
+        timeout : float
+            The maximum time in seconds to wait for the lock, and after which
+            the lock expires if it isn't released.
+
+        Returns
+        -------
+        ContextManager[bool]
+            A context manager that holds the lock and yields whether it was
+            acquired (False after a timeout).
+        """
+        return contextlib.nullcontext(True)
+
+    def _get_ttl(self, collection: str) -> int:
+        return get_ttl(collection, self.ttl)
+
+
+def get_ttl(collection: str, ttl: Optional[Dict[str, int]] = None) -> int:
+    """
+    Get the time-to-live (in seconds) of the cached spectra of a collection,
+    from `ttl` or the configured defaults.
+    """
+    ttl = ttl if ttl is not None else default_ttl
+    return ttl.get(collection, ttl.get('legacy', 0))
+
+
+def _get_key(usi: str) -> str:
+    return hashlib.sha1(usi.encode('utf-8')).hexdigest()
+
+
+def _get_metadata(spectrum: sus.MsmsSpectrum, source_link: str,
+                  expires: float) -> Dict:
+    return {'precursor_mz': float(spectrum.precursor_mz),
+            'precursor_charge': int(spectrum.precursor_charge),
+            'source_link': source_link,
+            'expires': expires}
+
+
+def _to_spectrum(usi: str, metadata: Dict, peaks: np.ndarray) \
+        -> Tuple[sus.MsmsSpectrum, str]:
+    spectrum = sus.MsmsSpectrum(usi, metadata['precursor_mz'],
+                                metadata['precursor_charge'],
+                                peaks[0], peaks[1])
+    return spectrum, metadata['source_link']
+
+
+class DiskSpectrumStore(SpectrumStore):
+    """
+    Spectrum store that keeps each entry as a NumPy file with a JSON metadata
+    sidecar in a directory shared by all workers.
+
+    Entries are written atomically and the least recently used entries are
+    evicted when the total size of the store exceeds `max_bytes`. The total
+    size is tracked per worker and only recomputed by scanning the directory
+    when it exceeds `max_bytes` or periodically.
+    """
+
+    def __init__(self, directory: str, max_bytes: int,
+                 ttl: Optional[Dict[str, int]] = None) -> None:
+        super().__init__(ttl)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+        self._total_bytes = 0
+        self._next_scan = 0.
+        self._lock = threading.Lock()
+
+    def _get_path(self, usi: str, extension: str) -> str:
+        return os.path.join(self.directory, f'{_get_key(usi)}.{extension}')
+
+    def get(self, usi: str) -> Optional[Tuple[sus.MsmsSpectrum, str]]:
+        metadata_path = self._get_path(usi, 'json')
+        try:
+            with open(metadata_path) as f_in:
+                metadata = json.load(f_in)
+            if metadata['expires'] < time.time():
+                return None
+            peaks = np.load(self._get_path(usi, 'npy'))
+            # Mark the entry as recently used for the LRU eviction.
+            os.utime(metadata_path)
+            return _to_spectrum(usi, metadata, peaks)
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def put(self, usi: str, spectrum: sus.MsmsSpectrum, source_link: str,
+            collection: str) -> None:
+        ttl = self._get_ttl(collection)
+        if ttl <= 0:
+            return
+        metadata = _get_metadata(spectrum, source_link, time.time() + ttl)
+        try:
+            # Write the peaks before the metadata because the metadata file
+            # marks a complete entry.
+            written_bytes = self._write_atomic(
+                self._get_path(usi, 'npy'), lambda f_out: np.save(
+                    f_out, np.vstack((spectrum.mz, spectrum.intensity))))
+            written_bytes += self._write_atomic(
+                self._get_path(usi, 'json'),
+                lambda f_out: f_out.write(json.dumps(metadata).encode()))
+            self._evict(written_bytes)
+        except OSError as e:
+            logger.warning('Unable to store spectrum %s: %s', usi, e)
+
+    @contextlib.contextmanager
+    def lock(self, usi: str, timeout: float):
+        filename = self._get_path(usi, 'lock')
+        f_lock = self._acquire(filename, time.monotonic() + timeout)
+        try:
+            yield f_lock is not None
+        finally:
+            if f_lock is not None:
+                os.unlink(filename)
+                f_lock.close()
+
+    def _acquire(self, filename: str, deadline: float) \
+            -> Optional[BinaryIO]:
+        while True:
+            f_lock = open(filename, 'ab')
+            try:
+                fcntl.flock(f_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f_lock.close()
+                if time.monotonic() >= deadline:
+                    return None
+                time.sleep(SPECTRUM_CACHE_LOCK_POLL_INTERVAL)
+                continue
+            # The previous holder might have removed the lock file in the
+            # meantime, in which case the lock isn't exclusive.
+            try:
+                if (os.fstat(f_lock.fileno()).st_ino ==
+                        os.stat(filename).st_ino):
+                    return f_lock
+            except FileNotFoundError:
+                pass
+            f_lock.close()
+
+    def _write_atomic(self, filename: str, write) -> int:
+        fd, tmp_filename = tempfile.mkstemp(dir=self.directory,
+                                            suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f_out:
+                write(f_out)
+                size = f_out.tell()
+            os.replace(tmp_filename, filename)
+            return size
+        except BaseException:
+            os.unlink(tmp_filename)
+            raise
+
+    def _evict(self, written_bytes: int) -> None:
+        with self._lock:
+            self._total_bytes += written_bytes
+            now = time.monotonic()
+            if (self._total_bytes <= self.max_bytes
+                    and now < self._next_scan):
+                return
+            self._next_scan = now + SPECTRUM_CACHE_SCAN_INTERVAL
+            self._total_bytes = self._scan_and_evict()
+
+    def _scan_and_evict(self) -> int:
+        # Return the total size of the store after evicting the least
+        # recently used entries.
+        entries, total_bytes = {}, 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                key, extension = os.path.splitext(entry.name)
+                if extension not in ('.json', '.npy'):
+                    continue
+                stat = entry.stat()
+                total_bytes += stat.st_size
+                last_used, size = entries.get(key, (0, 0))
+                if extension == '.json':
+                    last_used = stat.st_mtime
+                entries[key] = last_used, size + stat.st_size
+        if total_bytes <= self.max_bytes:
+            return total_bytes
+        for key, (_, size) in sorted(entries.items(),
+                                     key=lambda item: item[1][0]):
+            for extension in ('json', 'npy'):
+                try:
+                    os.unlink(os.path.join(self.directory,
+                                           f'{key}.{extension}'))
+                except FileNotFoundError:
+                    pass
+            total_bytes -= size
+            if total_bytes <= self.max_bytes:
+                break
+        return total_bytes
+
+
+class RedisSpectrumStore(SpectrumStore):
+    """
+    Spectrum store backed by a Redis-compatible key-value server.
+
+    Expiration is handled by Redis, size-based eviction by the server's
+    `maxmemory-policy` (e.g. `allkeys-lru`).
+    """
+
+    key_prefix = 'usi:spectrum:'
+    lock_prefix = 'usi:lock:'
+
+    def __init__(self, client, ttl: Optional[Dict[str, int]] = None) -> None:
+        super().__init__(ttl)
+        self.client = client
+
+    def get(self, usi: str) -> Optional[Tuple[sus.MsmsSpectrum, str]]:
+        try:
+            value = self.client.get(f'{self.key_prefix}{_get_key(usi)}')
+        except Exception as e:
+            logger.warning('Unable to retrieve spectrum %s: %s', usi, e)
+            return None
+        if value is None:
+            return None
+        metadata_len = int.from_bytes(value[:4], 'little')
+        metadata = json.loads(value[4:4 + metadata_len])
+        peaks = np.load(io.BytesIO(value[4 + metadata_len:]))
+        return _to_spectrum(usi, metadata, peaks)
+
+    def put(self, usi: str, spectrum: sus.MsmsSpectrum, source_link: str,
+            collection: str) -> None:
+        ttl = self._get_ttl(collection)
+        if ttl <= 0:
+            return
+        metadata = json.dumps(_get_metadata(spectrum, source_link,
+                                            time.time() + ttl)).encode()
+        peaks = io.BytesIO()
+        np.save(peaks, np.vstack((spectrum.mz, spectrum.intensity)))
+        value = (len(metadata).to_bytes(4, 'little') + metadata
+                 + peaks.getvalue())
+        try:
+            self.client.set(f'{self.key_prefix}{_get_key(usi)}', value,
+                            ex=ttl)
+        except Exception as e:
+            logger.warning('Unable to store spectrum %s: %s', usi, e)
+
+    @contextlib.contextmanager
+    def lock(self, usi: str, timeout: float):
+        key = f'{self.lock_prefix}{_get_key(usi)}'
+        token = os.urandom(16)
+        try:
+            acquired = self._acquire(key, token, timeout)
+        except Exception as e:
+            logger.warning('Unable to lock spectrum %s: %s', usi, e)
+            acquired = False
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                try:
+                    # Don't release the lock if it expired and was acquired
+                    # by another worker.
+                    if self.client.get(key) == token:
+                        self.client.delete(key)
+                except Exception as e:
+                    logger.warning('Unable to unlock spectrum %s: %s', usi, e)
+
+    def _acquire(self, key: str, token: bytes, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while not self.client.set(key, token, nx=True,
+                                  px=int(timeout * 1000)):
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(SPECTRUM_CACHE_LOCK_POLL_INTERVAL)
+        return True
+
+
+class LocalRedis:
+    """
+    In-process stand-in for the subset of the Redis client API used by the
+    Redis-based stores, with least recently used eviction once the stored
+    values exceed `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._data = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            return self._get(key)
+
+    def set(self, key: str, value: bytes, ex: Optional[int] = None,
+            px: Optional[int] = None, nx: bool = False) -> Optional[bool]:
+        with self._lock:
+            if nx and self._get(key) is not None:
+                return None
+            self._delete(key)
+            if px is not None:
+                ex = px / 1000
+            self._data[key] = (value,
+                               time.time() + ex if ex is not None else None)
+            self._size += len(value)
+            while self._size > self.max_bytes and self._data:
+                self._delete(next(iter(self._data)))
+            return True
+
+    def delete(self, key: str) -> int:
+        with self._lock:
+            return self._delete(key)
+
+    def _get(self, key: str) -> Optional[bytes]:
+        value, expires = self._data.get(key, (None, None))
+        if value is None:
+            return None
+        if expires is not None and expires < time.time():
+            self._delete(key)
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def _delete(self, key: str) -> int:
+        value, _ = self._data.pop(key, (None, None))
+        if value is None:
+            return 0
+        self._size -= len(value)
+        return 1
+
+
+_store = None
+_store_initialized = False
+
+
+def get_store() -> Optional[SpectrumStore]:
+    """
+    Get the configured spectrum store.
+
+    Returns
+    -------
+    Optional[SpectrumStore]
+        The spectrum store configured by the SPECTRUM_CACHE_BACKEND environment
+        variable, or None if no shared spectrum store is used.
+    """
+    global _store, _store_initialized
+    if not _store_initialized:
+        _store = _create_store(SPECTRUM_CACHE_BACKEND.lower())
+        _store_initialized = True
+    return _store
+
+
+def _create_store(backend: str) -> Optional[SpectrumStore]:
+    if backend == 'disk':
+        return DiskSpectrumStore(SPECTRUM_CACHE_DIR, SPECTRUM_CACHE_MAX_BYTES)
+    elif backend == 'redis':
+        import redis
+        return RedisSpectrumStore(
+            redis.Redis.from_url(SPECTRUM_CACHE_REDIS_URL))
+    elif backend == 'local':
+        return RedisSpectrumStore(LocalRedis(SPECTRUM_CACHE_MAX_BYTES))
+    elif not backend:
+        return None
+    else:
+        raise ValueError(f'Unknown spectrum cache backend: {backend}')
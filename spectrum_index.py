@@ -0,0 +1,217 @@
+import collections
+import math
+import os
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import scipy.sparse as ss
+from spectrum_utils import spectrum as sus
+
+import similarity
+
+
+# Maximum number of resolved spectra that are indexed per worker process for
+# similarity searches, after which the least recently indexed spectra are
+# replaced. If 0 (default), spectra aren't indexed.
+SPECTRUM_INDEX_MAX_SPECTRA = int(
+    os.environ.get('SPECTRUM_INDEX_MAX_SPECTRA', 0))
+# Width of the m/z bins of the sparse spectrum vectors, which should be at
+# least twice the fragment m/z tolerance of the searches.
+SPECTRUM_INDEX_BIN_SIZE = float(os.environ.get('SPECTRUM_INDEX_BIN_SIZE',
+                                               0.05))
+# Peaks with a higher m/z are assigned to the last bin.
+SPECTRUM_INDEX_MAX_MZ = float(os.environ.get('SPECTRUM_INDEX_MAX_MZ', 5000))
+# Number of candidates that are re-scored using the exact cosine similarity.
+SPECTRUM_INDEX_CANDIDATES = int(
+    os.environ.get('SPECTRUM_INDEX_CANDIDATES', 500))
+
+
+# The score is the exact cosine similarity, or the approximate (binned)
+# similarity if the candidate's peaks weren't available to re-score it.
+SpectrumMatch = collections.namedtuple(
+    'SpectrumMatch', ['usi', 'score', 'matched_peaks', 'exact'])
+
+
+class SpectrumIndex:
+    """
+    Index of spectra as binned, L2-normalized sparse vectors for cosine
+    similarity searches.
+
+    The approximate similarities between a query spectrum and all indexed
+    spectra are computed with sparse matrix-vector products, after which the
+    best candidates are re-scored using the exact cosine peak assignment.
+    Only the sparse vectors are kept in the index, the candidates' peaks are
+    retrieved again (e.g. from the spectrum store) to re-score them.
+
+    The spectra are stored in a fixed number of slots, which are replaced in
+    the order in which they were filled. The slots are grouped into segments
+    of which the CSR matrices are only rebuilt when they're modified.
+    """
+
+    def __init__(self, max_spectra: int, bin_size: float, max_mz: float,
+                 segment_size: int = 4096) -> None:
+        self.max_spectra = max_spectra
+        self.bin_size = bin_size
+        self.num_bins = int(math.ceil(max_mz / bin_size)) + 1
+        self.segment_size = segment_size
+        self._usis: List[Optional[str]] = []
+        self._slots: Dict[str, int] = {}
+        self._vectors: List[Optional[Tuple[np.ndarray, np.ndarray]]] = []
+        self._segments: Dict[int, ss.csr_matrix] = {}
+        self._next_slot = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def add(self, usi: str, spectrum: sus.MsmsSpectrum) -> None:
+        """
+        Add a spectrum to the index, or update it if the USI was indexed
+        before.
+
+        Parameters
+        ----------
+        usi : str
+            The (normalized) USI of the spectrum.
+        spectrum : sus.MsmsSpectrum
+            The spectrum.
+        """
+        if self.max_spectra <= 0 or not np.any(spectrum.intensity > 0):
+            return
+        vector = self._vectorize(spectrum.mz, spectrum.intensity)
+        with self._lock:
+            slot = self._slots.get(usi)
+            if slot is None:
+                slot = self._next_slot % self.max_spectra
+                self._next_slot += 1
+                if slot < len(self._usis):
+                    del self._slots[self._usis[slot]]
+                else:
+                    self._usis.append(None)
+                    self._vectors.append(None)
+                self._slots[usi] = slot
+            self._usis[slot] = usi
+            self._vectors[slot] = vector
+            self._segments.pop(slot // self.segment_size, None)
+
+    def search(self, spectrum: sus.MsmsSpectrum, fragment_mz_tolerance: float,
+               allow_shift: bool, k: int, exclude: Optional[str] = None,
+               get_spectrum: Optional[Callable[
+                   [str], Optional[sus.MsmsSpectrum]]] = None,
+               num_candidates: int = SPECTRUM_INDEX_CANDIDATES) \
+            -> List[SpectrumMatch]:
+        """
+        Find the indexed spectra that are most similar to the given spectrum.
+
+        Parameters
+        ----------
+        spectrum : sus.MsmsSpectrum
+            The query spectrum.
+        fragment_mz_tolerance : float
+            The fragment m/z tolerance used to match peaks.
+        allow_shift : bool
+            Boolean flag indicating whether to allow peak shifts or not. Only
+            unshifted peaks are considered to select the candidates.
+        k : int
+            The maximum number of matches to return.
+        exclude : Optional[str]
+            The USI of an indexed spectrum that should be excluded from the
+            matches (e.g. the query spectrum itself).
+        get_spectrum : Optional[Callable[[str], Optional[sus.MsmsSpectrum]]]
+            Function to retrieve the spectrum of an indexed USI to re-score
+            it, which returns None if it's no longer available. Candidates
+            that can't be retrieved are scored with their approximate (binned)
+            similarity, with the number of matching bins as the number of
+            matched peaks, and aren't marked as exact.
+        num_candidates : int
+            The number of candidates to re-score using the exact cosine
+            similarity.
+
+        Returns
+        -------
+        List[SpectrumMatch]
+            The (at most) k most similar spectra with a non-zero similarity,
+            in decreasing order of similarity.
+        """
+        spec_tuple = similarity.get_spectrum_tuple(spectrum)
+        if len(spec_tuple.mz) == 0:
+            return []
+        query = self._get_query(spec_tuple.mz, spec_tuple.intensity,
+                                fragment_mz_tolerance)
+        with self._lock:
+            num_slots = len(self._usis)
+            segments = [self._get_segment(i) for i in
+                        range(0, num_slots, self.segment_size)]
+        if num_slots == 0:
+            return []
+        scores = np.concatenate([segment @ query for segment in segments])
+        num_candidates = min(max(num_candidates, k + 1), num_slots)
+        candidates = np.argpartition(-scores, num_candidates - 1)
+        candidates = candidates[:num_candidates]
+        candidates = candidates[scores[candidates] > 0]
+        with self._lock:
+            candidates = [(self._usis[i], self._vectors[i], scores[i])
+                          for i in candidates
+                          if self._usis[i] not in (None, exclude)]
+        matches = []
+        for usi, (bins, _), approximate_score in candidates:
+            candidate = get_spectrum(usi) if get_spectrum is not None else None
+            if candidate is not None:
+                score, peak_matches = similarity.cosine_tuples(
+                    spec_tuple, similarity.get_spectrum_tuple(candidate),
+                    fragment_mz_tolerance, allow_shift)
+                matched_peaks, exact = len(peak_matches), True
+            else:
+                score = float(approximate_score)
+                matched_peaks = int(np.count_nonzero(query[bins]))
+                exact = False
+            if score > 0:
+                matches.append(SpectrumMatch(usi, score, matched_peaks, exact))
+        matches.sort(key=lambda match: match.score, reverse=True)
+        return matches[:k]
+
+    def _get_bins(self, mz: np.ndarray) -> np.ndarray:
+        return np.clip(np.floor_divide(mz, self.bin_size).astype(np.int64),
+                       0, self.num_bins - 1)
+
+    def _vectorize(self, mz: np.ndarray, intensity: np.ndarray) \
+            -> Tuple[np.ndarray, np.ndarray]:
+        # Sum the intensities per bin (the m/z values are sorted).
+        bins = self._get_bins(mz)
+        starts = np.flatnonzero(np.diff(bins, prepend=-1))
+        values = np.add.reduceat(intensity, starts).astype(np.float32)
+        # The (L2-normalized) vector doesn't depend on the intensity scale.
+        return bins[starts].astype(np.int32), values / np.linalg.norm(values)
+
+    def _get_query(self, mz: np.ndarray, intensity: np.ndarray,
+                   fragment_mz_tolerance: float) -> np.ndarray:
+        # Assign each peak to all bins within the fragment m/z tolerance, so
+        # that peaks that match across a bin boundary contribute as well.
+        query = np.zeros(self.num_bins, np.float32)
+        bins_min = self._get_bins(mz - fragment_mz_tolerance)
+        bins_max = self._get_bins(mz + fragment_mz_tolerance)
+        for offset in range(int(np.max(bins_max - bins_min)) + 1):
+            bins = np.minimum(bins_min + offset, bins_max)
+            np.maximum.at(query, bins, intensity)
+        return query
+
+    def _get_segment(self, start: int) -> ss.csr_matrix:
+        segment = self._segments.get(start // self.segment_size)
+        if segment is None:
+            vectors = [vector if vector is not None else
+                       (np.empty(0, np.int32), np.empty(0, np.float32))
+                       for vector in
+                       self._vectors[start:start + self.segment_size]]
+            indptr = np.zeros(len(vectors) + 1, np.int64)
+            indptr[1:] = np.cumsum([len(bins) for bins, _ in vectors])
+            segment = self._segments[start // self.segment_size] = \
+                ss.csr_matrix(
+                    (np.concatenate([values for _, values in vectors]),
+                     np.concatenate([bins for bins, _ in vectors]), indptr),
+                    shape=(len(vectors), self.num_bins))
+        return segment
+
+
+index = SpectrumIndex(SPECTRUM_INDEX_MAX_SPECTRA, SPECTRUM_INDEX_BIN_SIZE,
+                      SPECTRUM_INDEX_MAX_MZ)
@@ -0,0 +1,180 @@
+from typing import Dict, Optional
+
+import numpy as np
+from spectrum_utils import spectrum as sus
+
+
+def freeze(spectrum: sus.MsmsSpectrum) -> sus.MsmsSpectrum:
+    """
+    Make the peak arrays of a (cached) spectrum read-only.
+
+    Cached spectra are shared between requests, so they should never be
+    modified in place. Use a `SpectrumView` to derive modified peaks instead.
+
+    Parameters
+    ----------
+    spectrum : sus.MsmsSpectrum
+        The spectrum to freeze.
+
+    Returns
+    -------
+    sus.MsmsSpectrum
+        The frozen spectrum.
+    """
+    for array in (spectrum.mz, spectrum.intensity, spectrum.annotation):
+        if array is not None:
+            array.flags.writeable = False
+    return spectrum
+
+
+class SpectrumView:
+    """
+    Lightweight view on an immutable (cached) spectrum.
+
+    The m/z range is a slice of the source peak arrays, and the normalized
+    intensities and the peak annotations are only computed for the viewed
+    peaks, without modifying the source spectrum.
+    """
+
+    def __init__(self, spectrum: sus.MsmsSpectrum, start: int = 0,
+                 stop: Optional[int] = None,
+                 annotations: Optional[Dict[int, sus.FragmentAnnotation]]
+                 = None) -> None:
+        self.spectrum = spectrum
+        self.start = start
+        self.stop = stop if stop is not None else len(spectrum.mz)
+        # Peak annotations by source peak index.
+        self.annotations = annotations if annotations is not None else {}
+        self._intensity = None
+
+    @property
+    def identifier(self) -> str:
+        return self.spectrum.identifier
+
+    @property
+    def precursor_mz(self) -> float:
+        return self.spectrum.precursor_mz
+
+    @property
+    def precursor_charge(self) -> int:
+        return self.spectrum.precursor_charge
+
+    @property
+    def mz(self) -> np.ndarray:
+        return self.spectrum.mz[self.start:self.stop]
+
+    @property
+    def intensity(self) -> np.ndarray:
+        # Intensities relative to the most intense viewed peak, computed on
+        # first use.
+        if self._intensity is None:
+            intensity = self.spectrum.intensity[self.start:self.stop]
+            self._intensity = intensity / intensity.max()
+        return self._intensity
+
+    @property
+    def annotation(self) -> Optional[np.ndarray]:
+        if not self.annotations:
+            return None
+        annotation = np.full(self.stop - self.start, None, object)
+        for i, fragment_annotation in self.annotations.items():
+            if self.start <= i < self.stop:
+                annotation[i - self.start] = fragment_annotation
+        return annotation
+
+    def annotate_mz_fragment(self, fragment_mz: float,
+                             fragment_tol_mass: float,
+                             text: Optional[str] = None) -> 'SpectrumView':
+        """
+        Annotate the most intense viewed peak within the given m/z tolerance
+        (in Dalton).
+
+        Parameters
+        ----------
+        fragment_mz : float
+            The m/z to annotate.
+        fragment_tol_mass : float
+            The m/z tolerance in Dalton.
+        text : Optional[str]
+            The text to annotate the peak with. If None, its m/z value will be
+            used.
+
+        Returns
+        -------
+        SpectrumView
+            The view itself.
+
+        Raises
+        ------
+        ValueError
+            If there are no peaks within the m/z tolerance.
+        """
+        mz = self.mz
+        start = np.searchsorted(
+            mz, _to_float32(fragment_mz - fragment_tol_mass, np.inf))
+        stop = np.searchsorted(
+            mz, _to_float32(fragment_mz + fragment_tol_mass, np.inf))
+        if start == stop:
+            raise ValueError(f'No matching peak found for {fragment_mz} m/z')
+        peak_i = self.start + start + np.argmax(
+            self.spectrum.intensity[self.start + start:self.start + stop])
+        self.annotations[peak_i] = sus.FragmentAnnotation(
+            0, fragment_mz, text if text is not None else str(fragment_mz))
+        return self
+
+    def set_mz_range(self, min_mz: Optional[float] = None,
+                     max_mz: Optional[float] = None) -> 'SpectrumView':
+        """
+        Get a view restricted to the given (inclusive) m/z range.
+
+        Parameters
+        ----------
+        min_mz : Optional[float]
+            The minimum m/z, or None to keep the current lower bound.
+        max_mz : Optional[float]
+            The maximum m/z, or None to keep the current upper bound.
+
+        Returns
+        -------
+        SpectrumView
+            A new view on the peaks within the m/z range, with the same
+            annotations.
+        """
+        mz, start, stop = self.mz, 0, len(self.mz)
+        if min_mz is not None:
+            start = np.searchsorted(mz, _to_float32(min_mz, np.inf), 'left')
+        if max_mz is not None:
+            stop = np.searchsorted(mz, _to_float32(max_mz, -np.inf), 'right')
+        return SpectrumView(self.spectrum, self.start + start,
+                            max(self.start + start, self.start + stop),
+                            dict(self.annotations))
+
+    def to_spectrum(self) -> sus.MsmsSpectrum:
+        """
+        Materialize the view as a spectrum.
+
+        Returns
+        -------
+        sus.MsmsSpectrum
+            A spectrum with the viewed peaks, normalized intensities and
+            annotations. Its m/z values are a read-only view on the source
+            spectrum.
+        """
+        spectrum = sus.MsmsSpectrum(self.identifier, self.precursor_mz,
+                                    self.precursor_charge, [], [])
+        # The peaks are already sorted, so assign them directly instead of
+        # copying and sorting them again.
+        spectrum.mz = self.mz
+        spectrum.intensity = self.intensity
+        spectrum.annotation = self.annotation
+        return spectrum
+
+
+def _to_float32(value: float, direction: float) -> np.float32:
+    # Round the bound towards the peaks that it includes, so that comparing
+    # it to the float32 m/z values is exact.
+    value32 = np.float32(value)
+    if (float(value32) < value if direction > 0 else
+            float(value32) > value):
+        value32 = np.nextafter(value32, np.float32(direction))
+    return value32
@@ -0,0 +1,107 @@
+import sys
+
+import requests
+
+sys.path.insert(0, "..")
+import file_index  # noqa: E402
+import parsing  # noqa: E402
+import spectrum_cache  # noqa: E402
+import upstream  # noqa: E402
+
+
+def test_massive_file_index():
+    from benchmarks import replay
+    probed = []
+
+    def get_massive_spectrum(file_descriptor, scan):
+        probed.append(file_descriptor)
+        if not file_descriptor.endswith('/run1.mzML'):
+            response = requests.Response()
+            response.status_code = 404
+            raise requests.exceptions.HTTPError('Unknown file',
+                                                response=response)
+        return {'peaks': [[100., 1.]], 'precursor': {'mz': 500., 'charge': 2}}
+
+    usi = 'mzspec:MSV000000001:run1:scan:1'
+    server = replay.start_replay_server({
+        f'https://massive.ucsd.edu/ProteoSAFe/QuerySpectrum?id={usi}': {
+            'status_code': 200, 'content_type': 'application/json',
+            'body': '{"row_data": ['
+                    '{"file_descriptor": "f.MSV000000001/raw/run1.raw"}, '
+                    '{"file_descriptor": "f.MSV000000001/peak/other.mzML"}, '
+                    '{"file_descriptor": "f.MSV000000001/peak/run1.mzML"}]}'}})
+    index = file_index.FileIndex(spectrum_cache.LocalRedis(1024 ** 2))
+    url_override = upstream.UPSTREAM_URL_OVERRIDE
+    upstream.UPSTREAM_URL_OVERRIDE = server.url
+    _get_massive_spectrum = parsing._get_massive_spectrum
+    parsing._get_massive_spectrum = get_massive_spectrum
+    file_index._index, file_index._index_initialized = index, True
+    try:
+        spectrum, _ = parsing._parse_usi(usi)
+        assert spectrum.precursor_charge == 2
+        # The file named after the MS run is tried first.
+        assert probed[0] == 'f.MSV000000001/peak/run1.mzML'
+        assert (index.get('msv000000001', 'run1')
+                == 'f.MSV000000001/peak/run1.mzML')
+        # Other spectra of the MS run are retrieved without the lookup.
+        server.responses.clear()
+        parsing._parse_usi('mzspec:MSV000000001:run1:scan:2')
+        assert probed[-1] == 'f.MSV000000001/peak/run1.mzML'
+    finally:
+        upstream.UPSTREAM_URL_OVERRIDE = url_override
+        parsing._get_massive_spectrum = _get_massive_spectrum
+        file_index._index, file_index._index_initialized = None, False
+        server.shutdown()
+    assert index.seed([('MSV000000002', 'f.MSV000000002/peak/a.mzXML'),
+                       ('MSV000000002', 'f.MSV000000002/raw/a.raw')]) == 1
+    assert index.get('MSV000000002', 'a') == 'f.MSV000000002/peak/a.mzXML'
+
+
+def test_massive_upstream_failure():
+    from benchmarks import replay
+    usi = 'mzspec:MSV000000003:run1:scan:1'
+    lookup_url = f'https://massive.ucsd.edu/ProteoSAFe/QuerySpectrum?id={usi}'
+    server = replay.start_replay_server({lookup_url: {
+        'status_code': 503, 'content_type': 'text/plain', 'body': ''}})
+    probed = []
+
+    def get_massive_spectrum(file_descriptor, scan):
+        probed.append(file_descriptor)
+        response = requests.Response()
+        response.status_code = 503 if len(probed) == 1 else 404
+        raise requests.exceptions.HTTPError('Unavailable', response=response)
+
+    url_override = upstream.UPSTREAM_URL_OVERRIDE
+    upstream.UPSTREAM_URL_OVERRIDE = server.url
+    retries, upstream.UPSTREAM_RETRIES = upstream.UPSTREAM_RETRIES, 0
+    _get_massive_spectrum = parsing._get_massive_spectrum
+    parsing._get_massive_spectrum = get_massive_spectrum
+    file_index._index, file_index._index_initialized = None, True
+    try:
+        # The lookup isn't available.
+        try:
+            parsing.parse_usi(usi)
+            assert False
+        except requests.exceptions.HTTPError as e:
+            assert e.response.status_code == 503
+        assert usi not in parsing._unknown_usis
+        # A file can't be probed, and the spectrum isn't in the other files.
+        server.responses[replay.get_fixture_key(lookup_url)] = {
+            'status_code': 200, 'content_type': 'application/json',
+            'body': '{"row_data": ['
+                    '{"file_descriptor": "f.MSV000000003/peak/run1.mzML"}, '
+                    '{"file_descriptor": "f.MSV000000003/peak/run2.mzML"}]}'}
+        try:
+            parsing.parse_usi(usi)
+            assert False
+        except requests.exceptions.HTTPError as e:
+            assert e.response.status_code == 503
+        assert len(probed) == 2
+        assert usi not in parsing._unknown_usis
+    finally:
+        upstream.UPSTREAM_URL_OVERRIDE = url_override
+        upstream.UPSTREAM_RETRIES = retries
+        parsing._get_massive_spectrum = _get_massive_spectrum
+        file_index._index, file_index._index_initialized = None, False
+        parsing._unknown_usis.clear()
+        server.shutdown()
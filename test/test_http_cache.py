@@ -0,0 +1,61 @@
+import os
+import sys
+import tempfile
+
+import requests
+
+sys.path.insert(0, "..")
+import http_cache  # noqa: E402
+import spectrum_cache  # noqa: E402
+
+
+def _test_http_cache(cache):
+    response = requests.Response()
+    response.status_code, response.reason = 200, 'OK'
+    response.url = 'https://massbank.us/rest/spectra/BSU00002'
+    response.encoding = 'utf-8'
+    response.headers['Content-Type'] = 'application/json'
+    response._content = b'{"id": "BSU00002"}'
+    assert cache.get(response.url) is None
+    cache.put(response.url, response)
+    cached_response = cache.get(response.url)
+    assert cached_response.from_cache
+    assert cached_response.json() == {'id': 'BSU00002'}
+    assert cached_response.headers['content-type'] == 'application/json'
+    # Failed responses and responses from hosts that aren't cached.
+    response.status_code = 404
+    cache.put('https://massbank.us/rest/spectra/unknown', response)
+    assert cache.get('https://massbank.us/rest/spectra/unknown') is None
+    response.status_code = 200
+    cache.put('https://gnps.ucsd.edu/task', response)
+    assert cache.get('https://gnps.ucsd.edu/task') is None
+    assert cache.stats == {'hits': 1, 'misses': 2, 'stores': 1}
+    # Evict the least recently used responses once the cache exceeds its
+    # maximum size.
+    response._content = bytes(200)
+    for i in range(2):
+        cache.put(f'https://massbank.us/{i}', response)
+    assert cache.get('https://massbank.us/0') is not None
+    cache.put('https://massbank.us/2', response)
+    assert cache.get('https://massbank.us/1') is None
+    assert cache.get('https://massbank.us/0') is not None
+    assert cache.get('https://massbank.us/2') is not None
+
+
+def test_http_cache_memory():
+    _test_http_cache(http_cache.HttpCache(
+        spectrum_cache.LocalRedis(1024),
+        {'massbank.us': 60, 'gnps.ucsd.edu': 0}))
+
+
+def test_http_cache_sqlite():
+    touch_interval, http_cache.HTTP_CACHE_SQLITE_TOUCH_INTERVAL = \
+        http_cache.HTTP_CACHE_SQLITE_TOUCH_INTERVAL, 0
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            _test_http_cache(http_cache.HttpCache(
+                http_cache.SQLiteStore(os.path.join(directory, 'http.sqlite'),
+                                       1024),
+                {'massbank.us': 60, 'gnps.ucsd.edu': 0}))
+    finally:
+        http_cache.HTTP_CACHE_SQLITE_TOUCH_INTERVAL = touch_interval
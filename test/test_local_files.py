@@ -0,0 +1,59 @@
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, "..")
+import local_files  # noqa: E402
+import parsing  # noqa: E402
+
+
+def test_local_files():
+    from benchmarks import local_resolution
+    spectra = local_resolution.random_spectra(np.random.default_rng(1), 3, 5)
+    with tempfile.TemporaryDirectory() as directory:
+        local_resolution.write_mzml(os.path.join(directory, 'a.mzML'),
+                                    spectra)
+        local_resolution.write_mzml(os.path.join(directory, 'b.mzML'),
+                                    spectra, indexed=False, compress=False)
+        local_resolution.write_mzxml(os.path.join(directory, 'c.mzXML'),
+                                     spectra)
+        local_resolution.write_mgf(os.path.join(directory, 'd.mgf'), spectra)
+        with open(os.path.join(directory, 'e.mgf'), 'w') as f_out:
+            f_out.write('BEGIN IONS\nPEPMASS=500.1\n100.5 10\nEND IONS\n')
+        open(os.path.join(directory, 'f.mzML'), 'w').close()
+        index_dir = local_files.LOCAL_INDEX_DIR
+        local_files.LOCAL_INDEX_DIR = os.path.join(directory, 'index')
+        local_files.local_datasets['MSV000000003'] = directory
+        try:
+            for ms_run in ('a', 'b', 'c', 'd'):
+                for scan, precursor_mz, charge, mz, intensity in spectra:
+                    spectrum = local_files.get_spectrum(
+                        'msv000000003', ms_run, str(scan))
+                    np.testing.assert_allclose(spectrum.mz, mz)
+                    np.testing.assert_allclose(spectrum.intensity, intensity)
+                    assert spectrum.precursor_mz == precursor_mz
+                    assert spectrum.precursor_charge == charge
+                try:
+                    local_files.get_spectrum('MSV000000003', ms_run, '2')
+                    assert False
+                except ValueError:
+                    pass
+            assert len(os.listdir(local_files.LOCAL_INDEX_DIR)) == 4
+            # Spectra without a scan number and empty files are retrieved
+            # upstream instead.
+            assert local_files.get_spectrum('MSV000000003', 'e', '1') is None
+            assert local_files.get_spectrum('MSV000000003', 'f', '1') is None
+            # Persisted indexes are reused.
+            peak_file = local_files.PeakFile(os.path.join(directory, 'a.mzML'))
+            np.testing.assert_array_equal(peak_file.scans, [1, 3, 5])
+            assert local_files.get_spectrum('MSV000000003', 'g', '1') is None
+            assert local_files.get_spectrum('MSV000000004', 'a', '1') is None
+            spectrum, _ = parsing._parse_usi('mzspec:MSV000000003:c:scan:3')
+            np.testing.assert_allclose(spectrum.mz, spectra[1][3])
+        finally:
+            local_files.LOCAL_INDEX_DIR = index_dir
+            del local_files.local_datasets['MSV000000003']
+            local_files._listings.clear()
+            local_files._open.cache_clear()
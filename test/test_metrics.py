@@ -0,0 +1,44 @@
+import os
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, "..")
+import metrics  # noqa: E402
+
+
+def test_metrics():
+    import app
+    client = app.app.test_client()
+    assert client.get('/heartbeat').status_code == 200
+    metrics.stage_duration.observe(0.3, stage='test')
+    response = client.get('/metrics')
+    assert response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+    assert '# TYPE usi_request_duration_seconds histogram' in text
+    assert ('usi_request_duration_seconds_count'
+            '{route="/heartbeat",status="200"}') in text
+    assert ('usi_stage_duration_seconds_bucket{le="0.25",stage="test"} 0'
+            in text)
+    assert ('usi_stage_duration_seconds_bucket{le="0.5",stage="test"} 1'
+            in text)
+    # Aggregate the metrics of multiple (exited) worker processes.
+    with tempfile.TemporaryDirectory() as directory:
+        env = {**os.environ, 'PROMETHEUS_MULTIPROC_DIR': directory,
+               'PYTHONPATH': os.path.dirname(os.path.abspath(
+                   metrics.__file__))}
+
+        def run(code):
+            return subprocess.run(
+                [sys.executable, '-c', f'import os, metrics; {code}'],
+                env=env, stdout=subprocess.PIPE, universal_newlines=True,
+                check=True).stdout
+
+        pids = [run('metrics.cache_requests.inc(cache="test", result="hit");'
+                    'metrics.upstream_circuit_open.set(1, host="test");'
+                    'print(os.getpid())').strip() for _ in range(2)]
+        text = run(f'metrics.mark_process_dead({pids[0]});'
+                   f'print(metrics.generate_latest())')
+        assert ('usi_cache_requests_total{cache="test",result="hit"} 2.0'
+                in text)
+        assert 'usi_upstream_circuit_open{host="test"} 1.0' in text
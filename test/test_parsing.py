@@ -0,0 +1,124 @@
+import concurrent.futures
+import sys
+import time
+
+import requests
+import spectrum_utils.spectrum as sus
+
+sys.path.insert(0, "..")
+import parsing  # noqa: E402
+from usi_test_cases import test_usi_list  # noqa: E402
+
+
+def test_tokenize_usi():
+    for usi in test_usi_list:
+        try:
+            parsing.tokenize_usi(usi)
+        except ValueError:
+            assert parsing.parsing_legacy.is_legacy_usi(usi)
+    tokenized_usi = parsing.tokenize_usi(
+        'mzspec:pxd000561:run:SCAN:17555:PEPTM[UNIMOD:35]IDE/2')
+    assert tokenized_usi.collection_key == 'massive'
+    assert tokenized_usi.ms_run == 'run'
+    assert tokenized_usi.index == '17555'
+    assert tokenized_usi.interpretation == 'PEPTM[UNIMOD:35]IDE/2'
+    assert (tokenized_usi.normalized ==
+            'mzspec:PXD000561:run:scan:17555:PEPTM[UNIMOD:35]IDE/2')
+    for usi in ['mzdraft:PXD000561:run:scan:1', 'mzspec:PXD00056:run:scan:1',
+                'mzspec:GNPS:run:accession:', 'mzspec:MASSBANK::spectrum:1']:
+        try:
+            parsing.tokenize_usi(usi)
+            assert False, usi
+        except ValueError:
+            pass
+
+
+def test_parse_usi_batch():
+    resolved = []
+
+    def parse_usi(usi):
+        resolved.append(usi)
+        if usi.endswith('unknown'):
+            raise ValueError('Unknown USI')
+        return sus.MsmsSpectrum(usi, 0, 0, [100.], [1.]), usi
+
+    usis = ['mzspec:MOTIFDB::accession:batch1',
+            'mzspec:MOTIFDB::accession:unknown',
+            'mzspec:MASSBANK::accession:batch2',
+            'mzspec:MOTIFDB::accession:batch1']
+    _parse_usi, parsing._parse_usi = parsing._parse_usi, parse_usi
+    try:
+        results = list(parsing.parse_usi_batch(usis))
+    finally:
+        parsing._parse_usi = _parse_usi
+        parsing._unknown_usis.clear()
+    assert sorted(resolved) == sorted(set(usis))
+    assert [usi for usi, _, _ in results] == usis
+    assert results[0][1][1] == results[3][1][1] == usis[0]
+    assert results[1][1] is None and isinstance(results[1][2], ValueError)
+
+
+def test_parse_usi_single_flight():
+    resolved = []
+
+    def parse_usi(usi):
+        resolved.append(usi)
+        time.sleep(0.2)
+        if usi.endswith('unknown'):
+            raise ValueError('Unknown USI')
+        return sus.MsmsSpectrum(usi, 0, 0, [100.], [1.]), usi
+
+    usis = ['mzspec:MOTIFDB::accession:flight',
+            'MZSPEC:MOTIFDB::accession:flight',
+            'mzspec:MOTIFDB::accession:unknown',
+            'mzspec:motifdb::accession:unknown']
+    _parse_usi, parsing._parse_usi = parsing._parse_usi, parse_usi
+    try:
+        with concurrent.futures.ThreadPoolExecutor(len(usis)) as executor:
+            futures = [executor.submit(parsing.parse_usi, usi)
+                       for usi in usis]
+            concurrent.futures.wait(futures)
+    finally:
+        parsing._parse_usi = _parse_usi
+    assert len(resolved) == 2
+    assert futures[0].result() == futures[1].result()
+    assert isinstance(futures[2].exception(), ValueError)
+    assert isinstance(futures[3].exception(), ValueError)
+
+
+def test_negative_cache():
+    resolved = []
+
+    def parse_usi(usi):
+        resolved.append(usi)
+        if usi.endswith('unavailable'):
+            response = requests.Response()
+            response.status_code = 503
+            try:
+                raise requests.exceptions.HTTPError(response=response)
+            except requests.exceptions.HTTPError:
+                raise ValueError('Unknown MOTIFDB USI')
+        raise ValueError('Unknown MOTIFDB USI')
+
+    usis = ['mzspec:MOTIFDB::accession:negative',
+            'mzspec:MOTIFDB::accession:unavailable']
+    _parse_usi, parsing._parse_usi = parsing._parse_usi, parse_usi
+    try:
+        for usi in usis * 2:
+            try:
+                parsing.parse_usi(usi)
+                assert False
+            except ValueError as e:
+                assert str(e) == 'Unknown MOTIFDB USI'
+        # Server errors aren't remembered.
+        assert resolved == [usis[0], usis[1], usis[1]]
+        # Until the unknown USIs expire.
+        parsing._unknown_usis[usis[0]] = (0., 'Unknown MOTIFDB USI')
+        try:
+            parsing.parse_usi(usis[0])
+        except ValueError:
+            pass
+        assert resolved[-1] == usis[0]
+    finally:
+        parsing._parse_usi = _parse_usi
+        parsing._unknown_usis.clear()
@@ -0,0 +1,33 @@
+import sys
+
+import numpy as np
+
+sys.path.insert(0, "..")
+import peak_decoding  # noqa: E402
+
+
+def test_peak_decoding():
+    mz, intensity = [100.5, 200.25, 300.125], [1., 1e3, 0.5]
+    peak_list = [[m, i] for m, i in zip(mz, intensity)]
+    for decoded_mz, decoded_intensity in (
+            peak_decoding.decode_peak_string(
+                '100.5:1 200.25:1000 300.125:0.5'),
+            peak_decoding.decode_peak_list(peak_list),
+            peak_decoding.decode_peak_json(str(peak_list)),
+            peak_decoding.decode_peak_json(
+                '[[100.5, 1], [200.25, 1.0E3], [300.125, 0.5]]')):
+        np.testing.assert_array_equal(decoded_mz, mz)
+        np.testing.assert_array_equal(decoded_intensity, intensity)
+    for peaks in ('[]', 'null', '[[1, 2], [3, "x"]]', '[[1, 2], [3, 4, 5]]',
+                  '[[1, 2, 3], [4]]', '[[1e, 2]]'):
+        try:
+            peak_decoding.decode_peak_json(peaks)
+            assert False, peaks
+        except ValueError:
+            pass
+    for peaks in ([[1, 2], [3, 4, 5]], [[1, 2], 3]):
+        try:
+            peak_decoding.decode_peak_list(peaks)
+            assert False, peaks
+        except ValueError:
+            pass
@@ -0,0 +1,48 @@
+import base64
+import csv
+import io
+import sys
+
+import numpy as np
+import spectrum_utils.spectrum as sus
+
+sys.path.insert(0, "..")
+import parsing  # noqa: E402
+import views  # noqa: E402
+
+
+def test_peak_export():
+    import app
+    client = app.app.test_client()
+    mz, intensity = np.sort(np.random.uniform(50, 2000, 25)), np.ones(25)
+    spectrum = sus.MsmsSpectrum('export', 500.5, 2, mz, intensity)
+    usi = 'mzspec:MOTIFDB::accession:export'
+    _parse_usi = parsing._parse_usi
+    parsing._parse_usi = lambda usi: (spectrum, usi)
+    export_chunk_size = views.peak_export.EXPORT_CHUNK_SIZE
+    views.peak_export.EXPORT_CHUNK_SIZE = 10
+    try:
+        result = client.get('/json/', query_string={'usi': usi}).get_json()
+        assert result['n_peaks'] == 25 and result['precursor_mz'] == 500.5
+        assert result['peaks'] == [[float(m), float(i)] for m, i in
+                                   zip(spectrum.mz, spectrum.intensity)]
+        result = client.get('/json/', query_string={
+            'usi': usi, 'format': 'base64'}).get_json()
+        np.testing.assert_array_equal(np.frombuffer(
+            base64.b64decode(result['mz']), result['dtype']), spectrum.mz)
+        result = client.get('/api/proxi/v0.1/spectra',
+                            query_string={'usi': usi}).get_json()
+        assert result[0]['mzs'] == spectrum.mz.tolist()
+        assert result[0]['attributes'][1]['value'] == 2
+        response = client.get('/csv/', query_string={'usi': usi})
+        assert 'export.csv' in response.headers['Content-Disposition']
+        rows = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+        assert rows[0] == ['mz', 'intensity'] and len(rows) == 26
+        assert np.float32(rows[1][0]) == spectrum.mz[0]
+        response = client.get('/npy/', query_string={'usi': usi})
+        np.testing.assert_array_equal(
+            np.load(io.BytesIO(response.get_data())),
+            np.column_stack((spectrum.mz, spectrum.intensity)))
+    finally:
+        parsing._parse_usi = _parse_usi
+        views.peak_export.EXPORT_CHUNK_SIZE = export_chunk_size
@@ -0,0 +1,74 @@
+import sys
+import time
+
+import spectrum_utils.spectrum as sus
+
+sys.path.insert(0, "..")
+import parsing  # noqa: E402
+import prefetch  # noqa: E402
+import spectrum_cache  # noqa: E402
+import views  # noqa: E402
+
+
+def test_prefetch():
+    rate_limiter = prefetch.RateLimiter(20)
+    start = time.perf_counter()
+    for _ in range(5):
+        rate_limiter.acquire()
+    assert time.perf_counter() - start >= 0.19
+    resolved = []
+
+    def parse_usi(usi):
+        resolved.append(usi)
+        if usi.endswith(':4'):
+            raise ValueError('Unknown USI')
+        return sus.MsmsSpectrum(usi, 0, 0, [100.], [1.]), 'gnps'
+
+    task = 'mzspec:GNPS:TASK-0123456789abcdef0123456789abcdef-f.mzML:scan:'
+    store = spectrum_cache.RedisSpectrumStore(
+        spectrum_cache.LocalRedis(1024 ** 2))
+    prefetcher = prefetch.Prefetcher(parsing._resolve_usi, parsing._is_cached)
+    _parse_usi, parsing._parse_usi = parsing._parse_usi, parse_usi
+    _prefetcher, parsing._prefetcher = parsing._prefetcher, prefetcher
+    prefetch_scans, prefetch.PREFETCH_SCANS = prefetch.PREFETCH_SCANS, 1
+    spectrum_cache._store, spectrum_cache._store_initialized = store, True
+    admin_token, views.ADMIN_TOKEN = views.ADMIN_TOKEN, 'secret'
+    try:
+        parsing.parse_usi(f'{task}5')
+        prefetcher.join()
+        assert sorted(resolved) == [f'{task}4', f'{task}5', f'{task}6']
+        assert store.get(f'{task}6') is not None
+        # Prefetched spectra are served from the store, and cached neighbors
+        # aren't resolved again.
+        parsing.parse_usi(f'{task}6')
+        prefetcher.join()
+        assert sorted(resolved) == [f'{task}4', f'{task}5', f'{task}6',
+                                    f'{task}7']
+        import app
+        client = app.app.test_client()
+        args = {'task': '0123456789abcdef0123456789abcdef', 'file': 'f.mzML',
+                'scans': '1-3,8'}
+        assert client.post('/admin/prefetch/', json=args).status_code == 403
+        headers = {'Authorization': 'Bearer secret'}
+        response = client.post('/admin/prefetch/', json=args,
+                               headers=headers)
+        assert response.status_code == 202
+        assert response.get_json() == {'queued': 4, 'dropped': 0}
+        prefetcher.join()
+        assert {f'{task}{scan}' for scan in (1, 2, 3, 8)} <= set(resolved)
+        for scans in ('', '3-1', '0', 'a', '1-100000'):
+            assert client.post('/admin/prefetch/', headers=headers, json={
+                **args, 'scans': scans}).status_code == 400
+    finally:
+        parsing._parse_usi = _parse_usi
+        parsing._prefetcher = _prefetcher
+        prefetch.PREFETCH_SCANS = prefetch_scans
+        spectrum_cache._store, spectrum_cache._store_initialized = None, False
+        views.ADMIN_TOKEN = admin_token
+    # The queue is bounded.
+    prefetcher = prefetch.Prefetcher(lambda key: time.sleep(0.1),
+                                     lambda key: False, max_pending=2,
+                                     num_threads=1)
+    assert [prefetcher.submit(key, 'host') for key in 'aab'] == [True] * 3
+    assert not prefetcher.submit('c', 'host')
+    prefetcher.join()
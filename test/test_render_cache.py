@@ -0,0 +1,27 @@
+import sys
+import tempfile
+
+sys.path.insert(0, "..")
+import render_cache  # noqa: E402
+
+
+def test_render_cache():
+    plotting_args = {'width': 10, 'height': 6, 'annotate_peaks': [[1.5], []]}
+    key = render_cache.get_key(['usi1', 'usi2'], 'png', plotting_args)
+    assert key == render_cache.get_key(['usi1', 'usi2'], 'png',
+                                       dict(reversed(list(
+                                           plotting_args.items()))))
+    assert key != render_cache.get_key(['usi1', 'usi2'], 'svg',
+                                       plotting_args)
+    with tempfile.TemporaryDirectory() as directory:
+        cache = render_cache.RenderCache(10, directory, 1024)
+        figure = cache.put(key, b'0123456789', 60)
+        assert cache.get(key) == figure
+        cache.put('other', b'abcdefghij', 60)
+        # Evicted from memory but still available from disk.
+        assert cache.get(key) == figure
+        # Expired figures aren't served from memory or disk.
+        cache.put('expired', b'0123456789', -1)
+        assert cache.get('expired') is None
+        cache._figures.clear()
+        assert cache.get('expired') is None and cache.get(key) == figure
@@ -0,0 +1,38 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import spectrum_utils.spectrum as sus
+
+sys.path.insert(0, "..")
+import rendering  # noqa: E402
+import views  # noqa: E402
+
+
+def test_rendering():
+    plotting_args = {**views.default_plotting_args, 'annotate_peaks': True,
+                     'mz_min': None, 'mz_max': None, 'max_intensity': 1.5}
+    spectrum_top = sus.MsmsSpectrum(
+        'top', 500., 2, np.linspace(100, 900, 50), np.linspace(0, 1, 50))
+    spectrum_bottom = sus.MsmsSpectrum(
+        'bottom', 500., 2, np.linspace(100, 900, 50), np.linspace(1, 0, 50))
+    assert rendering.render(
+        rendering.render_spectrum, 'top', spectrum_top, 'url', 'png',
+        **plotting_args).startswith(b'\x89PNG')
+    assert b'Cosine similarity' not in rendering.render(
+        rendering.render_mirror, 'top', 'bottom', spectrum_top,
+        spectrum_bottom, None, 'url', 'svg', **plotting_args)
+    # Cooperative workers render in-process instead of in a process pool.
+    code = ('from gevent import monkey; monkey.patch_all();'
+            'import numpy as np, spectrum_utils.spectrum as sus, rendering;'
+            'rendering.RENDER_PROCESSES = 2;'
+            'spectrum = sus.MsmsSpectrum("top", 500., 2,'
+            ' np.linspace(100, 900, 50), np.linspace(0, 1, 50));'
+            'figure = rendering.render(rendering.render_spectrum, "top",'
+            ' spectrum, "url", "png", **%r);'
+            'assert figure.startswith(b"\\x89PNG");'
+            'assert rendering._get_pool() is None' % plotting_args)
+    subprocess.run([sys.executable, '-c', code], check=True, timeout=300,
+                   env={**os.environ, 'PYTHONPATH': os.path.dirname(
+                       os.path.abspath(rendering.__file__))})
@@ -0,0 +1,71 @@
+import sys
+
+import numpy as np
+import spectrum_utils.spectrum as sus
+
+sys.path.insert(0, "..")
+import parsing  # noqa: E402
+import peak_export  # noqa: E402
+import similarity  # noqa: E402
+import upstream  # noqa: E402
+
+
+def test_cosine_large_spectra():
+    # Peak indexes beyond the uint16 range.
+    mz = np.arange(100000, dtype=np.float32) / 40 + 100
+    spectrum = sus.MsmsSpectrum('large', 500., 1, mz, np.ones_like(mz))
+    score, peak_matches = similarity.cosine(spectrum, spectrum, 0.01, False)
+    assert np.isclose(score, 1)
+    np.testing.assert_array_equal(np.sort(peak_matches[:, 0]),
+                                  np.arange(len(mz)))
+    np.testing.assert_array_equal(peak_matches[:, 0], peak_matches[:, 1])
+    # A peak that matches multiple other peaks is only used once.
+    spectrum_other = sus.MsmsSpectrum('other', 500., 1, [99.995, 100.005],
+                                      [1., 2.])
+    score, peak_matches = similarity.cosine(spectrum, spectrum_other, 0.01,
+                                            False)
+    np.testing.assert_array_equal(peak_matches, [[0, 1]])
+
+
+def test_cosine_matrix():
+    rng = np.random.default_rng(42)
+    spectra = [sus.MsmsSpectrum(
+        str(i), rng.uniform(300, 800), i % 3, np.linspace(100, 300, 20)
+        + rng.integers(0, 2, 20) * 10, rng.uniform(0, 1, 20))
+        for i in range(6)]
+    for allow_shift in (False, True):
+        scores = similarity.cosine_matrix(spectra, 0.02, allow_shift)
+        for i, spectrum1 in enumerate(spectra):
+            for j, spectrum2 in enumerate(spectra):
+                assert np.isclose(scores[i, j], similarity.cosine(
+                    spectrum1, spectrum2, 0.02, allow_shift)[0])
+    indexes, top_scores = similarity.top_k(scores, 2)
+    assert indexes.shape == top_scores.shape == (6, 2)
+    assert all(i not in row for i, row in enumerate(indexes))
+    assert np.all(top_scores[:, 0] >= top_scores[:, 1])
+    np.testing.assert_array_equal(
+        top_scores[:, 0], np.max(scores - np.eye(6) * 2, axis=1))
+    # The score matrix is streamed in chunks of rows.
+    import app
+    client = app.app.test_client()
+    usis = [f'mzspec:MOTIFDB::accession:matrix{i}' for i in range(6)]
+
+    def parse_usi(usi):
+        if usi.endswith('unavailable'):
+            raise upstream.UpstreamUnavailableError('Upstream unavailable')
+        return spectra[usis.index(usi)], usi
+
+    _parse_usi, parsing._parse_usi = parsing._parse_usi, parse_usi
+    export_chunk_size = peak_export.EXPORT_CHUNK_SIZE
+    peak_export.EXPORT_CHUNK_SIZE = 10
+    try:
+        result = client.post('/json/similarity/', json=usis + [
+            'mzspec:MOTIFDB::accession:unavailable']).get_json()
+    finally:
+        parsing._parse_usi = _parse_usi
+        peak_export.EXPORT_CHUNK_SIZE = export_chunk_size
+    assert result['usis'] == usis
+    np.testing.assert_allclose(
+        result['scores'], similarity.cosine_matrix(spectra, 0.02, False),
+        atol=1e-6)
+    assert result['errors'][0]['error']['code'] == 503
@@ -0,0 +1,104 @@
+import concurrent.futures
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import spectrum_utils.spectrum as sus
+
+sys.path.insert(0, "..")
+import parsing  # noqa: E402
+import spectrum_cache  # noqa: E402
+
+
+def _test_spectrum_store(store):
+    usi = 'mzspec:MASSBANK::accession:BSU00002'
+    spectrum = sus.MsmsSpectrum(usi, 200.5, 1, [100., 150., 200.],
+                                [10., 30., 20.])
+    assert store.get(usi) is None
+    store.put(usi, spectrum, 'https://massbank.eu', 'massbank')
+    cached_spectrum, source_link = store.get(usi)
+    assert source_link == 'https://massbank.eu'
+    assert cached_spectrum.precursor_mz == spectrum.precursor_mz
+    assert cached_spectrum.precursor_charge == spectrum.precursor_charge
+    np.testing.assert_array_equal(cached_spectrum.mz, spectrum.mz)
+    np.testing.assert_array_equal(cached_spectrum.intensity,
+                                  spectrum.intensity)
+    store.ttl = {'massbank': -1}
+    store.put('expired', spectrum, 'https://massbank.eu', 'massbank')
+    assert store.get('expired') is None
+
+
+def test_spectrum_store_disk():
+    with tempfile.TemporaryDirectory() as directory:
+        _test_spectrum_store(
+            spectrum_cache.DiskSpectrumStore(directory, 1024 ** 2))
+    # Spectra of collections that aren't cached aren't written.
+    with tempfile.TemporaryDirectory() as directory:
+        store = spectrum_cache.DiskSpectrumStore(directory, 1024 ** 2,
+                                                 {'massbank': 0})
+        store.put('usi', sus.MsmsSpectrum('usi', 200.5, 1, [100.], [1.]),
+                  'https://massbank.eu', 'massbank')
+        assert os.listdir(directory) == []
+    # The directory is only scanned when the store exceeds its maximum size.
+    with tempfile.TemporaryDirectory() as directory:
+        store = spectrum_cache.DiskSpectrumStore(directory, 2000)
+        scans = []
+        scan_and_evict = store._scan_and_evict
+        store._scan_and_evict = lambda: scans.append(1) or scan_and_evict()
+        spectrum = sus.MsmsSpectrum('usi', 200.5, 1, np.arange(10.),
+                                    np.ones(10))
+        for i in range(10):
+            store.put(f'usi{i}', spectrum, 'https://massbank.eu', 'massbank')
+        assert 1 < len(scans) < 10
+        assert scan_and_evict() <= 2000
+        assert store.get('usi9') is not None and store.get('usi0') is None
+
+
+def test_spectrum_store_local():
+    _test_spectrum_store(spectrum_cache.RedisSpectrumStore(
+        spectrum_cache.LocalRedis(1024 ** 2)))
+
+
+def test_spectrum_store_normalized():
+    resolved = []
+
+    def parse_usi(usi):
+        resolved.append(usi)
+        time.sleep(0.2)
+        return sus.MsmsSpectrum(usi, 0, 0, [100.], [1.]), usi
+
+    usis = ['mzspec:MOTIFDB::accession:store',
+            'MZSPEC:motifdb::accession:store']
+    _parse_usi, parsing._parse_usi = parsing._parse_usi, parse_usi
+    with tempfile.TemporaryDirectory() as directory:
+        spectrum_cache._store = spectrum_cache.DiskSpectrumStore(
+            directory, 1024 ** 2)
+        spectrum_cache._store_initialized = True
+        try:
+            # Both spellings wait on the same lock and share the store entry
+            # (without the per-process single-flight of `parse_usi`).
+            with concurrent.futures.ThreadPoolExecutor(2) as executor:
+                list(executor.map(parsing._resolve_usi, usis))
+            assert len(resolved) == 1
+            assert all(parsing._is_cached(usi) for usi in usis)
+        finally:
+            parsing._parse_usi = _parse_usi
+            spectrum_cache._store = None
+            spectrum_cache._store_initialized = False
+
+
+def test_spectrum_store_lock():
+    with tempfile.TemporaryDirectory() as directory:
+        for store in (spectrum_cache.DiskSpectrumStore(directory, 1024 ** 2),
+                      spectrum_cache.RedisSpectrumStore(
+                          spectrum_cache.LocalRedis(1024 ** 2))):
+            with store.lock('usi', 1) as locked:
+                assert locked
+                with store.lock('usi', 0.1) as locked_again:
+                    assert not locked_again
+                with store.lock('other', 0.1) as locked_other:
+                    assert locked_other
+            with store.lock('usi', 0.1) as locked:
+                assert locked
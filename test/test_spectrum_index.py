@@ -0,0 +1,50 @@
+import sys
+
+import numpy as np
+import spectrum_utils.spectrum as sus
+
+sys.path.insert(0, "..")
+import similarity  # noqa: E402
+import spectrum_index  # noqa: E402
+
+
+def test_spectrum_index():
+    rng = np.random.default_rng(42)
+    mz = np.sort(rng.uniform(100, 500, 50))
+    spectra = [sus.MsmsSpectrum(
+        str(i), 500., 1, mz + rng.normal(0, 0.005, 50) * (i % 2),
+        rng.uniform(0, 1, 50)) for i in range(10)]
+    index = spectrum_index.SpectrumIndex(8, 0.05, 1000, 3)
+    for i, spectrum in enumerate(spectra):
+        index.add(f'usi{i}', spectrum)
+    # The first spectra were replaced.
+    assert len(index) == 8
+    # The candidates' peaks are retrieved to re-score them.
+    matches = index.search(spectra[0], 0.02, False, 3, exclude='usi9',
+                           get_spectrum=lambda usi: spectra[int(usi[3:])])
+    expected = sorted(((similarity.cosine(spectra[0], spectrum, 0.02,
+                                          False)[0], f'usi{i}')
+                       for i, spectrum in enumerate(spectra[2:9], 2)),
+                      reverse=True)[:3]
+    assert [match.usi for match in matches] == [usi for _, usi in expected]
+    assert np.allclose([match.score for match in matches],
+                       [score for score, _ in expected])
+    assert all(match.exact for match in matches)
+    # Otherwise they're scored with their approximate similarity.
+    matches = index.search(spectra[0], 0.02, False, 3, exclude='usi9')
+    assert len(matches) == 3 and all(0 < match.score <= 1 + 1e-6
+                                     for match in matches)
+    assert all(0 < match.matched_peaks <= 50 and not match.exact
+               for match in matches)
+    assert index.search(sus.MsmsSpectrum('empty', 500., 1, [], []), 0.02,
+                        False, 3) == []
+    import app
+    max_spectra, spectrum_index.index.max_spectra = \
+        spectrum_index.index.max_spectra, 0
+    try:
+        response = app.app.test_client().get('/json/search/', query_string={
+            'usi': 'mzspec:MASSBANK::accession:BSU00002'})
+        assert response.status_code == 404
+        assert 'disabled' in response.get_json()['error']['message']
+    finally:
+        spectrum_index.index.max_spectra = max_spectra
@@ -0,0 +1,33 @@
+import sys
+
+import numpy as np
+import spectrum_utils.spectrum as sus
+
+sys.path.insert(0, "..")
+import spectrum_view  # noqa: E402
+
+
+def test_spectrum_view():
+    spectrum = spectrum_view.freeze(sus.MsmsSpectrum(
+        'usi', 500., 2, [100., 200., 300., 400.], [1., 4., 2., 8.]))
+    view = spectrum_view.SpectrumView(spectrum)
+    view.annotate_mz_fragment(200.01, 0.02, '200')
+    view.annotate_mz_fragment(400., 0.02)
+    try:
+        view.annotate_mz_fragment(250., 0.02)
+        assert False
+    except ValueError:
+        pass
+    plotted = view.set_mz_range(150., 300.).to_spectrum()
+    np.testing.assert_array_equal(plotted.mz, [200., 300.])
+    np.testing.assert_array_equal(plotted.intensity, [1., 0.5])
+    assert plotted.annotation[0].annotation == '200'
+    assert plotted.annotation[1] is None
+    # The cached spectrum is unmodified.
+    np.testing.assert_array_equal(spectrum.intensity, [1., 4., 2., 8.])
+    assert spectrum.annotation is None
+    try:
+        spectrum.intensity[0] = 0
+        assert False
+    except ValueError:
+        pass
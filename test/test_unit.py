@@ -1,9 +1,9 @@
 import sys
+
 sys.path.insert(0, "..")
 import parsing  # noqa: E402
-
-import views
-from usi_test_cases import test_usi_list
+import views  # noqa: E402
+from usi_test_cases import test_usi_list  # noqa: E402
 
 
 def test_uri_parse():
@@ -0,0 +1,80 @@
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, "..")
+import metrics  # noqa: E402
+import parsing  # noqa: E402
+import upstream  # noqa: E402
+
+
+def test_upstream_replay():
+    from benchmarks import replay
+    url = 'https://massbank.us/rest/spectra/REPLAY0001'
+    server = replay.start_replay_server({url: {
+        'status_code': 200, 'content_type': 'application/json',
+        'body': '{"spectrum": "100.5:10 200.25:100", "metaData": '
+                '[{"name": "precursor m/z", "value": 300.1}]}'}})
+    url_override = upstream.UPSTREAM_URL_OVERRIDE
+    upstream.UPSTREAM_URL_OVERRIDE = server.url
+    try:
+        spectrum, _ = parsing._parse_usi(
+            'mzspec:MASSBANK::accession:REPLAY0001')
+        assert spectrum.precursor_mz == 300.1
+        np.testing.assert_array_equal(spectrum.mz, [100.5, 200.25])
+        try:
+            parsing._parse_usi('mzspec:MASSBANK::accession:REPLAY0002')
+            assert False
+        except ValueError:
+            pass
+    finally:
+        upstream.UPSTREAM_URL_OVERRIDE = url_override
+        server.shutdown()
+
+
+def test_upstream_circuit_breaker():
+    from benchmarks import replay
+    breaker = upstream.CircuitBreaker('test', 2, 0.1)
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.record(False)
+    assert breaker.get_status()['state'] == 'open'
+    assert not breaker.allow()
+    time.sleep(0.15)
+    # A single trial request after the cooldown.
+    assert breaker.allow() and not breaker.allow()
+    breaker.record(True)
+    assert breaker.get_status() == {'state': 'closed', 'failures': 0}
+    url = 'https://breaker.test/unavailable'
+    server = replay.start_replay_server({url: {
+        'status_code': 503, 'content_type': 'text/plain', 'body': ''}})
+    url_override = upstream.UPSTREAM_URL_OVERRIDE
+    upstream.UPSTREAM_URL_OVERRIDE = server.url
+    retries, upstream.UPSTREAM_RETRIES = upstream.UPSTREAM_RETRIES, 0
+    threshold, upstream.UPSTREAM_BREAKER_THRESHOLD = \
+        upstream.UPSTREAM_BREAKER_THRESHOLD, 2
+    try:
+        # Client errors don't count as failures.
+        assert upstream.get('https://breaker.test/unknown').status_code == 404
+        assert upstream.get(url).status_code == 503
+        assert upstream.get(url).status_code == 503
+        try:
+            upstream.get('https://breaker.test/unknown')
+            assert False
+        except upstream.UpstreamUnavailableError:
+            pass
+        import app
+        client = app.app.test_client()
+        status = client.get('/upstream/status').get_json()
+        assert status['breaker.test']['state'] == 'open'
+        assert status['breaker.test']['failures'] == 2
+        assert 'usi_upstream_circuit_open{host="breaker.test"} 1' in \
+            metrics.generate_latest()
+    finally:
+        upstream.UPSTREAM_URL_OVERRIDE = url_override
+        upstream.UPSTREAM_RETRIES = retries
+        upstream.UPSTREAM_BREAKER_THRESHOLD = threshold
+        upstream._breakers.pop('breaker.test', None)
+        upstream._sessions.pop('breaker.test', None)
+        server.shutdown()
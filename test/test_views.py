@@ -0,0 +1,82 @@
+import sys
+
+import numpy as np
+import spectrum_utils.spectrum as sus
+
+sys.path.insert(0, "..")
+import parsing  # noqa: E402
+import views  # noqa: E402
+
+
+def test_generate_labels():
+    spectrum = sus.MsmsSpectrum('labels', 500., 1,
+                                [100., 101., 150., 200., 300.],
+                                [10., 9., 8., 7., 1.])
+    # Peaks within the exclusion window (10 m/z) of a more intense labeled
+    # peak aren't labeled.
+    assert views._generate_labels(spectrum) == [0, 2, 3, 4]
+    assert views._generate_labels(spectrum, 5) == [0, 2, 3]
+    assert views._generate_labels(spectrum, 20) == []
+
+
+def test_plot_payload():
+    import app
+    client = app.app.test_client()
+    spectra = {
+        'mzspec:MOTIFDB::accession:plot1': sus.MsmsSpectrum(
+            'plot1', 500.5, 2, [100.12345, 200.5, 300.25], [5., 10., 2.5]),
+        'mzspec:MOTIFDB::accession:plot2': sus.MsmsSpectrum(
+            'plot2', 500.5, 2, [100.12, 250., 300.26], [1., 4., 2.])}
+    usi1, usi2 = spectra
+
+    def parse_usi(usi):
+        if usi not in spectra:
+            raise ValueError('Unknown USI')
+        return spectra[usi], usi
+
+    _parse_usi, parsing._parse_usi = parsing._parse_usi, parse_usi
+    try:
+        result = client.get('/json/plot/', query_string={
+            'usi': usi1, 'annotate_precision': 2}).get_json()
+        assert result['mz_decimals'] == 2 and 'cosine' not in result
+        spectrum = result['spectra'][0]
+        assert spectrum['n_peaks'] == 3 and spectrum['precursor_charge'] == 2
+        np.testing.assert_allclose(np.cumsum(spectrum['mz']) / 100,
+                                   [100.12, 200.5, 300.25])
+        assert spectrum['intensity'] == [5000, 10000, 2500]
+        assert spectrum['labels'] == views._generate_labels(spectra[usi1])
+        result = client.get('/json/plot/', query_string={
+            'usi1': usi1, 'usi2': usi2}).get_json()
+        assert len(result['spectra']) == 2
+        assert result['cosine']['type'] == 'standard'
+        assert sorted(result['cosine']['matches']) == [[0, 0], [2, 2]]
+        assert 0 < result['cosine']['score'] < 1
+        response = client.get('/json/plot/', query_string={
+            'usi': usi1, 'annotate_precision': 20})
+        assert response.status_code == 400
+        response = client.get('/json/plot/', query_string={
+            'usi': 'mzspec:MOTIFDB::accession:plot_unknown'})
+        assert response.status_code == 404
+        # The payload is cached and can be revalidated.
+        response = client.get('/json/plot/', query_string={'usi': usi1})
+        assert response.headers['ETag']
+        assert client.get('/json/plot/', query_string={'usi': usi1}, headers={
+            'If-None-Match': response.headers['ETag']}).status_code == 304
+        # The spectrum is drawn in the browser from the payload, or rendered by
+        # the server.
+        html = client.get('/spectrum/', query_string={
+            'usi': usi1}).get_data(as_text=True)
+        assert f'const plot_usis = ["{usi1}"]' in html
+        assert '"intensity_scale"' not in html and 'src="/svg/' not in html
+        html = client.get('/spectrum/', query_string={
+            'usi': usi1, 'renderer': 'server'}).get_data(as_text=True)
+        assert 'src="/svg/' in html
+        for args in [{'annotate_precision': 20}, {'annotate_precision': 'abc'},
+                     {'mz_min': 'foo'}]:
+            assert client.get('/spectrum/', query_string={
+                'usi': usi1, **args}).status_code == 400
+            assert client.get('/mirror/', query_string={
+                'usi1': usi1, 'usi2': usi2, **args}).status_code == 400
+    finally:
+        parsing._parse_usi = _parse_usi
+        parsing._unknown_usis.clear()
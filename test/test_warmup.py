@@ -0,0 +1,11 @@
+import sys
+
+sys.path.insert(0, "..")
+import similarity  # noqa: E402
+import warmup  # noqa: E402
+
+
+def test_warm_up():
+    warmup.warm_up()
+    assert len(similarity._cosine.signatures) > 0
+    assert len(similarity._cosine_matrix.signatures) > 0
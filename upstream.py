@@ -0,0 +1,258 @@
+import os
+import threading
+import time
+import urllib.parse
+from typing import Dict
+
+import requests
+import requests.adapters
+from urllib3.util.retry import Retry
+
+import http_cache
+import metrics
+
+
+# Connection and read timeouts (in seconds) of upstream requests.
+UPSTREAM_CONNECT_TIMEOUT = float(
+    os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 5))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', 60))
+# Number of retries of failed upstream requests, with exponential backoff.
+UPSTREAM_RETRIES = int(os.environ.get('UPSTREAM_RETRIES', 2))
+UPSTREAM_BACKOFF_FACTOR = float(
+    os.environ.get('UPSTREAM_BACKOFF_FACTOR', 0.5))
+# Number of pooled keep-alive connections per upstream host.
+# Can be overridden as a comma-separated list of host=size pairs in the
+# UPSTREAM_POOL_SIZES environment variable.
+UPSTREAM_DEFAULT_POOL_SIZE = int(
+    os.environ.get('UPSTREAM_DEFAULT_POOL_SIZE', 10))
+pool_sizes = {
+    'gnps.ucsd.edu': 20,
+    'massive.ucsd.edu': 10,
+    'massbank.us': 10,
+    'ms2lda.org': 10,
+}
+for _pool_size in filter(None,
+                         os.environ.get('UPSTREAM_POOL_SIZES', '').split(',')):
+    _host, _size = _pool_size.split('=')
+    pool_sizes[_host.strip().lower()] = int(_size)
+
+# Number of consecutive failed requests (connection errors, timeouts, and
+# server errors) to an upstream host after which further requests to it fail
+# immediately for UPSTREAM_BREAKER_COOLDOWN seconds, or 0 to never stop
+# requesting unhealthy hosts.
+UPSTREAM_BREAKER_THRESHOLD = int(
+    os.environ.get('UPSTREAM_BREAKER_THRESHOLD', 5))
+UPSTREAM_BREAKER_COOLDOWN = float(
+    os.environ.get('UPSTREAM_BREAKER_COOLDOWN', 30))
+
+# Optional base URL of a stand-in server to which all upstream requests are
+# redirected (e.g. the replay server in `benchmarks/replay.py`), as
+# {UPSTREAM_URL_OVERRIDE}/{scheme}/{host}/{path}?{query}.
+UPSTREAM_URL_OVERRIDE = os.environ.get('UPSTREAM_URL_OVERRIDE', '')
+
+_sessions: Dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+
+class UpstreamUnavailableError(requests.exceptions.ConnectionError):
+    """
+    An upstream host isn't requested because it's considered unhealthy.
+    """
+
+
+class CircuitBreaker:
+    """
+    Track the health of an upstream host from the outcome of its requests.
+
+    After `threshold` consecutive failures the circuit opens, and requests
+    are rejected for `cooldown` seconds. Then a single trial request is
+    allowed (half-open), which closes the circuit if it succeeds or opens it
+    again if it fails.
+    """
+
+    def __init__(self, host: str, threshold: int, cooldown: float) -> None:
+        self.host = host
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.failures = 0
+        self._opened = 0.
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """
+        Check whether a request is allowed, and if so, record that it's sent.
+
+        Returns
+        -------
+        bool
+            False if the request should be rejected, True otherwise. The
+            outcome of allowed requests needs to be recorded.
+        """
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if (self.state == 'open'
+                    and time.monotonic() - self._opened >= self.cooldown):
+                self.state = 'half_open'
+                return True
+        metrics.upstream_circuit_events.inc(host=self.host, event='rejected')
+        return False
+
+    def record(self, success: bool) -> None:
+        """
+        Record the outcome of an allowed request.
+
+        Parameters
+        ----------
+        success : bool
+            Whether the host responded without a server error.
+        """
+        with self._lock:
+            previous_state = self.state
+            if success:
+                self.state, self.failures = 'closed', 0
+            else:
+                self.failures += 1
+                if (self.state == 'half_open' or (
+                        self.threshold and self.failures >= self.threshold)):
+                    self.state, self._opened = 'open', time.monotonic()
+            state = self.state
+        if state != previous_state and state != 'half_open':
+            metrics.upstream_circuit_events.inc(
+                host=self.host, event='opened' if state == 'open'
+                else 'closed')
+            metrics.upstream_circuit_open.set(int(state == 'open'),
+                                              host=self.host)
+
+    def get_status(self) -> Dict:
+        with self._lock:
+            status = {'state': self.state, 'failures': self.failures}
+            if self.state == 'open':
+                status['retry_after'] = round(max(
+                    0., self._opened + self.cooldown - time.monotonic()), 3)
+            return status
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    """
+    Send a GET request to an upstream repository.
+
+    Requests are sent over a pooled keep-alive session per host, with default
+    timeouts and retries of failed connections and server errors. Successful
+    responses are cached (see `http_cache`). Hosts that fail repeatedly
+    aren't requested for a while (see `CircuitBreaker`).
+
+    Parameters
+    ----------
+    url : str
+        The URL to retrieve.
+    kwargs
+        Additional arguments for `requests.Session.get`.
+
+    Returns
+    -------
+    requests.Response
+        The upstream response.
+
+    Raises
+    ------
+    UpstreamUnavailableError
+        If the host's circuit breaker is open.
+    """
+    if 'params' in kwargs:
+        url = requests.Request('GET', url,
+                               params=kwargs.pop('params')).prepare().url
+    cache = http_cache.get_cache()
+    response = cache.get(url) if cache is not None else None
+    if response is not None:
+        return response
+    kwargs.setdefault('timeout',
+                      (UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT))
+    host = urllib.parse.urlsplit(url).hostname
+    breaker = get_breaker(host)
+    if not breaker.allow():
+        raise UpstreamUnavailableError(f'Upstream host {host} is unavailable')
+    success = False
+    try:
+        response = _get_session(host).get(
+            _override_url(url) if UPSTREAM_URL_OVERRIDE else url, **kwargs)
+        success = response.status_code < 500
+    finally:
+        breaker.record(success)
+    if cache is not None:
+        cache.put(url, response)
+    return response
+
+
+def get_breaker(host: str) -> CircuitBreaker:
+    """
+    Get the circuit breaker of an upstream host.
+
+    Parameters
+    ----------
+    host : str
+        The upstream host.
+
+    Returns
+    -------
+    CircuitBreaker
+        The circuit breaker of the host in this worker process.
+    """
+    breaker = _breakers.get(host)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(host)
+            if breaker is None:
+                breaker = _breakers[host] = CircuitBreaker(
+                    host, UPSTREAM_BREAKER_THRESHOLD,
+                    UPSTREAM_BREAKER_COOLDOWN)
+    return breaker
+
+
+def get_status() -> Dict[str, Dict]:
+    """
+    Get the state of the circuit breakers of the requested upstream hosts.
+
+    Returns
+    -------
+    Dict[str, Dict]
+        The circuit state ('closed', 'open', or 'half_open'), number of
+        consecutive failures, and the remaining seconds until a trial request
+        if the circuit is open, per upstream host.
+    """
+    return {host: breaker.get_status()
+            for host, breaker in sorted(_breakers.items())}
+
+
+def _override_url(url: str) -> str:
+    scheme, location = url.split('://', 1)
+    return f'{UPSTREAM_URL_OVERRIDE.rstrip("/")}/{scheme}/{location}'
+
+
+def _get_session(host: str) -> requests.Session:
+    session = _sessions.get(host)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(host)
+            if session is None:
+                session = _sessions[host] = _create_session(host)
+    return session
+
+
+def _create_session(host: str) -> requests.Session:
+    pool_size = pool_sizes.get(host, UPSTREAM_DEFAULT_POOL_SIZE)
+    retry = Retry(total=UPSTREAM_RETRIES,
+                  backoff_factor=UPSTREAM_BACKOFF_FACTOR,
+                  status_forcelist=(500, 502, 503, 504),
+                  raise_on_status=False)
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
@@ -1,27 +1,39 @@
-import collections
-import copy
-import csv
-import gc
+import hmac
 import io
 import json
-from typing import List, Tuple
+import math
+import os
+import time
+from typing import Callable, Dict, List, Optional, Tuple
 
 import flask
-import matplotlib
-import matplotlib.pyplot as plt
-import numba as nb
 import numpy as np
-import qrcode
-import requests_cache
-from spectrum_utils import plot as sup, spectrum as sus
+from spectrum_utils import spectrum as sus
 
+import concurrency
+import metrics
 import parsing
+import peak_export
+import render_cache
+import similarity
+import spectrum_index
+import spectrum_view
+import upstream
 
-matplotlib.use('Agg')
+USI_SERVER = 'https://metabolomics-usi.ucsd.edu/'
 
-requests_cache.install_cache('demo_cache', expire_after=300)
+# Browser/CDN cache lifetime (in seconds) of the rendered figures, after which
+# they are revalidated.
+RENDER_MAX_AGE = 60 * 60
 
-USI_SERVER = 'https://metabolomics-usi.ucsd.edu/'
+figure_mimetypes = {'png': 'image/png', 'svg': 'image/svg+xml'}
+
+# Maximum number of USIs in a single batch request.
+BATCH_MAX_USIS = 5000
+# Default number of similar spectra returned by a similarity search.
+SEARCH_DEFAULT_TOP_K = 10
+# Bearer token required by the admin endpoints, which are disabled if empty.
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
 
 default_plotting_args = {
     'width': 10,
@@ -43,10 +55,6 @@ default_plotting_args = {
 blueprint = flask.Blueprint('ui', __name__)
 
 
-SpectrumTuple = collections.namedtuple(
-    'SpectrumTuple', ['precursor_mz', 'precursor_charge', 'mz', 'intensity'])
-
-
 @blueprint.route('/', methods=['GET'])
 def render_homepage():
     return flask.render_template('homepage.html')
@@ -62,11 +70,89 @@ def render_heartbeat():
     return json.dumps({'status': 'success'})
 
 
+@blueprint.route('/metrics', methods=['GET'])
+def render_metrics():
+    return flask.Response(metrics.generate_latest(),
+                          mimetype=metrics.CONTENT_TYPE)
+
+
+@blueprint.route('/admin/prefetch/', methods=['POST'])
+def prefetch_gnps_task():
+    # Resolve (a range of) scans of a GNPS task file in the background, e.g.
+    # {"task": "...", "file": "...", "scans": "1-1000"}.
+    if not ADMIN_TOKEN:
+        return flask.jsonify(_get_error_result(
+            ValueError('Admin endpoints are disabled'))), 404
+    authorization = flask.request.headers.get('Authorization', '')
+    if not hmac.compare_digest(authorization.encode(),
+                               f'Bearer {ADMIN_TOKEN}'.encode()):
+        return flask.jsonify(_get_error_result(
+            ValueError('Invalid admin token'), 403)), 403
+    args = flask.request.get_json(force=True, silent=True)
+    if not isinstance(args, dict):
+        args = flask.request.values
+    task, filename = args.get('task'), args.get('file')
+    try:
+        if (not isinstance(task, str) or not isinstance(filename, str)
+                or parsing.gnps_task_pattern.match(
+                    f'TASK-{task}-{filename}') is None):
+            raise ValueError('Expected a GNPS task and file')
+        scans = _get_scans(str(args.get('scans', '')))
+    except ValueError as e:
+        return flask.jsonify(_get_error_result(e, 400)), 400
+    queued = parsing.prefetch_gnps_task(task, filename, scans)
+    return flask.jsonify({'queued': queued,
+                          'dropped': len(scans) - queued}), 202
+
+
+def _get_scans(scans: str) -> List[int]:
+    # Comma-separated scan numbers and inclusive ranges, e.g. 1-100,250.
+    result = []
+    for scan_range in filter(None, scans.split(',')):
+        first, _, last = scan_range.partition('-')
+        try:
+            first, last = int(first), int(last or first)
+        except ValueError:
+            first, last = 0, 0
+        if first < 1 or last < first:
+            raise ValueError(f'Invalid scans: {scan_range}')
+        if len(result) + last - first + 1 > BATCH_MAX_USIS:
+            raise ValueError(f'Too many scans (maximum {BATCH_MAX_USIS})')
+        result.extend(range(first, last + 1))
+    if not result:
+        raise ValueError('Expected scans')
+    return result
+
+
+@blueprint.route('/upstream/status', methods=['GET'])
+def render_upstream_status():
+    # Circuit breaker state of the upstream hosts in this worker process.
+    return flask.jsonify(upstream.get_status())
+
+
+@blueprint.before_request
+def _start_timer():
+    flask.g.start_time = time.perf_counter()
+
+
+@blueprint.after_request
+def _observe_request(response: flask.Response) -> flask.Response:
+    rule = flask.request.url_rule
+    metrics.request_duration.observe(
+        time.perf_counter() - flask.g.start_time,
+        route=rule.rule if rule is not None else 'unknown',
+        status=response.status_code)
+    return response
+
+
 @blueprint.route('/spectrum/', methods=['GET'])
 def render_spectrum():
+    try:
+        _get_plot_args(flask.request)
+    except ValueError as e:
+        return flask.jsonify(_get_error_result(e, 400)), 400
     spectrum, source_link = parsing.parse_usi(flask.request.args.get('usi'))
-    spectrum = copy.deepcopy(spectrum)
-    spectrum.scale_intensity(max_intensity=1)
+    spectrum = spectrum_view.SpectrumView(spectrum)
     return flask.render_template(
         'spectrum.html',
         usi=flask.request.args.get('usi'),
@@ -75,19 +161,23 @@ def render_spectrum():
             _get_peaks(spectrum),
         ],
         annotations=[
-            _generate_labels(spectrum),
+            np.asarray(_generate_labels(spectrum), np.int64).tolist(),
         ],
+        renderer=_get_renderer(flask.request),
+        plot_usis=[flask.request.args.get('usi')],
     )
 
 
 @blueprint.route('/mirror/', methods=['GET'])
 def render_mirror_spectrum():
+    try:
+        _get_plot_args(flask.request, mirror=True)
+    except ValueError as e:
+        return flask.jsonify(_get_error_result(e, 400)), 400
     spectrum1, source1 = parsing.parse_usi(flask.request.args.get('usi1'))
-    spectrum1 = copy.deepcopy(spectrum1)
-    spectrum1.scale_intensity(max_intensity=1)
+    spectrum1 = spectrum_view.SpectrumView(spectrum1)
     spectrum2, source2 = parsing.parse_usi(flask.request.args.get('usi2'))
-    spectrum2 = copy.deepcopy(spectrum2)
-    spectrum2.scale_intensity(max_intensity=1)
+    spectrum2 = spectrum_view.SpectrumView(spectrum2)
     return flask.render_template(
         'mirror.html',
         usi1=flask.request.args.get('usi1'),
@@ -99,18 +189,26 @@ def render_mirror_spectrum():
             _get_peaks(spectrum2),
         ],
         annotations=[
-            _generate_labels(spectrum1),
-            _generate_labels(spectrum2),
+            np.asarray(_generate_labels(spectrum1), np.int64).tolist(),
+            np.asarray(_generate_labels(spectrum2), np.int64).tolist(),
         ],
+        renderer=_get_renderer(flask.request),
+        plot_usis=[flask.request.args.get('usi1'),
+                   flask.request.args.get('usi2')],
     )
 
 
+def _get_renderer(request) -> str:
+    # Spectra are drawn in the browser (client) from the plot payload, which
+    # is requested from `plot_json`, or rendered by the server.
+    return 'server' if request.args.get('renderer') == 'server' else 'client'
+
+
 @blueprint.route('/png/')
 def generate_png():
     usi = flask.request.args.get('usi')
     plotting_args = _get_plotting_args(flask.request)
-    buf = _generate_figure(usi, 'png', **plotting_args)
-    return flask.send_file(buf, mimetype='image/png')
+    return _send_figure([usi], 'png', plotting_args, _generate_figure)
 
 
 @blueprint.route('/png/mirror/')
@@ -118,16 +216,15 @@ def generate_mirror_png():
     usi1 = flask.request.args.get('usi1')
     usi2 = flask.request.args.get('usi2')
     plot_pars = _get_plotting_args(flask.request, mirror=True)
-    buf = _generate_mirror_figure(usi1, usi2, 'png', **plot_pars)
-    return flask.send_file(buf, mimetype='image/png')
+    return _send_figure([usi1, usi2], 'png', plot_pars,
+                        _generate_mirror_figure)
 
 
 @blueprint.route('/svg/')
 def generate_svg():
     usi = flask.request.args.get('usi')
     plot_pars = _get_plotting_args(flask.request)
-    buf = _generate_figure(usi, 'svg', **plot_pars)
-    return flask.send_file(buf, mimetype='image/svg+xml')
+    return _send_figure([usi], 'svg', plot_pars, _generate_figure)
 
 
 @blueprint.route('/svg/mirror/')
@@ -135,292 +232,142 @@ def generate_mirror_svg():
     usi1 = flask.request.args.get('usi1')
     usi2 = flask.request.args.get('usi2')
     plot_pars = _get_plotting_args(flask.request, mirror=True)
-    buf = _generate_mirror_figure(usi1, usi2, 'svg', **plot_pars)
-    return flask.send_file(buf, mimetype='image/svg+xml')
+    return _send_figure([usi1, usi2], 'svg', plot_pars,
+                        _generate_mirror_figure)
 
 
-def _generate_figure(usi: str, extension: str, **kwargs) -> io.BytesIO:
-    fig, ax = plt.subplots(figsize=(kwargs['width'], kwargs['height']))
+def _send_figure(usis: List[str], extension: str, plotting_args: Dict,
+                 generate_figure: Callable[..., io.BytesIO]) -> flask.Response:
+    # The plotting libraries are only loaded when the first figure is rendered
+    # (or when preloading the app), to keep worker startup fast.
+    import rendering
+
+    def generate() -> bytes:
+        data = generate_figure(*usis, extension, **plotting_args).getvalue()
+        metrics.rendered_figures.inc(format=extension)
+        metrics.rendered_bytes.inc(len(data), format=extension)
+        return data
 
+    try:
+        return _send_cached(usis, extension, plotting_args, generate,
+                            figure_mimetypes[extension])
+    except rendering.RenderQueueFullError as e:
+        # Shed load instead of queueing indefinitely.
+        response = flask.jsonify(_get_error_result(e, 503))
+        response.status_code = 503
+        response.retry_after = 5
+        return response
+
+
+def _send_cached(usis: List[str], extension: str, plotting_args: Dict,
+                 generate: Callable[[], bytes], mimetype: str) \
+        -> flask.Response:
+    # Serve previously rendered figures (or plot payloads) from the render
+    # cache and let clients revalidate them using the ETag and Last-Modified
+    # headers.
+    key = render_cache.get_key(usis, extension, plotting_args)
+    figure = render_cache.cache.get(key)
+    metrics.cache_requests.inc(
+        cache='render', result='hit' if figure is not None else 'miss')
+    if figure is None:
+        # Figures expire with the spectra they're rendered from.
+        figure = render_cache.cache.put(
+            key, generate(), min(map(parsing.get_ttl, usis)))
+    response = flask.Response(figure.data, mimetype=mimetype)
+    response.set_etag(figure.etag)
+    response.last_modified = figure.last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = RENDER_MAX_AGE
+    return response.make_conditional(flask.request)
+
+
+def _generate_figure(usi: str, extension: str, **kwargs) -> io.BytesIO:
+    import rendering
     kwargs['annotate_peaks'] = kwargs['annotate_peaks'][0]
     spectrum = _prepare_spectrum(usi, **kwargs)
-    sup.spectrum(
-        spectrum,
-        annotate_ions=kwargs['annotate_peaks'],
-        annot_kws={'rotation': kwargs['annotation_rotation'], 'clip_on': True},
-        grid=kwargs['grid'], ax=ax,
-    )
-
-    ax.set_xlim(kwargs['mz_min'], kwargs['mz_max'])
-    ax.set_ylim(0, kwargs['max_intensity'])
-
-    if not kwargs['grid']:
-        ax.spines['right'].set_visible(False)
-        ax.spines['top'].set_visible(False)
-        ax.yaxis.set_ticks_position('left')
-        ax.xaxis.set_ticks_position('bottom')
-
-    title = ax.text(0.5, 1.06, usi, horizontalalignment='center',
-                    verticalalignment='bottom', fontsize='x-large',
-                    fontweight='bold', transform=ax.transAxes)
-    title.set_url(f'{USI_SERVER}spectrum/?usi={usi}')
-    subtitle = (f'Precursor m/z: '
-                f'{spectrum.precursor_mz:.{kwargs["annotate_precision"]}f} '
-                if spectrum.precursor_mz > 0 else '')
-    subtitle += f'Charge: {spectrum.precursor_charge}'
-    subtitle = ax.text(0.5, 1.02, subtitle, horizontalalignment='center',
-                       verticalalignment='bottom', fontsize='large',
-                       transform=ax.transAxes)
-    subtitle.set_url(f'{USI_SERVER}spectrum/?usi={usi}')
-
-    buf = io.BytesIO()
-    plt.savefig(buf, bbox_inches='tight', format=extension)
-    buf.seek(0)
-    fig.clear()
-    plt.close(fig)
-    gc.collect()
-
-    return buf
+    # Resolve the spectrum first, then render it in the rendering engine.
+    with metrics.stage_duration.time(stage='render'):
+        return io.BytesIO(rendering.render(
+            rendering.render_spectrum, usi, spectrum,
+            f'{USI_SERVER}spectrum/?usi={usi}', extension, **kwargs))
 
 
 def _generate_mirror_figure(usi1: str, usi2: str, extension: str, **kwargs) \
         -> io.BytesIO:
-    fig, ax = plt.subplots(figsize=(kwargs['width'], kwargs['height']))
-
+    import rendering
     annotate_peaks = kwargs['annotate_peaks']
     kwargs['annotate_peaks'] = annotate_peaks[0]
     spectrum_top = _prepare_spectrum(usi1, **kwargs)
     kwargs['annotate_peaks'] = annotate_peaks[1]
     spectrum_bottom = _prepare_spectrum(usi2, **kwargs)
 
-    fragment_mz_tolerance = kwargs['fragment_mz_tolerance']
-
     if kwargs['cosine']:
-        # Initialize the annotations as unmatched.
-        if spectrum_top.annotation is None:
-            spectrum_top.annotation = np.full_like(
-                spectrum_top.mz, None, object)
-        if spectrum_bottom.annotation is None:
-            spectrum_bottom.annotation = np.full_like(
-                spectrum_bottom.mz, None, object)
-        for annotation in spectrum_top.annotation:
-            if annotation is not None:
-                annotation.ion_type = 'unmatched'
-        for annotation in spectrum_bottom.annotation:
-            if annotation is not None:
-                annotation.ion_type = 'unmatched'
-        # Assign the matching peak annotations.
-        similarity, peak_matches = cosine(
-            spectrum_top, spectrum_bottom, fragment_mz_tolerance,
-            kwargs['cosine'] == 'shifted')
-        for top_i, bottom_i in peak_matches:
-            if spectrum_top.annotation[top_i] is None:
-                spectrum_top.annotation[top_i] = sus.FragmentAnnotation(
-                    0, spectrum_top.mz[top_i], '')
-            spectrum_top.annotation[top_i].ion_type = 'top'
-            if spectrum_bottom.annotation[bottom_i] is None:
-                spectrum_bottom.annotation[bottom_i] = sus.FragmentAnnotation(
-                    0, spectrum_bottom.mz[bottom_i], '')
-            spectrum_bottom.annotation[bottom_i].ion_type = 'bottom'
+        with metrics.stage_duration.time(stage='cosine'):
+            score = _annotate_matches(
+                spectrum_top, spectrum_bottom,
+                kwargs['fragment_mz_tolerance'],
+                kwargs['cosine'] == 'shifted')
     else:
-        similarity = 0
-
-    # Colors for mirror plot peaks, subject to change.
-    sup.colors['top'] = '#212121'
-    sup.colors['bottom'] = '#388E3C'
-    sup.colors['unmatched'] = 'darkgray'
-
-    sup.mirror(spectrum_top, spectrum_bottom,
-               {'annotate_ions': kwargs['annotate_peaks'],
-                'annot_kws': {'rotation': kwargs['annotation_rotation'],
-                              'clip_on': True},
-                'grid': kwargs['grid']}, ax=ax)
-
-    ax.set_xlim(kwargs['mz_min'], kwargs['mz_max'])
-    ax.set_ylim(-kwargs['max_intensity'], kwargs['max_intensity'])
-
-    if not kwargs['grid']:
-        ax.spines['right'].set_visible(False)
-        ax.spines['top'].set_visible(False)
-        ax.yaxis.set_ticks_position('left')
-        ax.xaxis.set_ticks_position('bottom')
-
-    text_y = 1.2 if kwargs['cosine'] else 1.15
-    for usi, spec, loc in zip([usi1, usi2], [spectrum_top, spectrum_bottom],
-                              ['Top', 'Bottom']):
-        title = ax.text(0.5, text_y, f'{loc}: {usi}',
-                        horizontalalignment='center',
-                        verticalalignment='bottom',
-                        fontsize='x-large',
-                        fontweight='bold',
-                        transform=ax.transAxes)
-        title.set_url(f'{USI_SERVER}mirror/?usi1={usi1}&usi2={usi2}')
-        text_y -= 0.04
-        subtitle = (
-            f'Precursor $m$/$z$: '
-            f'{spec.precursor_mz:.{kwargs["annotate_precision"]}f} '
-            if spec.precursor_mz > 0 else '')
-        subtitle += f'Charge: {spec.precursor_charge}'
-        subtitle = ax.text(0.5, text_y, subtitle, horizontalalignment='center',
-                           verticalalignment='bottom', fontsize='large',
-                           transform=ax.transAxes)
-        subtitle.set_url(f'{USI_SERVER}mirror/?usi1={usi1}&usi2={usi2}')
-        text_y -= 0.06
-
-    if kwargs['cosine']:
-        subtitle_score = f'Cosine similarity = {similarity:.4f}'
-        ax.text(0.5, text_y, subtitle_score, horizontalalignment='center',
-                verticalalignment='bottom', fontsize='x-large',
-                fontweight='bold', transform=ax.transAxes)
-
-    buf = io.BytesIO()
-    plt.savefig(buf, bbox_inches='tight', format=extension)
-    buf.seek(0)
-    fig.clear()
-    plt.close(fig)
-    gc.collect()
-
-    return buf
-
-
-def cosine(spectrum1: sus.MsmsSpectrum, spectrum2: sus.MsmsSpectrum,
-           fragment_mz_tolerance: float, allow_shift: bool) \
-        -> Tuple[float, List[Tuple[int, int]]]:
-    """
-    Compute the cosine similarity between the given spectra.
-
-    Parameters
-    ----------
-    spectrum1 : sus.MsmsSpectrum
-        The first spectrum.
-    spectrum2 : sus.MsmsSpectrum
-        The second spectrum.
-    fragment_mz_tolerance : float
-        The fragment m/z tolerance used to match peaks.
-    allow_shift : bool
-        Boolean flag indicating whether to allow peak shifts or not.
-
-    Returns
-    -------
-    Tuple[float, List[Tuple[int, int]]]
-        A tuple consisting of (i) the cosine similarity between both spectra,
-        and (ii) the indexes of matching peaks in both spectra.
-    """
-    spec_tup1 = SpectrumTuple(
-        spectrum1.precursor_mz, spectrum1.precursor_charge, spectrum1.mz,
-        np.copy(spectrum1.intensity) / np.linalg.norm(spectrum1.intensity))
-    spec_tup2 = SpectrumTuple(
-        spectrum2.precursor_mz, spectrum2.precursor_charge, spectrum2.mz,
-        np.copy(spectrum2.intensity) / np.linalg.norm(spectrum2.intensity))
-    return _cosine(spec_tup1, spec_tup2, fragment_mz_tolerance, allow_shift)
-
-
-@nb.njit
-def _cosine(spec: SpectrumTuple, spec_other: SpectrumTuple,
-            fragment_mz_tolerance: float, allow_shift: bool) \
-        -> Tuple[float, List[Tuple[int, int]]]:
-    """
-    Compute the cosine similarity between the given spectra.
-
-    Parameters
-    ----------
-    spec : SpectrumTuple
-        Numba-compatible tuple containing information from the first spectrum.
-    spec_other : SpectrumTuple
-        Numba-compatible tuple containing information from the second spectrum.
-    fragment_mz_tolerance : float
-        The fragment m/z tolerance used to match peaks in both spectra with
-        each other.
-    allow_shift : bool
-        Boolean flag indicating whether to allow peak shifts or not.
-
-    Returns
-    -------
-    Tuple[float, List[Tuple[int, int]]]
-        A tuple consisting of (i) the cosine similarity between both spectra,
-        and (ii) the indexes of matching peaks in both spectra.
-    """
-    # Find the matching peaks between both spectra, optionally allowing for
-    # shifted peaks.
-    # Candidate peak indices depend on whether we allow shifts
-    # (check all shifted peaks as well) or not.
-    # Account for unknown precursor charge (default: 1).
-    precursor_charge = max(spec.precursor_charge, 1)
-    precursor_mass_diff = ((spec.precursor_mz - spec_other.precursor_mz)
-                           * precursor_charge)
-    # Only take peak shifts into account if the mass difference is relevant.
-    num_shifts = 1
-    if allow_shift and abs(precursor_mass_diff) >= fragment_mz_tolerance:
-        num_shifts += precursor_charge
-    other_peak_index = np.zeros(num_shifts, np.uint16)
-    mass_diff = np.zeros(num_shifts, np.float32)
-    for charge in range(1, num_shifts):
-        mass_diff[charge] = precursor_mass_diff / charge
-
-    # Find the matching peaks between both spectra.
-    peak_match_scores, peak_match_idx = [], []
-    for peak_index, (peak_mz, peak_intensity) in enumerate(zip(
-            spec.mz, spec.intensity)):
-        # Advance while there is an excessive mass difference.
-        for cpi in range(num_shifts):
-            while (other_peak_index[cpi] < len(spec_other.mz) - 1 and
-                   (peak_mz - fragment_mz_tolerance >
-                    spec_other.mz[other_peak_index[cpi]] + mass_diff[cpi])):
-                other_peak_index[cpi] += 1
-        # Match the peaks within the fragment mass window if possible.
-        for cpi in range(num_shifts):
-            index = 0
-            other_peak_i = other_peak_index[cpi] + index
-            while (other_peak_i < len(spec_other.mz) and
-                   abs(peak_mz - (spec_other.mz[other_peak_i]
-                       + mass_diff[cpi])) <= fragment_mz_tolerance):
-                peak_match_scores.append(
-                    peak_intensity * spec_other.intensity[other_peak_i])
-                peak_match_idx.append((peak_index, other_peak_i))
-                index += 1
-                other_peak_i = other_peak_index[cpi] + index
-
-    score, peak_matches = 0., []
-    if len(peak_match_scores) > 0:
-        # Use the most prominent peak matches to compute the score (sort in
-        # descending order).
-        peak_match_scores_arr = np.asarray(peak_match_scores)
-        peak_match_order = np.argsort(peak_match_scores_arr)[::-1]
-        peak_match_scores_arr = peak_match_scores_arr[peak_match_order]
-        peak_match_idx_arr = np.asarray(peak_match_idx)[peak_match_order]
-        peaks_used, other_peaks_used = set(), set()
-        for peak_match_score, peak_i, other_peak_i in zip(
-                peak_match_scores_arr, peak_match_idx_arr[:, 0],
-                peak_match_idx_arr[:, 1]):
-            if (peak_i not in peaks_used
-                    and other_peak_i not in other_peaks_used):
-                score += peak_match_score
-                # Save the matched peaks.
-                peak_matches.append((peak_i, other_peak_i))
-                # Make sure these peaks are not used anymore.
-                peaks_used.add(peak_i)
-                other_peaks_used.add(other_peak_i)
-
-    return score, peak_matches
+        score = None
+
+    with metrics.stage_duration.time(stage='render'):
+        return io.BytesIO(rendering.render(
+            rendering.render_mirror, usi1, usi2, spectrum_top,
+            spectrum_bottom, score,
+            f'{USI_SERVER}mirror/?usi1={usi1}&usi2={usi2}', extension,
+            **kwargs))
+
+
+def _annotate_matches(spectrum_top: sus.MsmsSpectrum,
+                      spectrum_bottom: sus.MsmsSpectrum,
+                      fragment_mz_tolerance: float, allow_shift: bool) \
+        -> float:
+    # Initialize the annotations as unmatched.
+    if spectrum_top.annotation is None:
+        spectrum_top.annotation = np.full_like(spectrum_top.mz, None, object)
+    if spectrum_bottom.annotation is None:
+        spectrum_bottom.annotation = np.full_like(
+            spectrum_bottom.mz, None, object)
+    for annotation in spectrum_top.annotation:
+        if annotation is not None:
+            annotation.ion_type = 'unmatched'
+    for annotation in spectrum_bottom.annotation:
+        if annotation is not None:
+            annotation.ion_type = 'unmatched'
+    # Assign the matching peak annotations.
+    score, peak_matches = similarity.cosine(
+        spectrum_top, spectrum_bottom, fragment_mz_tolerance, allow_shift)
+    for top_i, bottom_i in peak_matches:
+        if spectrum_top.annotation[top_i] is None:
+            spectrum_top.annotation[top_i] = sus.FragmentAnnotation(
+                0, spectrum_top.mz[top_i], '')
+        spectrum_top.annotation[top_i].ion_type = 'top'
+        if spectrum_bottom.annotation[bottom_i] is None:
+            spectrum_bottom.annotation[bottom_i] = sus.FragmentAnnotation(
+                0, spectrum_bottom.mz[bottom_i], '')
+        spectrum_bottom.annotation[bottom_i].ion_type = 'bottom'
+    return score
 
 
 def _prepare_spectrum(usi: str, **kwargs) -> sus.MsmsSpectrum:
-    spectrum, _ = parsing.parse_usi(usi)
-    spectrum = copy.deepcopy(spectrum)
-    spectrum.scale_intensity(max_intensity=1)
+    with metrics.stage_duration.time(stage='resolve'):
+        spectrum, _ = parsing.parse_usi(usi)
+    # Derive the plotted peaks from a view on the cached spectrum, so that
+    # only the peaks in the m/z range are copied.
+    spectrum = spectrum_view.SpectrumView(spectrum)
 
     if kwargs['annotate_peaks']:
         if kwargs['annotate_peaks'] is True:
-            kwargs['annotate_peaks'] = spectrum.mz[_generate_labels(spectrum)]
+            with metrics.stage_duration.time(stage='labels'):
+                kwargs['annotate_peaks'] = spectrum.mz[
+                    _generate_labels(spectrum)]
         for mz in kwargs['annotate_peaks']:
             t = f'{mz:.{kwargs["annotate_precision"]}f}'
             spectrum.annotate_mz_fragment(
-                mz, 0, kwargs['fragment_mz_tolerance'], 'Da', text=t)
+                mz, kwargs['fragment_mz_tolerance'], text=t)
 
-    spectrum.set_mz_range(kwargs['mz_min'], kwargs['mz_max'])
-    spectrum.scale_intensity(max_intensity=1)
-
-    return spectrum
+    return spectrum.set_mz_range(
+        kwargs['mz_min'], kwargs['mz_max']).to_spectrum()
 
 
 def _get_peaks(spectrum: sus.MsmsSpectrum) -> List[Tuple[float, float]]:
@@ -435,16 +382,25 @@ def _generate_labels(spec, intensity_threshold=None):
         intensity_threshold = default_plotting_args['annotate_threshold']
     mz_exclusion_window = (spec.mz[-1] - spec.mz[0]) / 20  # Max 20 labels.
 
-    # Annotate peaks in decreasing intensity order.
-    labeled_i, order = [], np.argsort(spec.intensity)[::-1]
-    for i, mz, intensity in zip(order, spec.mz[order], spec.intensity[order]):
-        if intensity < intensity_threshold:
+    # Annotate peaks in decreasing intensity order, down to the first peak
+    # below the intensity threshold.
+    order = np.argsort(spec.intensity)[::-1]
+    below_threshold = np.flatnonzero(
+        spec.intensity[order] < intensity_threshold)
+    if len(below_threshold) > 0:
+        order = order[:below_threshold[0]]
+    mz = spec.mz[order]
+    # Each labeled peak excludes all less intense peaks within the exclusion
+    # window, so the next label is the most intense peak that isn't excluded
+    # yet.
+    labeled_i, available, start = [], np.ones(len(order), np.bool_), 0
+    while start < len(order):
+        candidate = np.argmax(available[start:]) + start
+        if not available[candidate]:
             break
-        if not any(
-            abs(mz - spec.mz[already_labeled_i]) <= mz_exclusion_window
-            for already_labeled_i in labeled_i
-        ):
-            labeled_i.append(i)
+        labeled_i.append(order[candidate])
+        available &= ~(np.abs(mz - mz[candidate]) <= mz_exclusion_window)
+        start = candidate + 1
 
     return labeled_i
 
@@ -511,63 +467,360 @@ def _get_plotting_args(request, mirror=False):
 
 @blueprint.route('/json/')
 def peak_json():
+    # The peaks are included as a list of [mz, intensity] pairs, or as
+    # base64-encoded binary arrays with format=base64.
+    peaks_format = flask.request.args.get('format', 'list')
+    if peaks_format not in ('list', 'base64'):
+        return flask.jsonify(_get_error_result(
+            ValueError('Unknown peaks format'), 400)), 400
     try:
         spectrum, _ = parsing.parse_usi(flask.request.args.get('usi'))
-        # Return for JSON includes, peaks, n_peaks, and precursor_mz.
-        result_dict = {
-            'peaks': _get_peaks(spectrum),
-            'n_peaks': len(spectrum.mz),
-            'precursor_mz': spectrum.precursor_mz}
     except ValueError as e:
-        result_dict = {'error': {'code': 404,
-                                 'message': str(e)}}
-    return flask.jsonify(result_dict)
+        return flask.jsonify(_get_error_result(e))
+    if peaks_format == 'base64':
+        return flask.jsonify(_get_base64_result(spectrum))
+    return _stream_json(_get_json_result(spectrum))
+
+
+@blueprint.route('/json/plot/')
+def plot_json():
+    # Compact delta-encoded peaks of a spectrum (usi) or two spectra (usi1 and
+    # usi2) to draw in the browser, see `_get_plot_result`.
+    mirror = 'usi' not in flask.request.args
+    usis = ([flask.request.args.get('usi1'), flask.request.args.get('usi2')]
+            if mirror else [flask.request.args.get('usi')])
+    try:
+        plotting_args = _get_plot_args(flask.request, mirror)
+    except ValueError as e:
+        return flask.jsonify(_get_error_result(e, 400)), 400
+
+    def generate() -> bytes:
+        spectra, source_links = [], []
+        for usi in usis:
+            with metrics.stage_duration.time(stage='resolve'):
+                spectrum, source_link = parsing.parse_usi(usi)
+            spectra.append(spectrum_view.SpectrumView(spectrum))
+            source_links.append(source_link)
+        return ''.join(peak_export.iter_json(_get_plot_result(
+            usis, spectra, source_links, plotting_args))).encode()
+
+    try:
+        return _send_cached(usis, 'json', plotting_args, generate,
+                            'application/json')
+    except ValueError as e:
+        return flask.jsonify(_get_error_result(e)), 404
 
 
-@blueprint.route('/api/proxi/v0.1/spectra')
+def _get_plot_args(request, mirror=False) -> Dict:
+    # The m/z values of the plot payload are encoded as integers with the
+    # annotation precision, see `peak_export.get_delta_arrays`.
+    plotting_args = _get_plotting_args(request, mirror)
+    if not 0 <= plotting_args['annotate_precision'] <= 10:
+        raise ValueError('annotate_precision should be between 0 and 10')
+    return plotting_args
+
+
+@blueprint.route('/json/batch/', methods=['POST'])
+def peak_json_batch():
+    try:
+        usis = _get_batch_usis(flask.request)
+    except ValueError as e:
+        return flask.jsonify(_get_error_result(e, 400)), 400
+    return _stream_batch(usis, _get_json_result)
+
+
+@blueprint.route('/json/validate/', methods=['POST'])
+def validate_usis():
+    # Validate and normalize USIs without resolving them.
+    try:
+        usis = _get_batch_usis(flask.request)
+    except ValueError as e:
+        return flask.jsonify(_get_error_result(e, 400)), 400
+    result = []
+    for usi, normalized_usi, error in parsing.validate_usis(usis):
+        if error is None:
+            result.append({'usi': usi, 'normalized_usi': normalized_usi})
+        else:
+            result.append({'usi': usi, **_get_error_result(error, 400)})
+    return flask.jsonify(result)
+
+
+@blueprint.route('/json/similarity/', methods=['GET', 'POST'])
+def similarity_json():
+    # Pairwise cosine similarities between the requested USIs, or only the
+    # top-k most similar spectra per USI.
+    try:
+        usis = _get_batch_usis(flask.request)
+        similarity_args = _get_similarity_args(flask.request)
+    except ValueError as e:
+        return flask.jsonify(_get_error_result(e, 400)), 400
+    resolved_usis, spectra, errors = [], [], []
+    for usi, result, error in parsing.parse_usi_batch(usis):
+        if error is None:
+            resolved_usis.append(usi)
+            spectra.append(result[0])
+        else:
+            errors.append({'usi': usi, **_get_error_result(
+                error, _get_batch_error_code(error))})
+    with metrics.stage_duration.time(stage='similarity_matrix'):
+        scores = concurrency.run_cpu_bound(
+            similarity.cosine_matrix, spectra,
+            similarity_args['fragment_mz_tolerance'],
+            similarity_args['cosine'] == 'shifted')
+    result_dict = {'usis': resolved_usis, 'errors': errors}
+    if similarity_args['top_k'] is None:
+        # The score matrix is streamed in chunks of rows rather than
+        # converted to Python floats at once.
+        result_dict['scores'] = scores
+    else:
+        indexes, top_scores = similarity.top_k(scores,
+                                               similarity_args['top_k'])
+        result_dict['neighbors'] = [
+            [{'index': int(j), 'usi': resolved_usis[j],
+              'score': round(float(score), 6)}
+             for j, score in zip(row_indexes, row_scores)]
+            for row_indexes, row_scores in zip(indexes, top_scores)]
+    return _stream_json(result_dict, decimals=6)
+
+
+@blueprint.route('/json/search/')
+def search_json():
+    # Find the most similar spectra among all spectra that were resolved by
+    # this server.
+    usi = flask.request.args.get('usi')
+    if spectrum_index.index.max_spectra <= 0:
+        return flask.jsonify(_get_error_result(ValueError(
+            'Similarity search is disabled (see SPECTRUM_INDEX_MAX_SPECTRA)'
+        ))), 404
+    try:
+        similarity_args = _get_similarity_args(flask.request)
+    except ValueError as e:
+        return flask.jsonify(_get_error_result(e, 400)), 400
+    try:
+        spectrum, _ = parsing.parse_usi(usi)
+    except ValueError as e:
+        return flask.jsonify(_get_error_result(e)), 404
+    with metrics.stage_duration.time(stage='search'):
+        matches = concurrency.run_cpu_bound(
+            spectrum_index.index.search, spectrum,
+            similarity_args['fragment_mz_tolerance'],
+            similarity_args['cosine'] == 'shifted',
+            similarity_args['top_k'] or SEARCH_DEFAULT_TOP_K,
+            parsing.normalize_usi(usi), parsing.get_cached_spectrum)
+    return flask.jsonify({
+        'usi': usi,
+        'n_indexed': len(spectrum_index.index),
+        'matches': [{'usi': match.usi, 'score': round(float(match.score), 6),
+                     'matched_peaks': match.matched_peaks,
+                     'exact': match.exact}
+                    for match in matches]})
+
+
+@blueprint.route('/api/proxi/v0.1/spectra', methods=['GET', 'POST'])
 def peak_proxi_json():
+    # Multiple USIs can be requested as repeated usi parameters or as a POST
+    # request.
+    if flask.request.method == 'POST' or \
+            len(flask.request.args.getlist('usi')) > 1:
+        try:
+            usis = _get_batch_usis(flask.request)
+        except ValueError as e:
+            return flask.jsonify([_get_error_result(e, 400)]), 400
+        return _stream_batch(usis, _get_proxi_result)
     try:
         spectrum, _ = parsing.parse_usi(flask.request.args.get('usi'))
-        result_dict = {
-            'intensities': spectrum.intensity.tolist(),
-            'mzs': spectrum.mz.tolist(),
-            'attributes': [
-                {
-                    'accession': 'MS:1000744',
-                    'name': 'selected ion m/z',
-                    'value': float(spectrum.precursor_mz)
-                },
-                {
-                    'accession': 'MS:1000041',
-                    'name': 'charge state',
-                    'value': int(spectrum.precursor_charge)
-                }
-            ]
-        }
     except ValueError as e:
-        result_dict = {'error': {'code': 404,
-                                 'message': str(e)}}
-
-    return flask.jsonify([result_dict])
+        return flask.jsonify([_get_error_result(e)])
+    return _stream_json([_get_proxi_result(spectrum)])
+
+
+def _get_plot_result(usis: List[str],
+                     spectra: List[spectrum_view.SpectrumView],
+                     source_links: List[str], plotting_args: Dict) -> Dict:
+    # Compact peaks to draw the spectra in the browser, with the default peak
+    # labels and (for mirror plots) the matching peaks of the cosine
+    # similarity over the full spectra precomputed.
+    result = {'mz_decimals': plotting_args['annotate_precision'],
+              'intensity_scale': peak_export.DELTA_INTENSITY_SCALE,
+              'spectra': []}
+    for usi, spectrum, source_link in zip(usis, spectra, source_links):
+        mz, intensity = peak_export.get_delta_arrays(
+            spectrum, plotting_args['annotate_precision'])
+        with metrics.stage_duration.time(stage='labels'):
+            labels = np.asarray(_generate_labels(spectrum), np.int64)
+        result['spectra'].append({
+            'usi': usi,
+            'source_link': source_link,
+            'precursor_mz': float(spectrum.precursor_mz),
+            'precursor_charge': int(spectrum.precursor_charge),
+            'n_peaks': len(mz),
+            'mz': mz,
+            'intensity': intensity,
+            'labels': labels})
+    if len(spectra) == 2 and plotting_args['cosine']:
+        with metrics.stage_duration.time(stage='cosine'):
+            score, peak_matches = similarity.cosine(
+                spectra[0].to_spectrum(), spectra[1].to_spectrum(),
+                plotting_args['fragment_mz_tolerance'],
+                plotting_args['cosine'] == 'shifted')
+        result['cosine'] = {
+            'type': plotting_args['cosine'],
+            'fragment_mz_tolerance': plotting_args['fragment_mz_tolerance'],
+            'score': round(float(score), 6),
+            'matches': np.asarray(peak_matches, np.int64).reshape(-1, 2)}
+    return result
+
+
+def _get_json_result(spectrum: sus.MsmsSpectrum) -> Dict:
+    # Return for JSON includes, peaks, n_peaks, and precursor_mz.
+    # The peaks are serialized from the arrays by `peak_export.iter_json`.
+    return {
+        'peaks': (spectrum.mz, spectrum.intensity),
+        'n_peaks': len(spectrum.mz),
+        'precursor_mz': float(spectrum.precursor_mz)}
+
+
+def _get_base64_result(spectrum: sus.MsmsSpectrum) -> Dict:
+    # Peaks as base64-encoded little-endian 32-bit float arrays (as in mzML).
+    mz, intensity = peak_export.get_base64_arrays(spectrum)
+    return {
+        'mz': mz,
+        'intensity': intensity,
+        'dtype': peak_export.BINARY_DTYPE,
+        'n_peaks': len(spectrum.mz),
+        'precursor_mz': float(spectrum.precursor_mz),
+        'precursor_charge': int(spectrum.precursor_charge)}
+
+
+def _get_proxi_result(spectrum: sus.MsmsSpectrum) -> Dict:
+    return {
+        'intensities': spectrum.intensity,
+        'mzs': spectrum.mz,
+        'attributes': [
+            {
+                'accession': 'MS:1000744',
+                'name': 'selected ion m/z',
+                'value': float(spectrum.precursor_mz)
+            },
+            {
+                'accession': 'MS:1000041',
+                'name': 'charge state',
+                'value': int(spectrum.precursor_charge)
+            }
+        ]
+    }
+
+
+def _get_error_result(error: Exception, code: int = 404) -> Dict:
+    return {'error': {'code': code,
+                      'message': str(error)}}
+
+
+def _get_batch_usis(request) -> List[str]:
+    if request.method == 'POST':
+        # Either a JSON list of USIs or an object with a "usis" list.
+        usis = request.get_json(force=True, silent=True)
+        if isinstance(usis, dict):
+            usis = usis.get('usis')
+    else:
+        usis = request.args.getlist('usi')
+    if (not isinstance(usis, list) or
+            not all(isinstance(usi, str) for usi in usis)):
+        raise ValueError('Expected a list of USIs')
+    if len(usis) > BATCH_MAX_USIS:
+        raise ValueError(f'Too many USIs (maximum {BATCH_MAX_USIS})')
+    return usis
+
+
+def _get_similarity_args(request) -> Dict:
+    # Options from the query parameters, or from the JSON object in a POST
+    # request.
+    args = request.args
+    if request.method == 'POST':
+        body = request.get_json(force=True, silent=True)
+        if isinstance(body, dict):
+            args = body
+    similarity_args = {}
+    cosine_type = args.get('cosine')
+    similarity_args['cosine'] = (default_plotting_args['cosine']
+                                 if cosine_type is None else cosine_type)
+    if similarity_args['cosine'] not in ('standard', 'shifted'):
+        raise ValueError('Unknown cosine type')
+    fragment_mz_tolerance = args.get('fragment_mz_tolerance')
+    similarity_args['fragment_mz_tolerance'] = (
+        default_plotting_args['fragment_mz_tolerance']
+        if fragment_mz_tolerance is None else float(fragment_mz_tolerance))
+    top_k = args.get('top_k')
+    similarity_args['top_k'] = int(top_k) if top_k is not None else None
+    if similarity_args['top_k'] is not None and similarity_args['top_k'] < 1:
+        raise ValueError('top_k should be positive')
+    return similarity_args
+
+
+def _stream_batch(usis: List[str],
+                  get_result: Callable[[sus.MsmsSpectrum], Dict]) \
+        -> flask.Response:
+    # Stream a JSON list with the results in the order of the requested USIs
+    # while the remaining USIs are still being resolved.
+    def generate():
+        yield '['
+        for i, (usi, result, error) in enumerate(
+                parsing.parse_usi_batch(usis)):
+            if error is None:
+                result_dict = get_result(result[0])
+            else:
+                result_dict = _get_error_result(
+                    error, _get_batch_error_code(error))
+            result_dict['usi'] = usi
+            if i > 0:
+                yield ','
+            yield from peak_export.iter_json(result_dict)
+        yield ']'
+
+    return flask.Response(flask.stream_with_context(generate()),
+                          mimetype='application/json')
+
+
+def _get_batch_error_code(error: Exception) -> int:
+    # Clients should retry USIs that couldn't be resolved because of an
+    # unhealthy upstream instead of treating them as unknown.
+    return (503 if isinstance(error, upstream.UpstreamUnavailableError)
+            else 404)
+
+
+def _stream_json(result, decimals: Optional[int] = None) -> flask.Response:
+    return flask.Response(peak_export.iter_json(result, decimals),
+                          mimetype='application/json')
 
 
 @blueprint.route('/csv/')
 def peak_csv():
     spectrum, _ = parsing.parse_usi(flask.request.args.get('usi'))
-    csv_str = io.StringIO()
-    writer = csv.writer(csv_str)
-    writer.writerow(['mz', 'intensity'])
-    for mz, intensity in zip(spectrum.mz, spectrum.intensity):
-        writer.writerow([mz, intensity])
-    csv_bytes = io.BytesIO()
-    csv_bytes.write(csv_str.getvalue().encode('utf-8'))
-    csv_bytes.seek(0)
-    return flask.send_file(csv_bytes, mimetype='text/csv', as_attachment=True,
-                           attachment_filename=f'{spectrum.identifier}.csv')
+    return _stream_attachment(peak_export.iter_csv(spectrum), 'text/csv',
+                              f'{spectrum.identifier}.csv')
+
+
+@blueprint.route('/npy/')
+def peak_npy():
+    # NumPy array with the m/z and intensity per peak, which can be loaded
+    # using `numpy.load`.
+    spectrum, _ = parsing.parse_usi(flask.request.args.get('usi'))
+    return _stream_attachment(peak_export.iter_npy(spectrum),
+                              'application/octet-stream',
+                              f'{spectrum.identifier}.npy')
+
+
+def _stream_attachment(chunks, mimetype: str, filename: str) \
+        -> flask.Response:
+    response = flask.Response(chunks, mimetype=mimetype)
+    response.headers.set('Content-Disposition', 'attachment',
+                         filename=filename)
+    return response
 
 
 @blueprint.route('/qrcode/')
 def generate_qr():
+    import qrcode
     # QR Code Rendering.
     if flask.request.args.get('mirror') != 'true':
         usi = flask.request.args.get('usi')
@@ -583,6 +836,15 @@ def generate_qr():
     return flask.send_file(qr_bytes, 'image/png')
 
 
+@blueprint.errorhandler(upstream.UpstreamUnavailableError)
+def upstream_unavailable(error):
+    # Fail fast while the upstream host is considered unhealthy.
+    response = flask.jsonify(_get_error_result(error, 503))
+    response.status_code = 503
+    response.retry_after = math.ceil(upstream.UPSTREAM_BREAKER_COOLDOWN)
+    return response
+
+
 @blueprint.errorhandler(Exception)
 def internal_error(error):
     return flask.render_template('500.html', error=error), 500
@@ -0,0 +1,51 @@
+import numpy as np
+from spectrum_utils import spectrum as sus
+
+import rendering
+import similarity
+import spectrum_index
+import spectrum_view
+
+
+def warm_up(worker: bool = True) -> None:
+    """
+    Compile the JIT functions and initialize the renderers, so that the first
+    requests after a worker (re)starts don't pay these one-time costs.
+
+    The compiled functions are cached on disk (in `__pycache__`, or in
+    `NUMBA_CACHE_DIR` if set), so only the first worker after a deployment
+    compiles them while later workers load them from the cache.
+
+    Parameters
+    ----------
+    worker : bool
+        Whether a server worker is warmed up, or the gunicorn master process
+        from which the workers are forked (when preloading the app). The
+        master doesn't start renderer processes or run the parallel
+        similarity functions, of which the threading layer isn't fork-safe.
+    """
+    spectra = [_get_spectrum(precursor_mz, precursor_charge)
+               for precursor_mz, precursor_charge in ((500., 2), (520., 1))]
+    # Compile the cosine similarity for the peak arrays of the spectrum views
+    # that are plotted, the cached spectra that are searched, and the batch
+    # similarities.
+    plotted = [spectrum_view.SpectrumView(spectrum)
+               .annotate_mz_fragment(spectrum.mz[0], 0.02)
+               .set_mz_range(None, 1000).to_spectrum()
+               for spectrum in spectra]
+    index = spectrum_index.SpectrumIndex(len(spectra), 0.05, 2000)
+    for i, spectrum in enumerate(spectra):
+        index.add(str(i), spectrum)
+    for allow_shift in (False, True):
+        similarity.cosine(*plotted, 0.02, allow_shift)
+        index.search(spectra[0], 0.02, allow_shift, 1)
+        if worker:
+            similarity.cosine_matrix(spectra, 0.02, allow_shift)
+    rendering.warm_up(worker)
+
+
+def _get_spectrum(precursor_mz: float, precursor_charge: int) \
+        -> sus.MsmsSpectrum:
+    mz = np.linspace(100, 1000, 20)
+    return spectrum_view.freeze(sus.MsmsSpectrum(
+        'warm-up', precursor_mz, precursor_charge, mz, np.ones_like(mz)))